@@ -0,0 +1,12 @@
+-- 0006_notes_keyset.sql — Keyset pagination for note lists
+-- Extend idx_notes_updated with id so (updated_at, id) cursors are served in index order.
+DO $$ BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_indexes WHERE indexname = 'idx_notes_updated' AND indexdef LIKE '%updated_at DESC, id DESC)%'
+  ) THEN
+    DROP INDEX IF EXISTS idx_notes_updated;
+    CREATE INDEX idx_notes_updated ON notes(user_id, updated_at DESC, id DESC);
+  END IF;
+END $$;
+
+-- Rollback: DROP INDEX idx_notes_updated; CREATE INDEX idx_notes_updated ON notes(user_id, updated_at DESC);
@@ -0,0 +1,16 @@
+-- 0007_index_jobs.sql — Durable search indexing queue, one row per note
+-- Repeated requests for a note update its row instead of adding jobs.
+CREATE TABLE IF NOT EXISTS index_jobs (
+  note_id UUID PRIMARY KEY REFERENCES notes(id) ON DELETE CASCADE,
+  -- latest request; a worker only deletes the row if this is unchanged
+  requested_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+  -- oldest request not yet indexed; used for lag
+  first_requested_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+  rebuild_blocks BOOLEAN NOT NULL DEFAULT false,
+  claimed_until TIMESTAMPTZ,
+  attempts INT NOT NULL DEFAULT 0,
+  last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_index_jobs_requested ON index_jobs(requested_at);
+
+-- Rollback: DROP TABLE index_jobs;
@@ -0,0 +1,6 @@
+-- 0008_block_text_cache.sql — Cache each block's decoded plain text
+-- text_cache_version is the block_versions.version the text was decoded from.
+ALTER TABLE blocks ADD COLUMN IF NOT EXISTS text_cache TEXT;
+ALTER TABLE blocks ADD COLUMN IF NOT EXISTS text_cache_version BIGINT;
+
+-- Rollback: ALTER TABLE blocks DROP COLUMN text_cache, DROP COLUMN text_cache_version;
@@ -0,0 +1,12 @@
+-- 0009_block_state.sql — Maintained Yjs state per block, compacted history
+-- blocks.ydoc_state is every update merged; state_version is the last version
+-- folded in. block_versions rows are either raw updates or checkpoints (full
+-- state as of that version); the compactor folds old updates into checkpoints.
+ALTER TABLE blocks ADD COLUMN IF NOT EXISTS ydoc_state BYTEA;
+ALTER TABLE blocks ADD COLUMN IF NOT EXISTS state_vector BYTEA;
+ALTER TABLE blocks ADD COLUMN IF NOT EXISTS state_version BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE blocks ADD COLUMN IF NOT EXISTS checkpoint_version BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE block_versions ADD COLUMN IF NOT EXISTS kind TEXT NOT NULL DEFAULT 'update';
+
+-- Rollback: ALTER TABLE block_versions DROP COLUMN kind;
+--           ALTER TABLE blocks DROP COLUMN ydoc_state, DROP COLUMN state_vector, DROP COLUMN state_version, DROP COLUMN checkpoint_version;
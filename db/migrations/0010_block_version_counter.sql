@@ -0,0 +1,8 @@
+-- 0010_block_version_counter.sql — blocks.state_version is the per-block version counter
+-- Pushes allocate with UPDATE blocks SET state_version = state_version + 1 RETURNING,
+-- so the counter must be at least the newest stored version for older blocks.
+UPDATE blocks b SET state_version = v.max_version
+FROM (SELECT block_id, max(version) AS max_version FROM block_versions GROUP BY block_id) v
+WHERE b.id = v.block_id AND b.state_version < v.max_version;
+
+-- Rollback: none needed (data-only; the column is from 0009)
@@ -0,0 +1,8 @@
+-- 0011_search_weights.sql — Weighted note_search vectors and per-user text search config
+-- Vectors are now setweight(title,'A') || setweight(excerpt,'B') || setweight(plain_text,'C')
+-- built with users.search_config; existing rows are refreshed by POST /admin/reindex-search.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS search_config TEXT NOT NULL DEFAULT 'english';
+-- Search no longer matches on notes directly
+DROP INDEX IF EXISTS idx_notes_search;
+
+-- Rollback: ALTER TABLE users DROP COLUMN search_config; re-run 0002_search_index.sql
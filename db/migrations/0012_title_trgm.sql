@@ -0,0 +1,7 @@
+-- 0012_title_trgm.sql — Fuzzy and prefix title lookup for /search/titles
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS idx_notes_title_trgm ON notes USING GIN (title gin_trgm_ops);
+-- One- and two-character prefixes are below trigram length; serve them by btree
+CREATE INDEX IF NOT EXISTS idx_notes_title_prefix ON notes (user_id, lower(title) text_pattern_ops);
+
+-- Rollback: DROP INDEX idx_notes_title_prefix; DROP INDEX idx_notes_title_trgm;
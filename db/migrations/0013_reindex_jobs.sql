@@ -0,0 +1,22 @@
+-- 0013_reindex_jobs.sql — Resumable, chunked search reindex jobs
+-- last_note_id is the keyset cursor; it is committed with each chunk, so a job
+-- that dies resumes after the last finished chunk.
+CREATE TABLE IF NOT EXISTS reindex_jobs (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  status TEXT NOT NULL DEFAULT 'running', -- running | done | failed | cancelled
+  rebuild_blocks BOOLEAN NOT NULL DEFAULT false,
+  chunk_size INT NOT NULL DEFAULT 500,
+  last_note_id UUID NOT NULL DEFAULT '00000000-0000-0000-0000-000000000000',
+  processed BIGINT NOT NULL DEFAULT 0,
+  total BIGINT NOT NULL DEFAULT 0,
+  error TEXT,
+  heartbeat_at TIMESTAMPTZ,
+  started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  finished_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS idx_reindex_jobs_started ON reindex_jobs(started_at DESC);
+-- At most one running job
+CREATE UNIQUE INDEX IF NOT EXISTS uniq_reindex_jobs_running ON reindex_jobs((true)) WHERE status = 'running';
+
+-- Rollback: DROP TABLE reindex_jobs;
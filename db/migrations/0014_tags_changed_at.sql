@@ -0,0 +1,6 @@
+-- 0014_tags_changed_at.sql — Per-user tag change stamp for list ETags
+-- Renaming or deleting a tag changes ?tag= listings without touching any
+-- note's updated_at; GET /notes folds this into its ETag.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS tags_changed_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+-- Rollback: ALTER TABLE users DROP COLUMN tags_changed_at;
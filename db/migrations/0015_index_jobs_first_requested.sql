@@ -0,0 +1,6 @@
+-- 0015_index_jobs_first_requested.sql — Claim order for the index queue
+-- Workers claim jobs oldest-first-request first, and also claim notes that
+-- never went quiet once their first request is INDEX_QUEUE_MAX_DELAY_SECONDS old.
+CREATE INDEX IF NOT EXISTS idx_index_jobs_first_requested ON index_jobs(first_requested_at);
+
+-- Rollback: DROP INDEX IF EXISTS idx_index_jobs_first_requested;
@@ -0,0 +1,12 @@
+-- 0016_block_compaction_backoff.sql — Compactor ordering and failure backoff
+-- The compactor takes the blocks with the longest uncompacted history first,
+-- walking this index, and backs off blocks whose history fails to merge
+-- instead of retrying them every pass.
+ALTER TABLE blocks ADD COLUMN IF NOT EXISTS compact_attempts INT NOT NULL DEFAULT 0;
+ALTER TABLE blocks ADD COLUMN IF NOT EXISTS compact_failed_at TIMESTAMPTZ;
+CREATE INDEX IF NOT EXISTS idx_blocks_compact_backlog
+  ON blocks ((state_version - checkpoint_version) DESC) WHERE ydoc_state IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_blocks_legacy ON blocks(id) WHERE ydoc_state IS NULL;
+
+-- Rollback: DROP INDEX IF EXISTS idx_blocks_legacy; DROP INDEX IF EXISTS idx_blocks_compact_backlog;
+--           ALTER TABLE blocks DROP COLUMN compact_failed_at, DROP COLUMN compact_attempts;
@@ -133,7 +133,7 @@ export function App() {
   const onSearch = async () => {
     if (!token || !query.trim()) return
     const r = await fetch(`/search?q=${encodeURIComponent(query)}`, { headers: { Authorization: `Bearer ${token}` }})
-    setResults(await r.json())
+    setResults((await r.json()).results)
   }
   const refreshRepos = async () => {
     if (!token) return
@@ -376,7 +376,15 @@ function GraphView({ data, selectedId, onSelect }: { data: { nodes:any[]; edges:
   // Position nodes: selected in center, others in circle
   let positioned: any[] = []
   const others = nodes.filter((n:any)=> n.id !== selectedId)
-  if (selectedId && nodes.find((n:any)=>n.id===selectedId)) {
+  const laidOut = nodes.length > 0 && nodes.every((n:any)=> typeof n.x === 'number' && typeof n.y === 'number')
+  if (laidOut) {
+    // Server-computed layout: scale it into the box
+    const xs = nodes.map((n:any)=>n.x), ys = nodes.map((n:any)=>n.y)
+    const minX = Math.min(...xs), minY = Math.min(...ys)
+    const span = Math.max(Math.max(...xs) - minX, Math.max(...ys) - minY, 1e-6)
+    const scale = (size - 40) / span
+    positioned = nodes.map((n:any)=> ({ id: n.id, label: n.label, x: 20 + (n.x - minX)*scale, y: 20 + (n.y - minY)*scale, selected: n.id === selectedId }))
+  } else if (selectedId && nodes.find((n:any)=>n.id===selectedId)) {
     const sel = nodes.find((n:any)=>n.id===selectedId)
     positioned.push({ id: selectedId, label: sel?.label, x: cx, y: cy, selected: true })
     const count = Math.max(1, others.length)
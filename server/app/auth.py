@@ -1,8 +1,15 @@
 from __future__ import annotations
 
-import secrets
+import asyncio
+import hmac
+import os
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional
+from datetime import datetime
+from typing import Dict, Optional, Tuple
 
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
@@ -10,10 +17,17 @@ from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from argon2 import PasswordHasher
 
-from .db import get_session
+from .config import env_float, env_int
+from .db import get_session, register_warmup
+from .metrics import registry
 
 
-ph = PasswordHasher()
+# Argon2 cost parameters; changing them makes existing hashes get upgraded on next login
+ph = PasswordHasher(
+    time_cost=env_int("ARGON2_TIME_COST", 3),
+    memory_cost=env_int("ARGON2_MEMORY_COST_KIB", 65536),
+    parallelism=env_int("ARGON2_PARALLELISM", 4),
+)
 bearer = HTTPBearer(auto_error=False)
 
 
@@ -28,11 +42,190 @@ def verify_password(hash_: str, password: str) -> bool:
         return False
 
 
+def password_needs_rehash(hash_: str) -> bool:
+    try:
+        return ph.check_needs_rehash(hash_)
+    except Exception:
+        return False
+
+
+class HashingPool:
+    """Runs Argon2 on a small dedicated thread pool, off the event loop.
+
+    argon2-cffi releases the GIL while hashing, so ``workers`` threads give real
+    parallelism. At most ``max_pending`` calls may be running or queued per
+    process; beyond that callers get a 429 instead of piling up.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 32):
+        self.workers = max(1, workers)
+        self.max_pending = max(self.workers, max_pending)
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="argon2")
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=429, detail="too many authentication requests", headers={"Retry-After": "1"})
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+hashing_pool = HashingPool(
+    workers=env_int("PASSWORD_HASH_WORKERS", 2),
+    max_pending=env_int("PASSWORD_HASH_MAX_PENDING", 32),
+)
+
+
+async def hash_password_async(password: str) -> str:
+    return await hashing_pool.run(hash_password, password)
+
+
+async def verify_password_async(hash_: str, password: str) -> Tuple[bool, Optional[str]]:
+    """Verify off the event loop. Returns (ok, new_hash); new_hash is set when
+    the stored hash uses outdated parameters and should be replaced."""
+    def _verify() -> Tuple[bool, Optional[str]]:
+        if not verify_password(hash_, password):
+            return False, None
+        if password_needs_rehash(hash_):
+            return True, hash_password(password)
+        return True, None
+
+    return await hashing_pool.run(_verify)
+
+
 @dataclass
 class CurrentUser:
     id: str
     email: str
 
+    @property
+    def uid(self) -> uuid.UUID:
+        return uuid.UUID(self.id)
+
+
+class TokenCache:
+    """Bounded LRU of bearer token -> CurrentUser.
+
+    Entries live for at most ``ttl`` seconds and never past the session's
+    ``expires_at``. The cache is per process, so a logout handled by another
+    worker is only observed here once the TTL runs out.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[CurrentUser, float]]" = OrderedDict()
+
+    def get(self, token: str) -> Optional[CurrentUser]:
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        user, deadline = entry
+        if deadline <= time.monotonic():
+            del self._entries[token]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return user
+
+    def peek(self, token: str) -> Optional[CurrentUser]:
+        """Look up without touching LRU order or counters."""
+        entry = self._entries.get(token)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def put(self, token: str, user: CurrentUser, expires_at: Optional[datetime] = None) -> None:
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        lifetime = self.ttl
+        if expires_at is not None:
+            lifetime = min(lifetime, expires_at.timestamp() - time.time())
+            if lifetime <= 0:
+                return
+        self._entries[token] = (user, time.monotonic() + lifetime)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, token: str) -> None:
+        self._entries.pop(token, None)
+
+    def invalidate_user(self, user_id: str) -> None:
+        for token in [t for t, (u, _) in self._entries.items() if u.id == user_id]:
+            del self._entries[token]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "maxEntries": self.max_entries,
+            "ttlSeconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+token_cache = TokenCache(
+    max_entries=env_int("AUTH_CACHE_MAX_ENTRIES", 10000),
+    ttl=env_float("AUTH_CACHE_TTL_SECONDS", 30.0),
+)
+
+
+def parse_token(token: str) -> Optional[uuid.UUID]:
+    # Session ids are UUIDs; anything else can never match a row
+    try:
+        return uuid.UUID(token)
+    except (ValueError, AttributeError, TypeError):
+        return None
+
+
+_SESSION_LOOKUP = text(
+    """
+    SELECT u.id::text AS id, u.email, s.expires_at
+    FROM sessions s
+    JOIN users u ON u.id = s.user_id
+    WHERE s.id = :sid AND (s.expires_at IS NULL OR s.expires_at > now())
+    LIMIT 1
+    """
+)
+register_warmup(_SESSION_LOOKUP, {"sid": uuid.UUID(int=0)})
+
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+async def require_admin(creds: Optional[HTTPAuthorizationCredentials] = Depends(bearer)) -> None:
+    """Guard for /admin: a bearer token equal to ADMIN_TOKEN. Unset = admin API off."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API disabled; set ADMIN_TOKEN")
+    if creds is None or not hmac.compare_digest(creds.credentials.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
 
 async def get_current_user(
     creds: Optional[HTTPAuthorizationCredentials] = Depends(bearer),
@@ -40,35 +233,56 @@ async def get_current_user(
 ) -> CurrentUser:
     if creds is None or not creds.credentials:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    token = creds.credentials
-    q = text(
-        """
-        SELECT u.id::text AS id, u.email
-        FROM sessions s
-        JOIN users u ON u.id = s.user_id
-        WHERE s.id::text = :token AND (s.expires_at IS NULL OR s.expires_at > now())
-        LIMIT 1
-        """
-    )
-    res = await session.execute(q, {"token": token})
+    user = await resolve_token(creds.credentials, session)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return user
+
+
+async def resolve_token(token: str, session: AsyncSession) -> Optional[CurrentUser]:
+    """Bearer token to user, via the cache; None if unknown or expired."""
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
+    sid = parse_token(token)
+    if sid is None:
+        return None
+    res = await session.execute(_SESSION_LOOKUP, {"sid": sid})
     row = res.fetchone()
     if row is None:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    return CurrentUser(id=row.id, email=row.email)
+        return None
+    user = CurrentUser(id=row.id, email=row.email)
+    token_cache.put(token, user, row.expires_at)
+    return user
+
+
+async def revoke_session(token: str, session: AsyncSession) -> None:
+    token_cache.invalidate(token)
+    sid = parse_token(token)
+    if sid is None:
+        return
+    await session.execute(text("DELETE FROM sessions WHERE id = :sid"), {"sid": sid})
+    await session.commit()
 
 
 async def create_session_for_user(user_id: str, session: AsyncSession) -> str:
-    token = secrets.token_hex(16)
+    # Session ids double as bearer tokens: gen_random_uuid() in SQL
     q = text(
-        "INSERT INTO sessions (id, user_id, expires_at) VALUES (:id::uuid, :uid::uuid, now() + interval '7 days')"
+        "INSERT INTO sessions (user_id, expires_at) VALUES (:uid, now() + interval '7 days') RETURNING id::text"
     )
-    # We store UUID format; if token isn't UUID, we can generate UUID in SQL
-    # Instead, use gen_random_uuid() and return it
-    q = text(
-        "INSERT INTO sessions (user_id, expires_at) VALUES (:uid::uuid, now() + interval '7 days') RETURNING id::text"
-    )
-    res = await session.execute(q, {"uid": user_id})
+    res = await session.execute(q, {"uid": uuid.UUID(str(user_id))})
     row = res.fetchone()
     await session.commit()
     return row[0]
 
+
+registry.gauge(
+    "vnote_auth_token_cache",
+    lambda: {(("stat", k),): float(v) for k, v in token_cache.stats().items() if k != "hitRate"},
+    help="Bearer token cache size and hit/miss counters",
+)
+registry.gauge(
+    "vnote_password_hash_pending",
+    lambda: {(): float(hashing_pool.pending)},
+    help="Argon2 calls running or queued",
+)
@@ -0,0 +1,297 @@
+"""Search indexing queue backed by the index_jobs table.
+
+Writers call ``enqueue_index`` inside their own transaction; a note has at most
+one pending row, so a burst of writes to it costs one reindex. Workers claim
+rows with ``FOR UPDATE SKIP LOCKED`` under a lease, so any number of in-app or
+``python -m app.worker`` processes can share the queue.
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from .config import env_float, env_int
+from .db import SessionLocal
+from .metrics import registry
+from .utils.ids import require_uuid
+from .utils.indexing import rebuild_and_update_search, update_notes_search_bulk
+
+log = logging.getLogger("vnote.index")
+
+
+# inline: index inside the request (old behaviour); inprocess: enqueue and run a
+# worker task in each app process; external: enqueue only, run app.worker
+MODE = os.getenv("INDEX_QUEUE_MODE", "inprocess").strip().lower()
+if MODE not in ("inline", "inprocess", "external"):
+    MODE = "inprocess"
+
+_ENQUEUE = text(
+    """
+    INSERT INTO index_jobs (note_id, rebuild_blocks)
+    SELECT id, :blocks FROM unnest(CAST(:ids AS uuid[])) AS t(id)
+    ON CONFLICT (note_id) DO UPDATE SET
+      requested_at = clock_timestamp(),
+      rebuild_blocks = index_jobs.rebuild_blocks OR EXCLUDED.rebuild_blocks
+    """
+)
+
+
+async def enqueue_index(session: AsyncSession, note_ids: Iterable[str | UUID], rebuild_blocks: bool = False) -> None:
+    """Request a reindex of ``note_ids``; commits with the caller's transaction.
+
+    ``rebuild_blocks`` also re-derives plain_text from the note's CRDT blocks.
+    """
+    ids = list(dict.fromkeys(require_uuid(i) for i in note_ids))
+    if not ids:
+        return
+    if MODE == "inline":
+        if rebuild_blocks:
+            for nid in ids:
+                try:
+                    await rebuild_and_update_search(session, nid)
+                except (asyncio.TimeoutError, BrokenProcessPool) as e:
+                    # Nothing was cached, so the note's next write decodes it again
+                    log.warning("decoding note %s failed: %s", nid, e.__class__.__name__)
+        else:
+            await update_notes_search_bulk(session, ids)
+        return
+    await session.execute(_ENQUEUE, {"ids": ids, "blocks": rebuild_blocks})
+    registry.inc("vnote_index_jobs_enqueued_total", float(len(ids)))
+
+
+async def enqueue_user_reindex(session: AsyncSession, user_id: UUID) -> None:
+    """Reindex every note of a user, e.g. after a search config change."""
+    if MODE == "inline":
+        res = await session.execute(text("SELECT id FROM notes WHERE user_id = :uid"), {"uid": user_id})
+        await update_notes_search_bulk(session, [r.id for r in res])
+        return
+    await session.execute(
+        text(
+            """
+            INSERT INTO index_jobs (note_id)
+            SELECT id FROM notes WHERE user_id = :uid
+            ON CONFLICT (note_id) DO UPDATE SET requested_at = clock_timestamp()
+            """
+        ),
+        {"uid": user_id},
+    )
+
+
+class IndexWorker:
+    """Claims due jobs in batches and indexes them.
+
+    A job is due once it has been quiet for ``debounce`` seconds, which is what
+    collapses keystroke-rate CRDT pushes into a single decode. A note that never
+    goes quiet is still picked up ``max_delay`` seconds after its first request.
+    From attempt ``max_attempts`` on, blocks that still can't be decoded are
+    indexed as blank, so one bad block state can't keep a note unindexed.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker = SessionLocal,
+        batch: int = 50,
+        poll: float = 1.0,
+        debounce: float = 0.5,
+        lease: float = 60.0,
+        max_delay: float = 10.0,
+        max_attempts: int = 5,
+    ):
+        self.session_factory = session_factory
+        self.batch = batch
+        self.poll = poll
+        self.debounce = debounce
+        self.lease = lease
+        self.max_delay = max_delay
+        self.max_attempts = max(1, max_attempts)
+        self.depth = 0
+        self.lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._stop = asyncio.Event()
+
+    async def _claim(self, note_ids: Optional[Sequence[UUID]] = None) -> List[Any]:
+        where = ["(claimed_until IS NULL OR claimed_until < now())"]
+        params: Dict[str, Any] = {"n": self.batch, "lease": self.lease}
+        if note_ids is not None:
+            where.append("note_id = ANY(:ids)")
+            params["ids"] = list(note_ids)
+        else:
+            where.append(
+                "(requested_at < clock_timestamp() - make_interval(secs => :debounce)"
+                " OR first_requested_at < clock_timestamp() - make_interval(secs => :max_delay))"
+            )
+            params["debounce"] = self.debounce
+            params["max_delay"] = self.max_delay
+        q = text(
+            f"""
+            WITH c AS (
+              SELECT note_id FROM index_jobs
+              WHERE {' AND '.join(where)}
+              ORDER BY first_requested_at
+              LIMIT :n
+              FOR UPDATE SKIP LOCKED
+            )
+            UPDATE index_jobs j
+            SET claimed_until = now() + make_interval(secs => :lease), attempts = j.attempts + 1
+            FROM c WHERE j.note_id = c.note_id
+            RETURNING j.note_id, j.requested_at, j.rebuild_blocks, j.first_requested_at, j.attempts
+            """
+        )
+        async with self.session_factory() as session:
+            res = await session.execute(q, params)
+            jobs = res.fetchall()
+            await session.commit()
+        return jobs
+
+    async def _complete(self, session: AsyncSession, jobs: Sequence[Any]) -> None:
+        # Rows re-requested while we worked stay queued for another pass
+        await session.execute(
+            text(
+                """
+                WITH done AS (
+                  DELETE FROM index_jobs j
+                  USING unnest(CAST(:ids AS uuid[]), CAST(:ts AS timestamptz[])) AS t(id, ts)
+                  WHERE j.note_id = t.id AND j.requested_at = t.ts
+                  RETURNING j.note_id
+                )
+                UPDATE index_jobs SET claimed_until = NULL, attempts = 0, last_error = NULL,
+                  first_requested_at = requested_at
+                WHERE note_id = ANY(:ids) AND note_id NOT IN (SELECT note_id FROM done)
+                """
+            ),
+            {"ids": [j.note_id for j in jobs], "ts": [j.requested_at for j in jobs]},
+        )
+        now = time.time()
+        for j in jobs:
+            registry.histogram("vnote_index_job_lag_seconds").observe(max(0.0, now - j.first_requested_at.timestamp()))
+
+    async def _fail(self, job: Any, error: BaseException) -> None:
+        log.warning("indexing note %s failed: %s", job.note_id, error)
+        registry.inc("vnote_index_jobs_total", result="error")
+        async with self.session_factory() as session:
+            # Exponential backoff via the lease, capped at five minutes
+            await session.execute(
+                text(
+                    """
+                    UPDATE index_jobs SET last_error = :err,
+                      claimed_until = now() + make_interval(secs => LEAST(300, 5 * power(2, attempts)))
+                    WHERE note_id = :id
+                    """
+                ),
+                {"id": job.note_id, "err": f"{error.__class__.__name__}: {error}"[:1000]},
+            )
+            await session.commit()
+
+    async def _process(self, jobs: Sequence[Any]) -> None:
+        plain = [j for j in jobs if not j.rebuild_blocks]
+        if plain:
+            try:
+                async with self.session_factory() as session:
+                    await update_notes_search_bulk(session, [j.note_id for j in plain])
+                    await self._complete(session, plain)
+                    await session.commit()
+                registry.inc("vnote_index_jobs_total", float(len(plain)), result="ok")
+            except Exception as e:
+                for j in plain:
+                    await self._fail(j, e)
+        # Block rebuilds decode CRDT state, so each gets its own transaction
+        for j in jobs:
+            if not j.rebuild_blocks:
+                continue
+            try:
+                async with self.session_factory() as session:
+                    await rebuild_and_update_search(session, j.note_id, give_up=j.attempts >= self.max_attempts)
+                    await self._complete(session, [j])
+                    await session.commit()
+                registry.inc("vnote_index_jobs_total", result="ok")
+            except Exception as e:
+                await self._fail(j, e)
+
+    async def run_once(self, note_ids: Optional[Sequence[UUID]] = None) -> int:
+        """Process one batch; with ``note_ids``, just those notes and no debounce."""
+        jobs = await self._claim(note_ids)
+        if jobs:
+            await self._process(jobs)
+        return len(jobs)
+
+    async def sample(self) -> Dict[str, float]:
+        async with self.session_factory() as session:
+            res = await session.execute(
+                text(
+                    "SELECT count(*) AS depth,"
+                    " COALESCE(EXTRACT(EPOCH FROM clock_timestamp() - min(first_requested_at)), 0) AS lag"
+                    " FROM index_jobs"
+                )
+            )
+            row = res.fetchone()
+        self.depth, self.lag = int(row.depth), float(row.lag)
+        return {"depth": self.depth, "lagSeconds": self.lag}
+
+    async def wait_for(self, note_ids: Iterable[str | UUID], timeout: float = 10.0) -> bool:
+        """Index ``note_ids`` now, or wait for whoever holds them; False on timeout."""
+        if MODE == "inline":
+            return True
+        ids = [require_uuid(i) for i in note_ids]
+        deadline = time.monotonic() + timeout
+        while True:
+            await self.run_once(ids)
+            async with self.session_factory() as session:
+                res = await session.execute(text("SELECT count(*) FROM index_jobs WHERE note_id = ANY(:ids)"), {"ids": ids})
+                if not res.scalar():
+                    return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+
+    async def run_forever(self) -> None:
+        last_sample = 0.0
+        while not self._stop.is_set():
+            try:
+                n = await self.run_once()
+                if time.monotonic() - last_sample >= self.poll:
+                    await self.sample()
+                    last_sample = time.monotonic()
+            except Exception as e:  # keep the loop alive across DB hiccups
+                log.warning("index worker error: %s", e)
+                n = 0
+            if n < self.batch:
+                try:
+                    await asyncio.wait_for(self._stop.wait(), timeout=self.poll)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._stop = asyncio.Event()
+            self._task = asyncio.create_task(self.run_forever())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._stop.set()
+            await self._task
+            self._task = None
+
+
+index_worker = IndexWorker(
+    batch=int(env_float("INDEX_QUEUE_BATCH", 50)),
+    poll=env_float("INDEX_QUEUE_POLL_SECONDS", 1.0),
+    debounce=env_float("INDEX_QUEUE_DEBOUNCE_MS", 500) / 1000.0,
+    lease=env_float("INDEX_QUEUE_LEASE_SECONDS", 60),
+    max_delay=env_float("INDEX_QUEUE_MAX_DELAY_SECONDS", 10),
+    max_attempts=env_int("INDEX_QUEUE_MAX_ATTEMPTS", 5),
+)
+
+registry.describe("vnote_index_jobs_total", "Indexing jobs processed by result")
+registry.describe("vnote_index_jobs_enqueued_total", "Indexing requests, before per-note coalescing")
+registry.describe("vnote_index_job_lag_seconds", "Time from first request to indexed")
+registry.gauge(
+    "vnote_index_queue",
+    lambda: {(("stat", "depth"),): float(index_worker.depth), (("stat", "lag_seconds"),): index_worker.lag},
+    help="Pending indexing jobs and age of the oldest, as last sampled by this process's worker",
+)
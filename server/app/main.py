@@ -2,8 +2,32 @@ import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.gzip import GZipMiddleware
-from .routers import auth, notes, tags, folders, health, attachments, sync, graph, search, repos, admin, blocks
-from .middleware import RateLimitMiddleware, BodySizeLimitMiddleware
+from .routers import auth, notes, tags, folders, health, attachments, sync, graph, search, repos, admin, blocks, ws
+from .middleware import (
+    RateLimitMiddleware,
+    RateRule,
+    BodySizeLimitMiddleware,
+    DEFAULT_BODY_RULES,
+    DEFAULT_RATE_RULES,
+    make_bucket_store,
+    parse_body_rules,
+    parse_rate_rules,
+    rule_for,
+)
+from .auth import hashing_pool
+from .config import env_int
+from .db import engine, warmup_pool
+from . import index_queue
+from .metrics import MetricsMiddleware, instrument_engine
+from .reindex import reindexer
+from .slowlog import slow_query_log
+from .utils.blockstore import block_compactor
+from .utils.collab import collab_hub
+from .utils.crdt import decode_pool
+from .utils.graph_index import graph_index
+from .utils.graph_layout import graph_layouts
+from .utils.search_backend import search_backend
+from .utils.search_cache import search_cache
 
 
 def create_app() -> FastAPI:
@@ -18,21 +42,40 @@ def create_app() -> FastAPI:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        # Browser clients need these for conditional listing and paging
+        expose_headers=["ETag", "X-Next-Cursor"],
     )
 
     # GZip and basic protections
     app.add_middleware(GZipMiddleware, minimum_size=500)
     # Read limits from env
-    try:
-        rate = int(os.getenv("RATE_LIMIT_PER_MIN", "120"))
-    except ValueError:
-        rate = 120
-    try:
-        max_body = int(os.getenv("MAX_BODY_BYTES", str(10 * 1024 * 1024)))
-    except ValueError:
-        max_body = 10 * 1024 * 1024
-    app.add_middleware(RateLimitMiddleware, max_per_minute=rate)
-    app.add_middleware(BodySizeLimitMiddleware, max_body_bytes=max_body)
+    rate = env_int("RATE_LIMIT_PER_MIN", 120)
+    burst = env_int("RATE_LIMIT_BURST", rate)
+    rate_keys = env_int("RATE_LIMIT_MAX_KEYS", 100000)
+    rate_rules = parse_rate_rules(os.getenv("RATE_LIMIT_RULES", DEFAULT_RATE_RULES))
+    max_body = env_int("MAX_BODY_BYTES", 10 * 1024 * 1024)
+    rate_store = make_bucket_store(os.getenv("RATE_LIMIT_SHM_PATH") or None, rate_keys)
+    app.add_middleware(
+        RateLimitMiddleware,
+        max_per_minute=rate,
+        burst=burst,
+        rules=rate_rules,
+        store=rate_store,
+    )
+    body_rules = parse_body_rules(os.getenv("MAX_BODY_RULES", DEFAULT_BODY_RULES))
+    app.add_middleware(BodySizeLimitMiddleware, max_body_bytes=max_body, rules=body_rules)
+    # The middlewares only see HTTP; updates sent over /ws get the budget and
+    # size cap of POST /blocks/:id/crdt, from the same buckets
+    crdt_path = "/blocks/-/crdt"
+    collab_hub.limit_updates(
+        rate_store,
+        rule_for(rate_rules, "POST", crdt_path) or RateRule(None, rate, burst, "ip"),
+        next((limit for route, limit in body_rules if route.matches("POST", crdt_path)), max_body),
+    )
+    # Outermost, so rejected and slow-to-parse requests are timed too
+    app.add_middleware(MetricsMiddleware)
+    instrument_engine(engine.sync_engine)
+    slow_query_log.install(engine)
 
     # Routers
     app.include_router(health.router, tags=["admin"])
@@ -47,6 +90,29 @@ def create_app() -> FastAPI:
     app.include_router(repos.router, prefix="/repos", tags=["repos"])
     app.include_router(admin.router, prefix="/admin", tags=["admin"])
     app.include_router(blocks.router, tags=["blocks"])  # mixed prefixes
+    app.include_router(ws.router, prefix="/ws", tags=["collab"])
+
+    if os.getenv("DB_POOL_WARMUP", "1").lower() not in ("0", "false", "no"):
+        app.add_event_handler("startup", warmup_pool)
+    app.add_event_handler("shutdown", hashing_pool.shutdown)
+    app.add_event_handler("startup", collab_hub.start)
+    app.add_event_handler("shutdown", collab_hub.stop)
+    app.add_event_handler("startup", search_cache.start)
+    app.add_event_handler("shutdown", search_cache.stop)
+    app.add_event_handler("startup", graph_index.start)
+    app.add_event_handler("shutdown", graph_index.stop)
+    app.add_event_handler("startup", search_backend.start)
+    app.add_event_handler("shutdown", search_backend.stop)
+    # Admin reindex jobs run in the process that started them
+    app.add_event_handler("shutdown", reindexer.stop)
+    app.add_event_handler("shutdown", decode_pool.shutdown)
+    app.add_event_handler("shutdown", graph_layouts.stop)
+    if index_queue.MODE == "inprocess":
+        app.add_event_handler("startup", reindexer.start)
+        app.add_event_handler("startup", index_queue.index_worker.start)
+        app.add_event_handler("shutdown", index_queue.index_worker.stop)
+        app.add_event_handler("startup", block_compactor.start)
+        app.add_event_handler("shutdown", block_compactor.stop)
 
     return app
 
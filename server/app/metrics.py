@@ -0,0 +1,244 @@
+"""Per-process counters and fixed-bucket histograms, rendered as Prometheus text."""
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "total", "sum")
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Estimate by linear interpolation inside the bucket holding the rank."""
+        if self.total == 0:
+            return 0.0
+        rank = q * self.total
+        seen = 0
+        lower = 0.0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                upper = self.bounds[i]
+                return lower + (upper - lower) * ((rank - seen) / c)
+            seen += c
+            if i < len(self.bounds):
+                lower = self.bounds[i]
+        return self.bounds[-1]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+        self.gauges: Dict[str, Callable[[], Dict[Tuple[Tuple[str, str], ...], float]]] = {}
+        self.help: Dict[str, str] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def histogram(self, name: str, bounds: Sequence[float] = LATENCY_BUCKETS, **labels: str) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = Histogram(bounds)
+        return h
+
+    def gauge(self, name: str, fn: Callable[[], Dict[Tuple[Tuple[str, str], ...], float]], help: str = "") -> None:
+        """Register a callback sampled at scrape time; returns {labels: value}."""
+        self.gauges[name] = fn
+        if help:
+            self.help[name] = help
+
+    def describe(self, name: str, help: str) -> None:
+        self.help[name] = help
+
+    def render(self) -> str:
+        lines: List[str] = []
+        typed = set()
+
+        def header(name: str, kind: str) -> None:
+            if name in typed:
+                return
+            typed.add(name)
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{_labels(labels)} {_num(value)}")
+        for (name, labels), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, c in zip(h.bounds, h.counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{_labels(labels + (('le', _num(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {h.total}")
+            lines.append(f"{name}_sum{_labels(labels)} {_num(h.sum)}")
+            lines.append(f"{name}_count{_labels(labels)} {h.total}")
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                values = fn()
+            except Exception:
+                continue
+            header(name, "gauge")
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{_labels(labels)} {_num(value)}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name: str, quantiles: Sequence[float] = (0.5, 0.95, 0.99)) -> List[dict]:
+        out = []
+        for (hname, labels), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+            if hname != name:
+                continue
+            row = dict(labels)
+            row["count"] = h.total
+            for q in quantiles:
+                row[f"p{int(q * 100)}"] = h.quantile(q)
+            out.append(row)
+        return out
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels) + "}"
+
+
+def _num(v: float) -> str:
+    if v == int(v):
+        return str(int(v))
+    return repr(float(v))
+
+
+registry = Registry()
+registry.describe("vnote_http_request_duration_seconds", "Request latency by route template")
+registry.describe("vnote_http_request_db_seconds", "Time spent in SQL statements per request")
+registry.describe("vnote_http_request_db_statements", "SQL statements executed per request")
+registry.describe("vnote_db_statement_duration_seconds", "SQL statement latency")
+registry.describe("vnote_crdt_decodes_total", "Yjs payloads decoded to plain text")
+registry.describe("vnote_crdt_decode_pool_total", "Out-of-process decodes by result (ok, timeout, crashed, too_large)")
+registry.describe("vnote_crdt_decode_seconds", "Yjs decode latency by path (inline or pool)")
+registry.describe("vnote_indexing_calls_total", "Search index updates by kind")
+registry.describe("vnote_block_text_cache_total", "Blocks re-decoded because their cached text was stale")
+
+
+class RequestStats:
+    __slots__ = ("scope", "db_time", "db_statements")
+
+    def __init__(self, scope: Scope) -> None:
+        self.scope = scope
+        self.db_time = 0.0
+        self.db_statements = 0
+
+    @property
+    def route(self) -> str:
+        return _route_template(self.scope)
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("vnote_request_stats", default=None)
+
+
+def _route_template(scope: Scope) -> str:
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    if path:
+        return path
+    # Unmatched paths would explode label cardinality
+    return "<unmatched>"
+
+
+class MetricsMiddleware:
+    """Times each HTTP request and attributes SQL time to it via a context var."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request.reset(token)
+            route = _route_template(scope)
+            method = scope["method"]
+            registry.histogram("vnote_http_request_duration_seconds", route=route, method=method).observe(elapsed)
+            registry.histogram("vnote_http_request_db_seconds", route=route, method=method).observe(stats.db_time)
+            registry.histogram(
+                "vnote_http_request_db_statements", COUNT_BUCKETS, route=route, method=method
+            ).observe(stats.db_statements)
+            registry.inc("vnote_http_requests_total", route=route, method=method, status=str(status))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("vnote_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("vnote_query_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    _db_latency.observe(elapsed)
+    stats = current_request.get()
+    if stats is not None:
+        stats.db_time += elapsed
+        stats.db_statements += 1
+
+
+def _handle_error(ctx):
+    conn = ctx.connection
+    if conn is not None:
+        starts = conn.info.get("vnote_query_start")
+        if starts:
+            starts.pop()
+
+
+_db_latency = registry.histogram("vnote_db_statement_duration_seconds")
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Hook cursor events on a (sync) engine; safe to call more than once."""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
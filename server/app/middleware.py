@@ -1,43 +1,402 @@
+import asyncio
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
 import time
-from collections import deque, defaultdict
-from typing import Deque, Dict
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from typing import Any, FrozenSet, List, Optional, Tuple
 
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
-from starlette.responses import Response, JSONResponse
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
+from .auth import token_cache
 
-class RateLimitMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, max_per_minute: int = 120):
-        super().__init__(app)
-        self.max = max_per_minute
-        self.window = 60.0
-        self.buckets: Dict[str, Deque[float]] = defaultdict(deque)
 
-    async def dispatch(self, request: Request, call_next):
-        if request.url.path in ("/health",):
-            return await call_next(request)
-        ident = request.client.host if request.client else "anon"
+class RouteRule:
+    """A `[METHOD ]PATTERN` matcher; PATTERN is a glob over the request path."""
+
+    def __init__(self, pattern: str, methods: Optional[FrozenSet[str]] = None):
+        self.pattern = pattern
+        self.methods = methods
+
+    def matches(self, method: str, path: str) -> bool:
+        if self.methods is not None and method not in self.methods:
+            return False
+        return fnmatchcase(path, self.pattern)
+
+    @property
+    def name(self) -> str:
+        if self.methods:
+            return ",".join(sorted(self.methods)) + " " + self.pattern
+        return self.pattern
+
+
+def parse_route_spec(spec: str) -> List[Tuple[RouteRule, str]]:
+    """Parse `"[METHOD[,METHOD]] PATTERN=VALUE; ..."` into (rule, raw value) pairs."""
+    out: List[Tuple[RouteRule, str]] = []
+    for part in (spec or "").split(";"):
+        part = part.strip()
+        if not part or "=" not in part:
+            continue
+        lhs, value = part.rsplit("=", 1)
+        bits = lhs.split()
+        methods: Optional[FrozenSet[str]] = None
+        if len(bits) == 2:
+            methods = frozenset(m.strip().upper() for m in bits[0].split(",") if m.strip())
+            pattern = bits[1]
+        elif len(bits) == 1:
+            pattern = bits[0]
+        else:
+            continue
+        out.append((RouteRule(pattern, methods), value.strip()))
+    return out
+
+
+class RateRule:
+    def __init__(self, route: Optional[RouteRule], per_minute: int, burst: Optional[int] = None, scope: str = "ip"):
+        self.route = route
+        self.per_minute = max(1, per_minute)
+        self.burst = max(1, burst if burst is not None else per_minute)
+        self.scope = scope
+        self.refill_per_sec = self.per_minute / 60.0
+        self.name = route.name if route is not None else "*"
+
+
+# CRDT pushes arrive in keystroke batches; sync pulls/pushes are heavy and rare
+DEFAULT_RATE_RULES = "POST /blocks/*/crdt=600/user; /sync*=60/user"
+
+
+def parse_rate_rules(spec: str) -> List[RateRule]:
+    """`RATE_LIMIT_RULES` entries look like `POST /blocks/*/crdt=600:100/user`:
+    requests per minute, optional burst, optional key scope (`ip` or `user`)."""
+    rules: List[RateRule] = []
+    for route, value in parse_route_spec(spec):
+        scope = "ip"
+        if "/" in value:
+            value, scope = value.split("/", 1)
+            scope = scope.strip().lower()
+            if scope not in ("ip", "user"):
+                continue
+        burst: Optional[int] = None
+        try:
+            if ":" in value:
+                rate_s, burst_s = value.split(":", 1)
+                per_minute, burst = int(rate_s), int(burst_s)
+            else:
+                per_minute = int(value)
+        except ValueError:
+            continue
+        rules.append(RateRule(route, per_minute, burst, scope))
+    return rules
+
+
+class MemoryBucketStore:
+    """Per-process token buckets: one (tokens, last_refill) pair per key, with
+    least-recently-used keys evicted beyond ``max_keys``."""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: str, refill_per_sec: float, capacity: float, now: float, blocking: bool = True) -> Optional[float]:
+        """Consume one token. Returns 0 when allowed, else seconds until one is available."""
+        b = self._buckets.get(key)
+        if b is None:
+            b = [capacity, now]
+            self._buckets[key] = b
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        tokens = min(capacity, b[0] + (now - b[1]) * refill_per_sec)
+        b[1] = now
+        if tokens >= 1.0:
+            b[0] = tokens - 1.0
+            return 0.0
+        b[0] = tokens
+        return (1.0 - tokens) / refill_per_sec
+
+
+class SharedBucketStore:
+    """Token buckets in a memory-mapped file shared by every worker on the host.
+
+    The file is a fixed open-addressing table of ``slots`` entries of
+    (key hash, tokens, last_refill). Lookups probe a short window; when it is
+    full the idlest entry in the window is reused. Updates are serialized with
+    an exclusive ``flock`` so the limit holds across processes, plus a thread
+    lock, since flock doesn't exclude threads sharing the descriptor.
+    """
+
+    _HEADER = struct.Struct("<8sQ")
+    _SLOT = struct.Struct("<Qdd")
+    _MAGIC = b"VNRLIM01"
+    _PROBE = 8
+
+    def __init__(self, path: str, slots: int = 65536):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self._fd, self._HEADER.size, 0)
+            valid = False
+            if len(header) == self._HEADER.size:
+                magic, existing = self._HEADER.unpack(header)
+                if magic == self._MAGIC and existing > 0:
+                    slots, valid = int(existing), True
+            size = self._HEADER.size + slots * self._SLOT.size
+            if not valid:
+                os.ftruncate(self._fd, 0)
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            os.pwrite(self._fd, self._HEADER.pack(self._MAGIC, slots), 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self.slots = slots
+        self._mm = mmap.mmap(self._fd, size)
+        self._mutex = threading.Lock()
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        h = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+        return h or 1
+
+    def _offset(self, idx: int) -> int:
+        return self._HEADER.size + idx * self._SLOT.size
+
+    def take(self, key: str, refill_per_sec: float, capacity: float, now: float, blocking: bool = True) -> Optional[float]:
+        """As ``MemoryBucketStore.take``; with ``blocking=False`` returns None
+        instead of waiting when another thread or process holds the lock."""
+        if not self._mutex.acquire(blocking=blocking):
+            return None
+        try:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                return self._take_locked(key, refill_per_sec, capacity, now)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._mutex.release()
+
+    def _take_locked(self, key: str, refill_per_sec: float, capacity: float, now: float) -> float:
+        h = self._hash(key)
+        start = h % self.slots
+        mm = self._mm
+        target, empty = -1, -1
+        victim, victim_last = start, math.inf
+        tokens, last = capacity, now
+        for i in range(self._PROBE):
+            idx = (start + i) % self.slots
+            slot_h, slot_tokens, slot_last = self._SLOT.unpack_from(mm, self._offset(idx))
+            if slot_h == h:
+                target, tokens, last = idx, slot_tokens, slot_last
+                break
+            if slot_h == 0:
+                if empty < 0:
+                    empty = idx
+            elif slot_last < victim_last:
+                victim, victim_last = idx, slot_last
+        if target < 0:
+            # New key: take a free slot, else evict the idlest one in the window
+            target = empty if empty >= 0 else victim
+        tokens = min(capacity, tokens + max(0.0, now - last) * refill_per_sec)
+        if tokens >= 1.0:
+            tokens -= 1.0
+            wait = 0.0
+        else:
+            wait = (1.0 - tokens) / refill_per_sec
+        self._SLOT.pack_into(mm, self._offset(target), h, tokens, now)
+        return wait
+
+    def close(self) -> None:
+        self._mm.close()
+        os.close(self._fd)
+
+
+def make_bucket_store(shm_path: Optional[str] = None, max_keys: int = 100000) -> Any:
+    if shm_path:
+        return SharedBucketStore(shm_path, slots=max(1024, max_keys))
+    return MemoryBucketStore(max_keys=max_keys)
+
+
+def rule_for(rules: List[RateRule], method: str, path: str) -> Optional[RateRule]:
+    """The first of ``rules`` matching the request, if any."""
+    for rule in rules:
+        if rule.route is not None and rule.route.matches(method, path):
+            return rule
+    return None
+
+
+class RateLimitMiddleware:
+    """Pure ASGI token-bucket limiter.
+
+    The first matching rule decides the budget for a request; everything else
+    falls under the default ``max_per_minute`` keyed by client IP. ``user``
+    rules key by the authenticated user when the token is already known to the
+    auth cache, else by client IP: keying by an unverified token would give
+    every made-up token a fresh bucket.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        max_per_minute: int = 120,
+        burst: Optional[int] = None,
+        rules: Optional[List[RateRule]] = None,
+        shm_path: Optional[str] = None,
+        max_keys: int = 100000,
+        exempt_paths: Tuple[str, ...] = ("/health", "/health/ready"),
+        store: Any = None,
+    ):
+        self.app = app
+        self.default = RateRule(None, max_per_minute, burst, "ip")
+        self.rules = rules or []
+        self.exempt = frozenset(exempt_paths)
+        # Pass ``store`` to share buckets with limits enforced outside HTTP
+        self.store = store if store is not None else make_bucket_store(shm_path, max_keys)
+
+    def _rule_for(self, method: str, path: str) -> RateRule:
+        return rule_for(self.rules, method, path) or self.default
+
+    @staticmethod
+    def _ident(scope: Scope, by_user: bool) -> str:
+        if by_user:
+            for name, value in scope.get("headers") or ():
+                if name == b"authorization":
+                    raw = value.decode("latin-1")
+                    if raw[:7].lower() == "bearer ":
+                        user = token_cache.peek(raw[7:].strip())
+                        if user is not None:
+                            return "u:" + user.id
+                    break
+        client = scope.get("client")
+        return "ip:" + (client[0] if client else "anon")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] in self.exempt:
+            await self.app(scope, receive, send)
+            return
+        rule = self._rule_for(scope["method"], scope["path"])
+        key = rule.name + "|" + self._ident(scope, rule.scope == "user")
         now = time.time()
-        q = self.buckets[ident]
-        # Purge old
-        while q and now - q[0] > self.window:
-            q.popleft()
-        if len(q) >= self.max:
-            return JSONResponse({"detail": "rate limit exceeded"}, status_code=429)
-        q.append(now)
-        return await call_next(request)
-
-
-class BodySizeLimitMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, max_body_bytes: int = 10 * 1024 * 1024):
-        super().__init__(app)
+        wait = self.store.take(key, rule.refill_per_sec, rule.burst, now, blocking=False)
+        if wait is None:
+            # Shared store is busy: wait for its lock off the event loop
+            wait = await asyncio.to_thread(self.store.take, key, rule.refill_per_sec, rule.burst, now)
+        if wait > 0:
+            response = JSONResponse(
+                {"detail": "rate limit exceeded"},
+                status_code=429,
+                headers={"Retry-After": str(max(1, math.ceil(wait)))},
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+_SIZE_UNITS = {"": 1, "B": 1, "KB": 1024, "K": 1024, "MB": 1024 ** 2, "M": 1024 ** 2, "GB": 1024 ** 3, "G": 1024 ** 3}
+
+
+def parse_size(value: str) -> Optional[int]:
+    """`"512KB"`, `"10MB"`, `"1048576"` -> bytes."""
+    raw = value.strip().upper()
+    num = raw.rstrip("BKMG")
+    unit = raw[len(num):]
+    if unit not in _SIZE_UNITS:
+        return None
+    try:
+        return int(float(num) * _SIZE_UNITS[unit])
+    except ValueError:
+        return None
+
+
+# Yjs updates are small; uploads fall back to MAX_BODY_BYTES
+DEFAULT_BODY_RULES = "POST /blocks/*/crdt=2MB"
+
+
+def parse_body_rules(spec: str) -> List[Tuple[RouteRule, int]]:
+    rules: List[Tuple[RouteRule, int]] = []
+    for route, value in parse_route_spec(spec):
+        size = parse_size(value)
+        if size is not None:
+            rules.append((route, size))
+    return rules
+
+
+class _BodyTooLarge(HTTPException):
+    def __init__(self) -> None:
+        super().__init__(status_code=413, detail="request too large")
+
+
+class BodySizeLimitMiddleware:
+    """Pure ASGI request body cap.
+
+    Rejects on `Content-Length` up front and otherwise counts bytes as
+    `http.request` messages are received, so chunked uploads are cut off as
+    soon as they cross the limit instead of being buffered first.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        max_body_bytes: int = 10 * 1024 * 1024,
+        rules: Optional[List[Tuple[RouteRule, int]]] = None,
+    ):
+        self.app = app
         self.max = max_body_bytes
+        self.rules = rules or []
+
+    def _limit_for(self, method: str, path: str) -> int:
+        for route, limit in self.rules:
+            if route.matches(method, path):
+                return limit
+        return self.max
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        limit = self._limit_for(scope["method"], scope["path"])
+        for name, value in scope.get("headers") or ():
+            if name == b"content-length":
+                if value.isdigit() and int(value) > limit:
+                    await JSONResponse({"detail": "request too large"}, status_code=413)(scope, receive, send)
+                    return
+                break
+
+        received = 0
+        response_started = False
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise _BodyTooLarge()
+            return message
 
-    async def dispatch(self, request: Request, call_next):
-        cl = request.headers.get("content-length")
-        if cl is not None and cl.isdigit():
-            if int(cl) > self.max:
-                return JSONResponse({"detail": "request too large"}, status_code=413)
-        return await call_next(request)
+        async def tracking_send(message: Message) -> None:
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
 
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except _BodyTooLarge:
+            # Normally the app's exception middleware already answered 413
+            if response_started:
+                raise
+            await JSONResponse({"detail": "request too large"}, status_code=413)(scope, receive, send)
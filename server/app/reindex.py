@@ -0,0 +1,246 @@
+"""Online search reindex: walks notes by id in chunks, one transaction each.
+
+Each chunk is indexed through the configured search backend, replacing
+entries in place, so search keeps working while a job runs.
+Progress is committed with every chunk, and a job whose runner stops
+heartbeating is picked up again by the next process that calls
+``resume_stale``.
+"""
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from .config import env_float
+from .db import SessionLocal
+from .metrics import registry
+from .utils.indexing import rebuild_note_plaintext_from_blocks
+from .utils.search_backend import search_backend
+
+log = logging.getLogger("vnote.reindex")
+
+
+_CLAIM = text(
+    """
+    UPDATE reindex_jobs SET heartbeat_at = now()
+    WHERE id = :id AND status = 'running'
+      AND (heartbeat_at IS NULL OR heartbeat_at < now() - make_interval(secs => :stale))
+    RETURNING id
+    """
+)
+
+_STATUS = """
+    SELECT id, status, rebuild_blocks, chunk_size, processed, total, error, started_at, updated_at, finished_at,
+           EXTRACT(EPOCH FROM COALESCE(finished_at, updated_at) - started_at) AS elapsed
+    FROM reindex_jobs
+"""
+
+
+class Reindexer:
+    def __init__(self, session_factory: async_sessionmaker = SessionLocal, pause: float = 0.0, stale_after: float = 60.0):
+        self.session_factory = session_factory
+        self.pause = pause
+        self.stale_after = stale_after
+        self._tasks: Dict[UUID, asyncio.Task] = {}
+        self._watch: Optional[asyncio.Task] = None
+        self._stop = asyncio.Event()
+
+    async def create(self, rebuild_blocks: bool, chunk_size: int) -> Optional[Dict[str, Any]]:
+        """Start a job; None if one is already running."""
+        async with self.session_factory() as session:
+            res = await session.execute(
+                text(
+                    """
+                    INSERT INTO reindex_jobs (rebuild_blocks, chunk_size, total)
+                    SELECT :rb, :cs, count(*) FROM notes
+                    ON CONFLICT DO NOTHING
+                    RETURNING id
+                    """
+                ),
+                {"rb": rebuild_blocks, "cs": chunk_size},
+            )
+            job_id = res.scalar()
+            await session.commit()
+        if job_id is None:
+            return None
+        await self.resume(job_id)
+        return await self.status(job_id)
+
+    async def resume(self, job_id: UUID) -> bool:
+        """Start running ``job_id`` here unless a live runner already has it."""
+        if job_id in self._tasks:
+            return False
+        async with self.session_factory() as session:
+            res = await session.execute(_CLAIM, {"id": job_id, "stale": self.stale_after})
+            claimed = res.fetchone() is not None
+            await session.commit()
+        if claimed:
+            self._tasks[job_id] = asyncio.create_task(self._run(job_id))
+        return claimed
+
+    async def resume_stale(self) -> None:
+        async with self.session_factory() as session:
+            res = await session.execute(text("SELECT id FROM reindex_jobs WHERE status = 'running' ORDER BY started_at"))
+            ids = [r.id for r in res]
+        for job_id in ids:
+            if await self.resume(job_id):
+                log.info("resuming reindex job %s", job_id)
+
+    async def _chunk(self, job_id: UUID) -> bool:
+        """Index one chunk; False once the job is finished or no longer running."""
+        async with self.session_factory() as session:
+            res = await session.execute(
+                text("SELECT status, last_note_id, rebuild_blocks, chunk_size FROM reindex_jobs WHERE id = :id FOR UPDATE"),
+                {"id": job_id},
+            )
+            job = res.fetchone()
+            if job is None or job.status != "running":
+                return False
+            res = await session.execute(
+                text("SELECT id, user_id, deleted_at IS NOT NULL AS deleted FROM notes WHERE id > :last ORDER BY id LIMIT :n"),
+                {"last": job.last_note_id, "n": job.chunk_size},
+            )
+            rows = res.fetchall()
+            if not rows:
+                await session.execute(
+                    text("UPDATE reindex_jobs SET status = 'done', finished_at = now(), updated_at = now() WHERE id = :id"),
+                    {"id": job_id},
+                )
+                await session.commit()
+                return False
+            live = [r.id for r in rows if not r.deleted]
+            if job.rebuild_blocks and live:
+                res = await session.execute(
+                    text(
+                        """
+                        SELECT DISTINCT note_id FROM blocks b
+                        WHERE note_id = ANY(:ids)
+                          AND (ydoc_state IS NOT NULL OR EXISTS (SELECT 1 FROM block_versions v WHERE v.block_id = b.id))
+                        """
+                    ),
+                    {"ids": live},
+                )
+                for nid in [r.note_id for r in res]:
+                    await self._rebuild_blocks(nid)
+            # Through the configured backend, so a bm25 index is rebuilt too
+            await search_backend.index_notes(session, [r.id for r in rows])
+            await session.execute(
+                text(
+                    """
+                    UPDATE reindex_jobs SET last_note_id = :last, processed = processed + :n,
+                      total = GREATEST(total, processed + :n), heartbeat_at = now(), updated_at = now()
+                    WHERE id = :id
+                    """
+                ),
+                {"id": job_id, "last": rows[-1].id, "n": len(rows)},
+            )
+            await session.commit()
+        registry.inc("vnote_reindex_notes_total", float(len(rows)))
+        return True
+
+    async def _rebuild_blocks(self, note_id: UUID) -> None:
+        # Its own short transaction per note: a decode never runs while block
+        # rows are locked, so pushes to the note aren't held up by it
+        async with self.session_factory() as session:
+            body = await rebuild_note_plaintext_from_blocks(session, note_id, force=True)
+            await session.execute(text("UPDATE notes SET plain_text = :pt WHERE id = :id"), {"pt": body, "id": note_id})
+            await session.commit()
+
+    async def _run(self, job_id: UUID) -> None:
+        try:
+            while await self._chunk(job_id):
+                if self.pause > 0:
+                    await asyncio.sleep(self.pause)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("reindex job %s failed: %s", job_id, e)
+            async with self.session_factory() as session:
+                await session.execute(
+                    text("UPDATE reindex_jobs SET status = 'failed', error = :err, updated_at = now() WHERE id = :id"),
+                    {"id": job_id, "err": f"{e.__class__.__name__}: {e}"[:1000]},
+                )
+                await session.commit()
+        finally:
+            self._tasks.pop(job_id, None)
+
+    async def cancel(self, job_id: UUID) -> Optional[Dict[str, Any]]:
+        async with self.session_factory() as session:
+            await session.execute(
+                text("UPDATE reindex_jobs SET status = 'cancelled', updated_at = now() WHERE id = :id AND status = 'running'"),
+                {"id": job_id},
+            )
+            await session.commit()
+        return await self.status(job_id)
+
+    async def status(self, job_id: UUID) -> Optional[Dict[str, Any]]:
+        async with self.session_factory() as session:
+            res = await session.execute(text(f"{_STATUS} WHERE id = :id"), {"id": job_id})
+            row = res.fetchone()
+        return self._describe(row) if row is not None else None
+
+    async def recent(self, limit: int = 20) -> List[Dict[str, Any]]:
+        async with self.session_factory() as session:
+            res = await session.execute(text(f"{_STATUS} ORDER BY started_at DESC LIMIT :n"), {"n": limit})
+            return [self._describe(r) for r in res]
+
+    def _describe(self, row: Any) -> Dict[str, Any]:
+        elapsed = float(row.elapsed or 0)
+        rate = row.processed / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, row.total - row.processed)
+        return {
+            "id": str(row.id),
+            "status": row.status,
+            "rebuildBlocks": row.rebuild_blocks,
+            "chunkSize": row.chunk_size,
+            "processed": row.processed,
+            "total": row.total,
+            "notesPerSecond": round(rate, 1),
+            "etaSeconds": round(remaining / rate, 1) if rate > 0 and row.status == "running" else None,
+            "error": row.error,
+            "startedAt": row.started_at.isoformat(),
+            "updatedAt": row.updated_at.isoformat(),
+            "finishedAt": row.finished_at.isoformat() if row.finished_at else None,
+            "runningHere": row.id in self._tasks,
+        }
+
+    async def run_forever(self) -> None:
+        while not self._stop.is_set():
+            try:
+                await self.resume_stale()
+            except Exception as e:
+                log.warning("reindex watcher error: %s", e)
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.stale_after)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self) -> None:
+        if self._watch is None:
+            self._stop = asyncio.Event()
+            self._watch = asyncio.create_task(self.run_forever())
+
+    async def stop(self) -> None:
+        if self._watch is not None:
+            self._stop.set()
+            await self._watch
+            self._watch = None
+        # Leave jobs 'running'; the heartbeat goes stale and another process resumes
+        for task in list(self._tasks.values()):
+            task.cancel()
+        for task in list(self._tasks.values()):
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+reindexer = Reindexer(
+    pause=env_float("REINDEX_CHUNK_PAUSE_MS", 0) / 1000.0,
+    stale_after=env_float("REINDEX_STALE_SECONDS", 60),
+)
+
+registry.describe("vnote_reindex_notes_total", "Notes processed by admin reindex jobs")
@@ -1,24 +1,90 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy import text
-from sqlalchemy.ext.asyncio import AsyncSession
-from ..db import get_session
-
-router = APIRouter()
-
-
-@router.post("/reindex-search")
-async def reindex_search(session: AsyncSession = Depends(get_session)):
-    # Recompute note_search from current notes (title, excerpt, plain_text)
-    await session.execute(text("DELETE FROM note_search"))
-    await session.execute(
-        text(
-            """
-            INSERT INTO note_search (note_id, content_tsv)
-            SELECT n.id, to_tsvector('english', coalesce(n.title,'') || ' ' || coalesce(n.excerpt,'') || ' ' || coalesce(n.plain_text,''))
-            FROM notes n WHERE n.deleted_at IS NULL
-            """
-        )
-    )
-    await session.commit()
+from fastapi import APIRouter, Body, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
+from ..auth import require_admin, token_cache
+from ..metrics import registry
+from ..reindex import reindexer
+from ..schemas import ReindexRequest
+from ..slowlog import slow_query_log
+from .. import index_queue
+from ..utils.ids import require_uuid
+from ..utils.search_backend import search_backend
+from ..utils.search_cache import search_cache
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.post("/reindex-search", status_code=202)
+async def reindex_search(body: ReindexRequest = Body(default_factory=ReindexRequest)):
+    # Chunked upsert in the background; search keeps serving the old vectors meanwhile
+    job = await reindexer.create(body.rebuildBlocks, body.chunkSize)
+    if job is None:
+        raise HTTPException(status_code=409, detail="A reindex job is already running")
+    return job
+
+
+@router.get("/reindex-search")
+async def reindex_jobs(limit: int = 20):
+    return {"jobs": await reindexer.recent(max(1, min(limit, 100)))}
+
+
+@router.get("/reindex-search/{job_id}")
+async def reindex_job(job_id: str):
+    job = await reindexer.status(require_uuid(job_id, "Job not found"))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.delete("/reindex-search/{job_id}")
+async def cancel_reindex_job(job_id: str):
+    job = await reindexer.cancel(require_uuid(job_id, "Job not found"))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.get("/auth-cache")
+async def auth_cache_stats():
+    return token_cache.stats()
+
+
+@router.get("/search-cache")
+async def search_cache_stats():
+    return search_cache.stats()
+
+
+@router.get("/search-backend")
+async def search_backend_stats():
+    return search_backend.stats()
+
+
+@router.get("/metrics")
+async def metrics(format: str = "prometheus"):
+    if format == "json":
+        return {
+            "latency": registry.summary("vnote_http_request_duration_seconds"),
+            "dbTime": registry.summary("vnote_http_request_db_seconds"),
+        }
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@router.get("/slow-queries")
+async def slow_queries(limit: int = 50):
+    return {
+        "thresholdMs": slow_query_log.threshold * 1000.0,
+        "total": slow_query_log.total,
+        "entries": slow_query_log.snapshot(max(0, min(limit, 1000))),
+    }
+
+
+@router.delete("/slow-queries")
+async def clear_slow_queries():
+    slow_query_log.clear()
     return {"ok": True}
 
+
+@router.get("/index-queue")
+async def index_queue_stats():
+    stats = await index_queue.index_worker.sample()
+    stats["mode"] = index_queue.MODE
+    return stats
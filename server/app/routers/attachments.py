@@ -1,4 +1,5 @@
 import os
+from uuid import UUID
 from fastapi import APIRouter, UploadFile, File, Depends, HTTPException
 from fastapi.responses import FileResponse
 from sqlalchemy import text
@@ -21,14 +22,14 @@ async def upload(
     q = text(
         """
         INSERT INTO attachments (user_id, name, mime, bytes, checksum, storage_key, created_by)
-        VALUES (:uid::uuid, :name, :mime, :bytes, :checksum, :storage_key, :uid::uuid)
+        VALUES (:uid, :name, :mime, :bytes, :checksum, :storage_key, :uid)
         RETURNING id::text
         """
     )
     res = await session.execute(
         q,
         {
-            "uid": user.id,
+            "uid": user.uid,
             "name": file.filename,
             "mime": file.content_type,
             "bytes": size,
@@ -43,14 +44,14 @@ async def upload(
 
 @router.get("/{attachment_id}")
 async def get_attachment(
-    attachment_id: str,
+    attachment_id: UUID,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
     q = text(
-        "SELECT storage_key, name, mime FROM attachments WHERE id::text=:id AND user_id=:uid::uuid"
+        "SELECT storage_key, name, mime FROM attachments WHERE id = :id AND user_id = :uid"
     )
-    res = await session.execute(q, {"id": attachment_id, "uid": user.id})
+    res = await session.execute(q, {"id": attachment_id, "uid": user.uid})
     row = res.fetchone()
     if row is None:
         raise HTTPException(status_code=404, detail="Attachment not found")
@@ -63,13 +64,13 @@ async def get_attachment(
 
 @router.get("/{attachment_id}/download")
 async def download_attachment(
-    attachment_id: str,
+    attachment_id: UUID,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
     res = await session.execute(
-        text("SELECT storage_key, name, mime FROM attachments WHERE id::text=:id AND user_id=:uid::uuid"),
-        {"id": attachment_id, "uid": user.id},
+        text("SELECT storage_key, name, mime FROM attachments WHERE id = :id AND user_id = :uid"),
+        {"id": attachment_id, "uid": user.uid},
     )
     row = res.fetchone()
     if row is None:
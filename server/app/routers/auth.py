@@ -1,9 +1,21 @@
+from typing import Optional
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.security import HTTPAuthorizationCredentials
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from ..schemas import AuthCredentials, AuthToken
 from ..db import get_session
-from ..auth import hash_password, verify_password, get_current_user, create_session_for_user, CurrentUser
+from ..utils.ids import require_uuid
+from ..auth import (
+    hash_password_async,
+    verify_password_async,
+    get_current_user,
+    create_session_for_user,
+    revoke_session,
+    token_cache,
+    bearer,
+    CurrentUser,
+)
 
 router = APIRouter()
 
@@ -18,7 +30,7 @@ async def register(creds: AuthCredentials, session: AsyncSession = Depends(get_s
     if res.fetchone() is not None:
         raise HTTPException(status_code=409, detail="email already registered")
     # Create user
-    pw = hash_password(creds.password)
+    pw = await hash_password_async(creds.password)
     ins_q = text(
         "INSERT INTO users (email, password_hash) VALUES (:email, :hash) RETURNING id::text"
     )
@@ -34,8 +46,17 @@ async def login(creds: AuthCredentials, session: AsyncSession = Depends(get_sess
     q = text("SELECT id::text, password_hash FROM users WHERE email=:email LIMIT 1")
     res = await session.execute(q, {"email": creds.email})
     row = res.fetchone()
-    if row is None or not verify_password(row.password_hash, creds.password):
+    if row is None:
         raise HTTPException(status_code=401, detail="invalid credentials")
+    ok, new_hash = await verify_password_async(row.password_hash, creds.password)
+    if not ok:
+        raise HTTPException(status_code=401, detail="invalid credentials")
+    if new_hash is not None:
+        # Argon2 parameters changed since this hash was made; upgrade it in place
+        await session.execute(
+            text("UPDATE users SET password_hash=:hash, updated_at=now() WHERE id = :uid"),
+            {"hash": new_hash, "uid": require_uuid(row.id)},
+        )
     token = await create_session_for_user(row.id, session)
     return AuthToken(accessToken=token)
 
@@ -44,17 +65,23 @@ async def login(creds: AuthCredentials, session: AsyncSession = Depends(get_sess
 async def logout(
     user: CurrentUser = Depends(get_current_user),
     session: AsyncSession = Depends(get_session),
-    creds = Depends(lambda: None),
 ):
-    # Token revocation: delete caller's session by token
-    # We can't easily access the token here without re-parsing; simplify by deleting all sessions for user
-    q = text("DELETE FROM sessions WHERE user_id=:uid::uuid")
-    await session.execute(q, {"uid": user.id})
+    # Revoke every session of the user and drop them from the token cache
+    q = text("DELETE FROM sessions WHERE user_id = :uid")
+    await session.execute(q, {"uid": user.uid})
     await session.commit()
+    token_cache.invalidate_user(user.id)
     return {"ok": True}
 
 
 @router.post("/refresh", response_model=AuthToken)
-async def refresh(user: CurrentUser = Depends(get_current_user), session: AsyncSession = Depends(get_session)):
+async def refresh(
+    user: CurrentUser = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+    creds: Optional[HTTPAuthorizationCredentials] = Depends(bearer),
+):
     token = await create_session_for_user(user.id, session)
+    # Rotate: the presented token stops working once a new one is issued
+    if creds is not None and creds.credentials:
+        await revoke_session(creds.credentials, session)
     return AuthToken(accessToken=token)
@@ -1,16 +1,21 @@
+from uuid import UUID
 from fastapi import APIRouter, Depends, HTTPException, Body
+from fastapi.responses import Response
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from ..db import get_session
 from ..auth import get_current_user, CurrentUser
-from ..utils.indexing import rebuild_and_update_search
+from ..index_queue import index_worker
+from ..utils.blockstore import diff_note, push_update
+from ..utils.collab import collab_hub
+from ..utils.framing import decode_frames, encode_frames
 
 router = APIRouter()
 
 
 @router.post("/notes/{note_id}/blocks")
 async def create_block(
-    note_id: str,
+    note_id: UUID,
     type: str,
     attrs: dict | None = None,
     after: float | None = None,
@@ -18,15 +23,15 @@ async def create_block(
     user: CurrentUser = Depends(get_current_user),
 ):
     # Ensure note ownership
-    own = await session.execute(text("SELECT 1 FROM notes WHERE id::text=:id AND user_id=:uid::uuid AND deleted_at IS NULL"), {"id": note_id, "uid": user.id})
+    own = await session.execute(text("SELECT 1 FROM notes WHERE id = :id AND user_id = :uid AND deleted_at IS NULL"), {"id": note_id, "uid": user.uid})
     if own.fetchone() is None:
         raise HTTPException(status_code=404, detail="Note not found")
     if after is None:
-        res = await session.execute(text("SELECT COALESCE(MAX(order_idx),0) + 1 FROM blocks WHERE note_id::text=:id"), {"id": note_id})
+        res = await session.execute(text("SELECT COALESCE(MAX(order_idx),0) + 1 FROM blocks WHERE note_id = :id"), {"id": note_id})
         order_idx = float(res.scalar() or 1)
     else:
         order_idx = after + 1.0
-    ins = await session.execute(text("INSERT INTO blocks (note_id, type, attrs, order_idx) VALUES (:nid::uuid, :type, :attrs, :ord) RETURNING id::text"), {"nid": note_id, "type": type, "attrs": attrs or {}, "ord": order_idx})
+    ins = await session.execute(text("INSERT INTO blocks (note_id, type, attrs, order_idx) VALUES (:nid, :type, :attrs, :ord) RETURNING id::text"), {"nid": note_id, "type": type, "attrs": attrs or {}, "ord": order_idx})
     row = ins.fetchone()
     await session.commit()
     return {"id": row[0], "type": type, "attrs": attrs or {}, "order": order_idx}
@@ -34,7 +39,7 @@ async def create_block(
 
 @router.patch("/blocks/{block_id}")
 async def update_block(
-    block_id: str,
+    block_id: UUID,
     attrs: dict | None = None,
     order: float | None = None,
     session: AsyncSession = Depends(get_session),
@@ -46,13 +51,13 @@ async def update_block(
           attrs = COALESCE(:attrs, attrs),
           order_idx = COALESCE(:ord, order_idx),
           updated_at = now()
-        WHERE b.id::text=:id AND EXISTS (
-          SELECT 1 FROM notes n WHERE n.id=b.note_id AND n.user_id=:uid::uuid
+        WHERE b.id = :id AND EXISTS (
+          SELECT 1 FROM notes n WHERE n.id=b.note_id AND n.user_id = :uid
         )
         RETURNING id::text
         """
     )
-    res = await session.execute(q, {"attrs": attrs, "ord": order, "id": block_id, "uid": user.id})
+    res = await session.execute(q, {"attrs": attrs, "ord": order, "id": block_id, "uid": user.uid})
     if res.fetchone() is None:
         raise HTTPException(status_code=404, detail="Block not found")
     await session.commit()
@@ -61,23 +66,31 @@ async def update_block(
 
 @router.post("/blocks/{block_id}/crdt")
 async def push_block_update(
-    block_id: str,
+    block_id: UUID,
     payload: bytes = Body(..., media_type="application/octet-stream"),
+    waitForIndex: bool = False,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
-    # Ensure ownership
-    own = await session.execute(text("SELECT 1 FROM blocks b JOIN notes n ON n.id=b.note_id WHERE b.id::text=:id AND n.user_id=:uid::uuid"), {"id": block_id, "uid": user.id})
-    if own.fetchone() is None:
-        raise HTTPException(status_code=404, detail="Block not found")
-    # Next version
-    vres = await session.execute(text("SELECT COALESCE(MAX(version),0)+1 FROM block_versions WHERE block_id::text=:id"), {"id": block_id})
-    version = int(vres.scalar() or 1)
-    await session.execute(text("INSERT INTO block_versions (block_id, version, ydoc_snapshot) VALUES (:bid::uuid, :ver, :snap)"), {"bid": block_id, "ver": version, "snap": payload})
-    # Rebuild note plaintext and update search index
-    nid_res = await session.execute(text("SELECT note_id::text FROM blocks WHERE id::text=:id"), {"id": block_id})
-    nid = nid_res.scalar()
-    if nid:
-        await rebuild_and_update_search(session, nid)
+    out = await push_update(session, block_id, user.uid, payload)
     await session.commit()
-    return {"blockId": block_id, "version": version}
+    await collab_hub.publish_update(out["noteId"], block_id, payload, out["version"])
+    if waitForIndex:
+        await index_worker.wait_for([out["noteId"]])
+    return {"blockId": block_id, "version": out["version"]}
+
+
+@router.post("/notes/{note_id}/blocks/sync")
+async def sync_blocks(
+    note_id: UUID,
+    payload: bytes = Body(b"", media_type="application/octet-stream"),
+    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+):
+    # Body: frames of (block id, 0, client state vector); empty = fetch everything
+    try:
+        vectors = {bid: sv for bid, _, sv in decode_frames(payload)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid frames: {e}")
+    frames = await diff_note(session, note_id, user.uid, vectors)
+    return Response(encode_frames(frames), media_type="application/octet-stream", headers={"X-Block-Count": str(len(frames))})
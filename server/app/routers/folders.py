@@ -1,10 +1,12 @@
 from typing import Dict, Any, List
+from uuid import UUID
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from ..schemas import Folder, FolderCreate, FolderUpdate
 from ..db import get_session
 from ..auth import get_current_user, CurrentUser
+from ..utils.search_cache import mark_changed
 
 router = APIRouter()
 
@@ -16,9 +18,9 @@ async def get_tree(
 ):
     # Fetch all folders for the user, then build a tree
     q = text(
-        "SELECT id, name, parent_id FROM folders WHERE user_id=:uid::uuid ORDER BY name"
+        "SELECT id, name, parent_id FROM folders WHERE user_id = :uid ORDER BY name"
     )
-    res = await session.execute(q, {"uid": user.id})
+    res = await session.execute(q, {"uid": user.uid})
     rows = res.fetchall()
     nodes: Dict[str, Dict[str, Any]] = {}
     children: Dict[str, List[Dict[str, Any]]] = {}
@@ -50,21 +52,22 @@ async def create_folder(
     q = text(
         """
         INSERT INTO folders (user_id, name, parent_id)
-        VALUES (:uid::uuid, :name, :parent)
+        VALUES (:uid, :name, :parent)
         RETURNING id, name, parent_id
         """
     )
     res = await session.execute(
-        q, {"uid": user.id, "name": payload.name, "parent": str(payload.parentId) if payload.parentId else None}
+        q, {"uid": user.uid, "name": payload.name, "parent": payload.parentId}
     )
     row = res.fetchone()
+    mark_changed(session, [user.id])
     await session.commit()
     return Folder(id=row.id, name=row.name, parentId=row.parent_id)
 
 
 @router.patch("/{folder_id}", response_model=Folder)
 async def update_folder(
-    folder_id: str,
+    folder_id: UUID,
     payload: FolderUpdate,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
@@ -75,7 +78,7 @@ async def update_folder(
           name = COALESCE(:name, name),
           parent_id = COALESCE(:parent, parent_id),
           updated_at = now()
-        WHERE id::text = :id AND user_id = :uid::uuid
+        WHERE id = :id AND user_id = :uid
         RETURNING id, name, parent_id
         """
     )
@@ -83,12 +86,13 @@ async def update_folder(
         q,
         {
             "name": payload.name,
-            "parent": str(payload.parentId) if payload.parentId else None,
+            "parent": payload.parentId,
             "id": folder_id,
-            "uid": user.id,
+            "uid": user.uid,
         },
     )
     row = res.fetchone()
+    mark_changed(session, [user.id])
     await session.commit()
     if row is None:
         raise HTTPException(status_code=404, detail="Folder not found")
@@ -97,21 +101,22 @@ async def update_folder(
 
 @router.delete("/{folder_id}")
 async def delete_folder(
-    folder_id: str,
+    folder_id: UUID,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
     # Soft-delete notes in the folder could be added later. For now, reject delete if children exist.
     c = await session.execute(
-        text("SELECT count(*) FROM folders WHERE parent_id::text=:id AND user_id=:uid::uuid"),
-        {"id": folder_id, "uid": user.id},
+        text("SELECT count(*) FROM folders WHERE parent_id = :id AND user_id = :uid"),
+        {"id": folder_id, "uid": user.uid},
     )
     if (c.scalar() or 0) > 0:
         raise HTTPException(status_code=400, detail="Folder not empty")
     res = await session.execute(
-        text("DELETE FROM folders WHERE id::text=:id AND user_id=:uid::uuid"),
-        {"id": folder_id, "uid": user.id},
+        text("DELETE FROM folders WHERE id = :id AND user_id = :uid"),
+        {"id": folder_id, "uid": user.uid},
     )
+    mark_changed(session, [user.id])
     await session.commit()
     if res.rowcount == 0:
         raise HTTPException(status_code=404, detail="Folder not found")
@@ -1,53 +1,97 @@
-from fastapi import APIRouter, Depends
+from typing import Dict, List, Tuple
+from uuid import UUID
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from ..db import get_session
 from ..auth import get_current_user, CurrentUser
+from ..utils.graph_index import graph_index
+from ..utils.graph_layout import graph_layouts
 
 router = APIRouter()
 
 
+_IN_FOLDER = text("SELECT id FROM notes WHERE user_id = :uid AND folder_id = :fid AND deleted_at IS NULL")
+_TAGGED = text(
+    """
+    SELECT nt.note_id AS id FROM note_tags nt JOIN tags t ON t.id = nt.tag_id
+    WHERE t.user_id = :uid AND lower(t.name) = lower(:tag)
+    """
+)
+
+
 @router.get("")
 async def graph(
     scope: str | None = None,
-    limit: int = 200,
-    folderId: str | None = None,
+    limit: int = Query(200, ge=1, le=5000),
+    folderId: UUID | None = None,
     tag: str | None = None,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
-    filters = ["s.user_id = :uid::uuid", "d.user_id = :uid::uuid", "s.deleted_at IS NULL", "d.deleted_at IS NULL"]
-    params = {"uid": user.id, "lim": limit}
-    join_extra = ""
+    g = await graph_index.get(session, user.id)
+    # Same filters as ever: an edge touches the folder, and both ends carry the tag
+    folder = tagged = None
     if folderId:
-        filters.append("(s.folder_id::text = :fid OR d.folder_id::text = :fid)")
-        params["fid"] = folderId
+        res = await session.execute(_IN_FOLDER, {"uid": user.uid, "fid": folderId})
+        folder = {g.index[r.id] for r in res if r.id in g.index}
     if tag:
-        join_extra = "JOIN note_tags nts ON nts.note_id = s.id JOIN tags ts ON ts.id = nts.tag_id AND lower(ts.name)=lower(:tag) JOIN note_tags ntd ON ntd.note_id = d.id JOIN tags td ON td.id = ntd.tag_id AND lower(td.name)=lower(:tag)"
-        params["tag"] = tag
-    q = text(
-        f"""
-        SELECT l.src_note_id::text AS src, l.dst_note_id::text AS dst
-        FROM links l
-        JOIN notes s ON s.id = l.src_note_id
-        JOIN notes d ON d.id = l.dst_note_id
-        {join_extra}
-        WHERE {' AND '.join(filters)}
-        LIMIT :lim
-        """
+        res = await session.execute(_TAGGED, {"uid": user.uid, "tag": tag})
+        tagged = {g.index[r.id] for r in res if r.id in g.index}
+    edges: List[Tuple[int, int]] = []
+    for s in (range(len(g.ids)) if tagged is None else sorted(tagged)):
+        if not g.alive[s]:
+            continue
+        for t in g.out(s):
+            if not g.alive[t] or (tagged is not None and t not in tagged):
+                continue
+            if folder is not None and s not in folder and t not in folder:
+                continue
+            edges.append((s, t))
+    degree: Dict[int, int] = {}
+    for s, t in edges:
+        degree[s] = degree.get(s, 0) + 1
+        degree[t] = degree.get(t, 0) + 1
+    # The `limit` best-connected notes, rather than whichever edges came first
+    keep = sorted(sorted(degree, key=lambda i: -degree[i])[:limit])
+    local = {i: k for k, i in enumerate(keep)}
+    edges = [(s, t) for s, t in edges if s in local and t in local]
+    ids = [g.ids[i] for i in keep]
+    positions, status = graph_layouts.positions(
+        (user.id, folderId, (tag or "").lower(), limit), ids, [local[s] for s, _ in edges], [local[t] for _, t in edges]
     )
-    res = await session.execute(q, params)
-    edges = [{"source": r.src, "target": r.dst} for r in res]
-    ids = set()
-    for e in edges:
-        ids.add(e["source"])
-        ids.add(e["target"])
-    if not ids:
-        return {"nodes": [], "edges": []}
-    nodes_q = text(
-        "SELECT id::text AS id, title FROM notes WHERE id = ANY(:ids)"
-    )
-    # SQLAlchemy needs array binding
-    resn = await session.execute(nodes_q, {"ids": list(ids)})
-    nodes = [{"id": r.id, "label": r.title} for r in resn]
-    return {"nodes": nodes, "edges": edges}
+    nodes = []
+    for i, nid in zip(keep, ids):
+        x, y = positions.get(nid, (None, None))
+        nodes.append({"id": str(nid), "label": g.titles[i], "x": x, "y": y})
+    return {
+        "nodes": nodes,
+        "edges": [{"source": str(g.ids[s]), "target": str(g.ids[t])} for s, t in edges],
+        "layout": status,
+    }
+
+
+@router.get("/neighborhood")
+async def neighborhood(
+    noteId: UUID,
+    depth: int = Query(1, ge=1, le=4),
+    maxNodes: int = Query(200, ge=1, le=5000),
+    maxDegree: int = Query(50, ge=1),
+    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+):
+    g = await graph_index.get(session, user.id)
+    root = g.index.get(noteId)
+    if root is None or not g.alive[root]:
+        raise HTTPException(status_code=404, detail="Note not found")
+    hops, edges, collapsed, truncated = g.neighborhood(root, depth, maxNodes, maxDegree)
+    hubs = set(collapsed)
+    nodes = [
+        {"id": str(g.ids[i]), "label": g.titles[i], "depth": d, "degree": g.degree(i), "collapsed": i in hubs}
+        for i, d in hops.items()
+    ]
+    return {
+        "nodes": nodes,
+        "edges": [{"source": str(g.ids[s]), "target": str(g.ids[t])} for s, t in edges],
+        "truncated": truncated,
+    }
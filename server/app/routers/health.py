@@ -1,4 +1,8 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..db import get_session, pool_stats
 
 router = APIRouter()
 
@@ -7,3 +11,11 @@ router = APIRouter()
 def health():
     return {"status": "ok"}
 
+
+@router.get("/health/ready")
+async def ready(session: AsyncSession = Depends(get_session)):
+    try:
+        await session.execute(text("SELECT 1"))
+    except Exception as e:
+        return JSONResponse({"status": "unavailable", "error": e.__class__.__name__, "pool": pool_stats()}, status_code=503)
+    return {"status": "ok", "pool": pool_stats()}
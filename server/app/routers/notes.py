@@ -1,80 +1,161 @@
+import hashlib
 from datetime import datetime
-from uuid import uuid4
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
+from uuid import UUID, uuid4
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import JSONResponse, Response
+from typing import Any, Dict, List
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
-from ..schemas import Note, NoteCreate, Block
-from ..db import get_session
+from ..schemas import Note, NoteBatch, NoteCreate, Block
+from ..config import env_int
+from ..db import get_session, register_warmup
 from ..auth import get_current_user, CurrentUser
-from ..utils.indexing import update_note_search
-from ..utils.links import rebuild_links_for_note
+from ..utils.links import rebuild_links_for_note, rebuild_links_for_notes
+from ..index_queue import enqueue_index, index_worker
+from ..utils.ids import optional_uuid, require_uuid
+from ..utils.cursors import decode_cursor, encode_cursor
+from ..utils.graph_index import note_removed, note_upserted
+from ..utils.search_cache import mark_changed
+from ..utils.title_cache import recent_titles
 
 router = APIRouter()
 
+BATCH_MAX = env_int("NOTES_BATCH_MAX", 500)
+
+_GET_NOTE = text(
+    """
+    SELECT n.id, n.title, n.excerpt, n.folder_id, n.created_at, n.updated_at, n.plain_text
+    FROM notes n
+    WHERE n.id = :id AND n.user_id = :uid
+    """
+)
+register_warmup(_GET_NOTE, {"id": UUID(int=0), "uid": UUID(int=0)})
+_LIST_VERSION = text(
+    "SELECT (SELECT max(updated_at) FROM notes WHERE user_id = :uid), tags_changed_at FROM users WHERE id = :uid"
+)
+
+
+def _iso(dt: datetime | None) -> str | None:
+    return dt.isoformat() if dt is not None else None
+
 
 @router.get("/", response_model=List[Note])
 async def list_notes(
+    request: Request,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: str | None = None,
+    folderId: UUID | None = None,
+    tag: str | None = None,
+    pinned: bool | None = None,
+    archived: bool | None = None,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
-    # Demo user scope
+    # Cheap change detector: every note write (including soft delete) bumps
+    # updated_at, and max() is the first entry of idx_notes_updated. Tag
+    # renames and deletes change ?tag= listings, so their stamp counts too.
+    ver = await session.execute(_LIST_VERSION, {"uid": user.uid})
+    latest, tags_changed = ver.fetchone() or (None, None)
+    tag_key = hashlib.sha1(
+        f"{user.id}|{_iso(latest)}|{_iso(tags_changed)}|{limit}|{cursor}|{folderId}|{(tag or '').lower()}|{pinned}|{archived}".encode("utf-8")
+    ).hexdigest()[:20]
+    etag = f'W/"{tag_key}"'
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    where = ["n.user_id = :uid", "n.deleted_at IS NULL"]
+    params: dict = {"uid": user.uid, "lim": limit + 1}
+    if cursor:
+        ts_raw, id_raw = decode_cursor(cursor, 2)
+        try:
+            params["cts"] = datetime.fromisoformat(ts_raw)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        params["cid"] = require_uuid(id_raw, "Invalid cursor", 400)
+        where.append("(n.updated_at, n.id) < (:cts, :cid)")
+    if folderId:
+        where.append("n.folder_id = :fid")
+        params["fid"] = folderId
+    if pinned is not None:
+        where.append("n.pinned = :pinned")
+        params["pinned"] = pinned
+    if archived is not None:
+        where.append("n.archived = :archived")
+        params["archived"] = archived
+    if tag:
+        where.append(
+            "EXISTS (SELECT 1 FROM note_tags nt JOIN tags t ON t.id = nt.tag_id"
+            " WHERE nt.note_id = n.id AND t.user_id = :uid AND lower(t.name) = lower(:tag))"
+        )
+        params["tag"] = tag
     q = text(
-        """
+        f"""
         SELECT n.id, n.title, n.excerpt, n.folder_id, n.created_at, n.updated_at
         FROM notes n
-        WHERE n.user_id = :uid::uuid AND n.deleted_at IS NULL
-        ORDER BY n.updated_at DESC
-        LIMIT 50
+        WHERE {' AND '.join(where)}
+        ORDER BY n.updated_at DESC, n.id DESC
+        LIMIT :lim
         """
     )
-    res = await session.execute(q, {"uid": user.id})
+    res = await session.execute(q, params)
     rows = res.fetchall()
-    notes: List[Note] = []
-    for r in rows:
-        notes.append(
-            Note(
-                id=r.id,
-                title=r.title,
-                excerpt=r.excerpt,
-                folderId=r.folder_id,
-                createdAt=r.created_at,
-                updatedAt=r.updated_at,
-                blocks=[],
-            )
-        )
-    return notes
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        headers["X-Next-Cursor"] = encode_cursor(_iso(last.updated_at), str(last.id))
+    # Plain dicts in the Note shape; skipping per-row model validation
+    notes = [
+        {
+            "id": str(r.id),
+            "title": r.title,
+            "excerpt": r.excerpt,
+            "folderId": str(r.folder_id) if r.folder_id else None,
+            "tags": [],
+            "createdAt": _iso(r.created_at),
+            "updatedAt": _iso(r.updated_at),
+            "blocks": [],
+            "body": None,
+        }
+        for r in rows
+    ]
+    return JSONResponse(notes, headers=headers)
 
 
 @router.post("/", response_model=Note)
 async def create_note(
     payload: NoteCreate,
+    waitForIndex: bool = False,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
     q = text(
         """
-        INSERT INTO notes (user_id, title, folder_id, excerpt)
-        VALUES (:uid::uuid, :title, :folder_id, :excerpt)
+        INSERT INTO notes (user_id, title, folder_id, excerpt, plain_text)
+        VALUES (:uid, :title, :folder_id, :excerpt, :body)
         RETURNING id, title, excerpt, folder_id, created_at, updated_at
         """
     )
     res = await session.execute(
         q,
         {
-            "uid": user.id,
+            "uid": user.uid,
             "title": payload.title,
-            "folder_id": str(payload.folderId) if payload.folderId else None,
+            "folder_id": payload.folderId,
             "excerpt": payload.excerpt or (payload.body[:200] if payload.body else None),
+            "body": payload.body or "",
         },
     )
     row = res.fetchone()
     if row is None:
         raise HTTPException(status_code=500, detail="Demo user not found; run seed")
-    # Update search and links
-    await update_note_search(session, str(row.id), row.title, row.excerpt, payload.body)
-    await rebuild_links_for_note(session, user.id, str(row.id), payload.body)
+    await enqueue_index(session, [row.id])
+    note_upserted(session, user.id, row.id, row.title)
+    await rebuild_links_for_note(session, user.id, row.id, payload.body)
+    mark_changed(session, [user.id])
     await session.commit()
+    if waitForIndex:
+        await index_worker.wait_for([row.id])
     return Note(
         id=row.id,
         title=row.title,
@@ -87,23 +168,142 @@ async def create_note(
     )
 
 
+@router.post("/batch")
+async def batch_notes(
+    payload: NoteBatch,
+    waitForIndex: bool = False,
+    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+):
+    """Create and update many notes in one transaction.
+
+    Items without an id are created, items with one are updated. Invalid items
+    are reported per index and skipped; the rest are written with a fixed
+    number of statements regardless of batch size.
+    """
+    items = payload.notes
+    if not items:
+        raise HTTPException(status_code=400, detail="No notes")
+    if len(items) > BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX} notes per batch")
+
+    results: List[Dict[str, Any]] = [{"index": i, "id": None, "status": None, "error": None} for i in range(len(items))]
+
+    def fail(i: int, error: str) -> None:
+        results[i]["status"] = "error"
+        results[i]["error"] = error
+
+    folder_ids = list({it.folderId for it in items if it.folderId is not None})
+    owned = set()
+    if folder_ids:
+        res = await session.execute(
+            text("SELECT id FROM folders WHERE user_id = :uid AND id = ANY(:ids)"), {"uid": user.uid, "ids": folder_ids}
+        )
+        owned = {r.id for r in res}
+
+    creates: List[int] = []
+    updates: List[int] = []
+    seen = set()
+    for i, it in enumerate(items):
+        if it.folderId is not None and it.folderId not in owned:
+            fail(i, "Folder not found")
+        elif it.id is None:
+            if not (it.title or "").strip():
+                fail(i, "Title required")
+            else:
+                creates.append(i)
+        elif it.id in seen:
+            fail(i, "Duplicate id in batch")
+        else:
+            seen.add(it.id)
+            updates.append(i)
+
+    if creates:
+        ids = [uuid4() for _ in creates]
+        await session.execute(
+            text(
+                """
+                INSERT INTO notes (id, user_id, title, folder_id, excerpt, plain_text)
+                SELECT t.id, :uid, t.title, t.folder_id, t.excerpt, t.body
+                FROM unnest(CAST(:ids AS uuid[]), CAST(:titles AS text[]), CAST(:folders AS uuid[]),
+                            CAST(:excerpts AS text[]), CAST(:bodies AS text[])) AS t(id, title, folder_id, excerpt, body)
+                """
+            ),
+            {
+                "uid": user.uid,
+                "ids": ids,
+                "titles": [items[i].title for i in creates],
+                "folders": [items[i].folderId for i in creates],
+                "excerpts": [items[i].excerpt or (items[i].body[:200] if items[i].body else None) for i in creates],
+                "bodies": [items[i].body or "" for i in creates],
+            },
+        )
+        for i, nid in zip(creates, ids):
+            results[i].update(id=str(nid), status="created")
+            note_upserted(session, user.id, nid, items[i].title)
+
+    if updates:
+        res = await session.execute(
+            text(
+                """
+                UPDATE notes n SET
+                  title = COALESCE(t.title, n.title),
+                  folder_id = COALESCE(t.folder_id, n.folder_id),
+                  excerpt = COALESCE(t.excerpt, n.excerpt),
+                  plain_text = COALESCE(t.body, n.plain_text),
+                  updated_at = now()
+                FROM unnest(CAST(:ids AS uuid[]), CAST(:titles AS text[]), CAST(:folders AS uuid[]),
+                            CAST(:excerpts AS text[]), CAST(:bodies AS text[])) AS t(id, title, folder_id, excerpt, body)
+                WHERE n.id = t.id AND n.user_id = :uid AND n.deleted_at IS NULL
+                RETURNING n.id
+                """
+            ),
+            {
+                "uid": user.uid,
+                "ids": [items[i].id for i in updates],
+                "titles": [items[i].title for i in updates],
+                "folders": [items[i].folderId for i in updates],
+                "excerpts": [items[i].excerpt for i in updates],
+                "bodies": [items[i].body for i in updates],
+            },
+        )
+        found = {r.id for r in res}
+        for i in updates:
+            if items[i].id in found:
+                results[i].update(id=str(items[i].id), status="updated")
+                if items[i].title is not None:
+                    recent_titles.rename(user.id, items[i].id, items[i].title)
+                    note_upserted(session, user.id, items[i].id, items[i].title)
+            else:
+                fail(i, "Note not found")
+
+    written = [i for i in creates + updates if results[i]["status"] != "error"]
+    await enqueue_index(session, [results[i]["id"] for i in written])
+    # Only items that carry a body change their outgoing links
+    await rebuild_links_for_notes(session, user.id, [(results[i]["id"], items[i].body) for i in written if items[i].body is not None])
+    mark_changed(session, [user.id])
+    await session.commit()
+    if waitForIndex:
+        await index_worker.wait_for([results[i]["id"] for i in written])
+    return {
+        "results": results,
+        "created": sum(1 for r in results if r["status"] == "created"),
+        "updated": sum(1 for r in results if r["status"] == "updated"),
+        "errors": sum(1 for r in results if r["status"] == "error"),
+    }
+
+
 @router.get("/{note_id}", response_model=Note)
 async def get_note(
-    note_id: str,
+    note_id: UUID,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
-    q = text(
-        """
-        SELECT n.id, n.title, n.excerpt, n.folder_id, n.created_at, n.updated_at, n.plain_text
-        FROM notes n
-        WHERE n.user_id = :uid::uuid AND n.id::text = :id
-        """
-    )
-    res = await session.execute(q, {"uid": user.id, "id": note_id})
+    res = await session.execute(_GET_NOTE, {"uid": user.uid, "id": note_id})
     row = res.fetchone()
     if row is None:
         raise HTTPException(status_code=404, detail="Note not found")
+    recent_titles.touch(user.id, row.id, row.title)
     return Note(
         id=row.id,
         title=row.title,
@@ -118,8 +318,9 @@ async def get_note(
 
 @router.patch("/{note_id}")
 async def update_note(
-    note_id: str,
+    note_id: UUID,
     payload: dict,
+    waitForIndex: bool = False,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
@@ -134,8 +335,9 @@ async def update_note(
           title = COALESCE(:title, title),
           excerpt = COALESCE(:excerpt, excerpt),
           folder_id = COALESCE(:folder_id, folder_id),
+          plain_text = COALESCE(:body, plain_text),
           updated_at = now()
-        WHERE id::text = :id AND user_id = :uid::uuid
+        WHERE id = :id AND user_id = :uid
         RETURNING id, title, excerpt, folder_id, created_at, updated_at
         """
     )
@@ -145,24 +347,24 @@ async def update_note(
             "id": note_id,
             "title": allowed.get("title"),
             "excerpt": allowed.get("excerpt"),
-            "folder_id": allowed.get("folderId"),
-            "uid": user.id,
+            "folder_id": optional_uuid(allowed.get("folderId"), "Invalid folderId"),
+            "body": allowed.get("body"),
+            "uid": user.uid,
         },
     )
     row = res.fetchone()
-    await session.commit()
     if row is None:
         raise HTTPException(status_code=404, detail="Note not found")
-    # Update search and links if body/title/excerpt changed
-    await update_note_search(
-        session,
-        note_id,
-        allowed.get("title", row.title),
-        allowed.get("excerpt", row.excerpt),
-        allowed.get("body"),
-    )
-    await rebuild_links_for_note(session, user.id, note_id, allowed.get("body"))
+    recent_titles.rename(user.id, row.id, row.title)
+    if "title" in allowed:
+        note_upserted(session, user.id, row.id, row.title)
+    await enqueue_index(session, [note_id])
+    if "body" in allowed:
+        await rebuild_links_for_note(session, user.id, note_id, allowed.get("body"))
+    mark_changed(session, [user.id])
     await session.commit()
+    if waitForIndex:
+        await index_worker.wait_for([note_id])
     return {
         "id": str(row.id),
         "title": row.title,
@@ -175,19 +377,22 @@ async def update_note(
 
 @router.delete("/{note_id}")
 async def delete_note(
-    note_id: str,
+    note_id: UUID,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
-    q = text("UPDATE notes SET deleted_at = now() WHERE id::text = :id AND user_id = :uid::uuid")
-    await session.execute(q, {"id": note_id, "uid": user.id})
+    q = text("UPDATE notes SET deleted_at = now(), updated_at = now() WHERE id = :id AND user_id = :uid")
+    await session.execute(q, {"id": note_id, "uid": user.uid})
+    mark_changed(session, [user.id])
+    note_removed(session, user.id, note_id)
     await session.commit()
+    recent_titles.forget(user.id, note_id)
     return {"id": note_id, "deleted": True}
 
 
 @router.get("/{note_id}/backlinks")
 async def backlinks(
-    note_id: str,
+    note_id: UUID,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
@@ -196,12 +401,12 @@ async def backlinks(
         SELECT n.id::text AS id, n.title, count(l.id) AS refs
         FROM links l
         JOIN notes n ON n.id = l.src_note_id
-        WHERE l.dst_note_id::text = :id AND n.user_id = :uid::uuid AND n.deleted_at IS NULL
+        WHERE l.dst_note_id = :id AND n.user_id = :uid AND n.deleted_at IS NULL
         GROUP BY n.id, n.title
         ORDER BY refs DESC, n.updated_at DESC
         LIMIT 100
         """
     )
-    res = await session.execute(q, {"id": note_id, "uid": user.id})
+    res = await session.execute(q, {"id": note_id, "uid": user.uid})
     rows = res.mappings().all()
     return [{"id": r["id"], "title": r["title"], "count": int(r["refs"])} for r in rows]
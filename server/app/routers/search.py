@@ -1,44 +1,191 @@
-from fastapi import APIRouter, Depends, HTTPException
+from datetime import datetime
+from typing import List, Tuple
+from uuid import UUID
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from ..db import get_session
 from ..auth import get_current_user, CurrentUser
+from ..index_queue import enqueue_user_reindex
+from ..schemas import SearchConfig
+from ..utils.cursors import decode_cursor, encode_cursor
+from ..utils.ids import require_uuid
+from ..utils.search_backend import FACETS, search_backend
+from ..utils.search_cache import mark_changed, search_cache
+from ..utils.title_cache import recent_titles
 
 router = APIRouter()
 
 
+def _hit(r) -> dict:
+    return {"id": str(r["id"]), "title": r["title"], "excerpt": r["excerpt"], "snippet": r["snippet"], "rank": float(r["rank"] or 0)}
+
+
 @router.get("")
 async def search(
+    response: Response,
     q: str,
-    folderId: str | None = None,
+    folderId: UUID | None = None,
     tag: str | None = None,
+    limit: int = Query(50, ge=1, le=100),
+    cursor: str | None = None,
+    facets: str | None = None,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
     if not q or len(q.strip()) < 2:
         raise HTTPException(status_code=400, detail="Query too short")
-    where = ["n.user_id = :uid::uuid", "n.deleted_at IS NULL"]
-    params = {"q": q, "uid": user.id}
-    if folderId:
-        where.append("n.folder_id::text = :fid")
-        params["fid"] = folderId
-    join = ""
-    if tag:
-        join = "JOIN note_tags nt ON nt.note_id = n.id JOIN tags t ON t.id = nt.tag_id AND lower(t.name)=lower(:tag)"
-        params["tag"] = tag
-    query = text(
-        f"""
-        SELECT n.id::text AS id, n.title, n.excerpt,
-               ts_rank(to_tsvector('english', coalesce(n.title,'') || ' ' || coalesce(n.excerpt,'')), plainto_tsquery('english', :q)) AS rank,
-               ts_headline('english', coalesce(n.excerpt, n.title), plainto_tsquery('english', :q), 'StartSel=<b>,StopSel=</b>,MaxFragments=2,MinWords=5,MaxWords=20') AS snippet
-        FROM notes n
-        {join}
-        WHERE {' AND '.join(where)}
-          AND to_tsvector('english', coalesce(n.title,'') || ' ' || coalesce(n.excerpt,'')) @@ plainto_tsquery('english', :q)
-        ORDER BY rank DESC, n.updated_at DESC
-        LIMIT 50
-        """
+    wanted = sorted({f.strip() for f in (facets or "").split(",") if f.strip()})
+    if any(f not in FACETS for f in wanted):
+        raise HTTPException(status_code=422, detail=f"facets must be a subset of {','.join(FACETS)}")
+    # Taken before querying: a write committed meanwhile invalidates this result
+    gen = search_cache.generation(user.id)
+    key = ("search", " ".join(q.split()).lower(), folderId, (tag or "").lower(), limit, cursor, tuple(wanted))
+    cached = search_cache.get(user.id, key)
+    if cached is not None:
+        body, next_cursor = cached
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return body
+    after = None
+    if cursor:
+        rank_raw, ts_raw, id_raw = decode_cursor(cursor, 3)
+        try:
+            after = (float(rank_raw), datetime.fromisoformat(ts_raw), require_uuid(id_raw, "Invalid cursor", 400))
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    page = await search_backend.search(
+        session, user.uid, q, folder_id=folderId, tag=tag, limit=limit + 1, after=after, facets=wanted
+    )
+    rows = page["rows"]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(float(last["rank"]), last["updated_at"].isoformat(), str(last["id"]))
+        response.headers["X-Next-Cursor"] = next_cursor
+    out = [_hit(r) for r in rows]
+    size = sum(len(r["title"] or "") + len(r["excerpt"] or "") + len(r["snippet"] or "") + 200 for r in out)
+    body = {
+        "results": out,
+        "total": page["total"],
+        "truncated": page["truncated"],
+        "nextCursor": next_cursor,
+        "facets": page["facets"],
+    }
+    size += sum(len(v) * 100 for v in page["facets"].values())
+    search_cache.put(user.id, key, gen, (body, next_cursor), size + 200)
+    return body
+
+
+def _like_escape(q: str) -> str:
+    return q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+async def _confirm_recent(
+    session: AsyncSession, user: CurrentUser, q: str, recent: List[Tuple[UUID, str]]
+) -> List[Tuple[UUID, str]]:
+    # Other workers' renames and deletes don't reach this worker's cache, so
+    # check the candidates against notes by primary key
+    if not recent:
+        return recent
+    res = await session.execute(
+        text("SELECT id, title FROM notes WHERE id = ANY(:ids) AND user_id = :uid AND deleted_at IS NULL"),
+        {"ids": [nid for nid, _ in recent], "uid": user.uid},
     )
+    live = {r.id: r.title for r in res}
+    needle = q.casefold()
+    out = []
+    for nid, title in recent:
+        current = live.get(nid)
+        if current is None:
+            recent_titles.forget(user.id, nid)
+            continue
+        if current != title:
+            recent_titles.rename(user.id, nid, current)
+        if current.casefold().startswith(needle):
+            out.append((nid, current))
+    return out
+
+
+@router.get("/titles")
+async def search_titles(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(10, ge=1, le=20),
+    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+):
+    q = q.strip()
+    if not q:
+        return []
+    # Recently opened notes first; if they fill the page, skip the title search
+    recent = await _confirm_recent(session, user, q, recent_titles.match(user.id, q))
+    if len(recent) >= limit:
+        recent_titles.hits += 1
+        return [{"id": str(nid), "title": title, "recent": True} for nid, title in recent[:limit]]
+    recent_titles.misses += 1
+    params = {"uid": user.uid, "lim": limit, "prefix": _like_escape(q.lower()) + "%"}
+    if len(q) < 3:
+        # Below trigram length: prefix only, served by idx_notes_title_prefix
+        query = text(
+            """
+            SELECT id, title FROM notes
+            WHERE user_id = :uid AND deleted_at IS NULL AND lower(title) LIKE :prefix
+            ORDER BY updated_at DESC
+            LIMIT :lim
+            """
+        )
+    else:
+        # Typo-tolerant: word similarity via the trigram index, boosted for
+        # prefix matches and recently edited notes
+        await session.execute(text("SELECT set_config('pg_trgm.word_similarity_threshold', '0.3', true)"))
+        params["q"] = q
+        query = text(
+            """
+            SELECT id, title FROM notes
+            WHERE user_id = :uid AND deleted_at IS NULL AND :q <% title
+            ORDER BY word_similarity(:q, title)
+                     + CASE WHEN lower(title) LIKE :prefix THEN 0.5 ELSE 0 END
+                     + 0.2 / (1 + EXTRACT(EPOCH FROM now() - updated_at) / 604800) DESC
+            LIMIT :lim
+            """
+        )
     res = await session.execute(query, params)
-    rows = res.mappings().all()
-    return [{"id": r["id"], "title": r["title"], "excerpt": r["excerpt"], "snippet": r["snippet"], "rank": float(r["rank"] or 0)} for r in rows]
+    out = [{"id": str(nid), "title": title, "recent": True} for nid, title in recent]
+    seen = {nid for nid, _ in recent}
+    for r in res:
+        if r.id not in seen and len(out) < limit:
+            out.append({"id": str(r.id), "title": r.title, "recent": False})
+    return out
+
+
+@router.get("/config")
+async def get_search_config(
+    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+):
+    res = await session.execute(text("SELECT search_config FROM users WHERE id = :uid"), {"uid": user.uid})
+    avail = await session.execute(text("SELECT cfgname FROM pg_ts_config ORDER BY cfgname"))
+    return {"config": res.scalar(), "available": [r[0] for r in avail]}
+
+
+@router.put("/config")
+async def set_search_config(
+    payload: SearchConfig,
+    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+):
+    ok = await session.execute(text("SELECT 1 FROM pg_ts_config WHERE cfgname = :c"), {"c": payload.config})
+    if ok.fetchone() is None:
+        raise HTTPException(status_code=422, detail="Unknown text search configuration")
+    res = await session.execute(
+        text("UPDATE users SET search_config = :c WHERE id = :uid AND search_config <> :c RETURNING id"),
+        {"c": payload.config, "uid": user.uid},
+    )
+    changed = res.fetchone() is not None
+    if changed:
+        # Existing vectors were built with the old config
+        await enqueue_user_reindex(session, user.uid)
+        mark_changed(session, [user.id])
+    await session.commit()
+    return {"config": payload.config, "reindexing": changed}
@@ -1,10 +1,13 @@
 from typing import List
+from uuid import UUID
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from ..schemas import TagOut, TagCreate, TagUpdate
 from ..db import get_session
 from ..auth import get_current_user, CurrentUser
+from ..utils.search_cache import mark_changed
 
 router = APIRouter()
 
@@ -19,15 +22,20 @@ async def list_tags(
         SELECT t.id, t.name, t.color,
           (SELECT count(*) FROM note_tags nt WHERE nt.tag_id = t.id) AS count
         FROM tags t
-        WHERE t.user_id = :uid::uuid
+        WHERE t.user_id = :uid
         ORDER BY lower(t.name)
         """
     )
-    res = await session.execute(q, {"uid": user.id})
+    res = await session.execute(q, {"uid": user.uid})
     rows = res.fetchall()
     return [TagOut(id=r.id, name=r.name, color=r.color, count=r.count) for r in rows]
 
 
+async def _touch_tags(session: AsyncSession, uid) -> None:
+    # Invalidates GET /notes ETags, which can't see tag renames or deletes
+    await session.execute(text("UPDATE users SET tags_changed_at = clock_timestamp() WHERE id = :uid"), {"uid": uid})
+
+
 @router.post("/", response_model=TagOut)
 async def create_tag(
     payload: TagCreate,
@@ -37,23 +45,25 @@ async def create_tag(
     q = text(
         """
         INSERT INTO tags (user_id, name, color)
-        VALUES (:uid::uuid, :name, :color)
+        VALUES (:uid, :name, :color)
         RETURNING id, name, color
         """
     )
     try:
-        res = await session.execute(q, {"uid": user.id, "name": payload.name, "color": payload.color})
-        row = res.fetchone()
-        await session.commit()
-        return TagOut(id=row.id, name=row.name, color=row.color, count=0)
-    except Exception:
+        res = await session.execute(q, {"uid": user.uid, "name": payload.name, "color": payload.color})
+    except IntegrityError:
         await session.rollback()
         raise HTTPException(status_code=409, detail="Tag already exists")
+    row = res.fetchone()
+    await _touch_tags(session, user.uid)
+    mark_changed(session, [user.id])
+    await session.commit()
+    return TagOut(id=row.id, name=row.name, color=row.color, count=0)
 
 
 @router.patch("/{tag_id}", response_model=TagOut)
 async def update_tag(
-    tag_id: str,
+    tag_id: UUID,
     payload: TagUpdate,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
@@ -63,36 +73,42 @@ async def update_tag(
         UPDATE tags SET
           name = COALESCE(:name, name),
           color = COALESCE(:color, color)
-        WHERE id::text = :id AND user_id = :uid::uuid
+        WHERE id = :id AND user_id = :uid
         RETURNING id, name, color
         """
     )
     res = await session.execute(
-        q, {"name": payload.name, "color": payload.color, "id": tag_id, "uid": user.id}
+        q, {"name": payload.name, "color": payload.color, "id": tag_id, "uid": user.uid}
     )
     row = res.fetchone()
     if row is None:
         raise HTTPException(status_code=404, detail="Tag not found")
+    await _touch_tags(session, user.uid)
+    mark_changed(session, [user.id])
     await session.commit()
     # recompute count
-    c = await session.execute(text("SELECT count(*) AS c FROM note_tags WHERE tag_id::text=:id"), {"id": tag_id})
+    c = await session.execute(text("SELECT count(*) AS c FROM note_tags WHERE tag_id = :id"), {"id": tag_id})
     count = c.scalar() or 0
     return TagOut(id=row.id, name=row.name, color=row.color, count=count)
 
 
 @router.delete("/{tag_id}")
 async def delete_tag(
-    tag_id: str,
+    tag_id: UUID,
     session: AsyncSession = Depends(get_session),
     user: CurrentUser = Depends(get_current_user),
 ):
     await session.execute(
-        text("DELETE FROM note_tags WHERE tag_id::text=:id"), {"id": tag_id}
+        text("DELETE FROM note_tags nt USING tags t WHERE nt.tag_id = :id AND t.id = nt.tag_id AND t.user_id = :uid"),
+        {"id": tag_id, "uid": user.uid},
     )
     res = await session.execute(
-        text("DELETE FROM tags WHERE id::text=:id AND user_id=:uid::uuid"),
-        {"id": tag_id, "uid": user.id},
+        text("DELETE FROM tags WHERE id = :id AND user_id = :uid"),
+        {"id": tag_id, "uid": user.uid},
     )
+    if res.rowcount:
+        await _touch_tags(session, user.uid)
+    mark_changed(session, [user.id])
     await session.commit()
     if res.rowcount == 0:
         raise HTTPException(status_code=404, detail="Tag not found")
@@ -0,0 +1,40 @@
+from uuid import UUID
+from fastapi import APIRouter, WebSocket
+from sqlalchemy import text
+from ..auth import resolve_token
+from ..db import SessionLocal
+from ..utils.collab import collab_hub
+
+router = APIRouter()
+
+
+@router.websocket("/notes/{note_id}")
+async def note_socket(websocket: WebSocket, note_id: UUID, token: str | None = None):
+    # Browsers can't set headers on WebSocket; accept ?token= as well as Bearer
+    if not token:
+        auth = websocket.headers.get("authorization", "")
+        token = auth[7:] if auth.lower().startswith("bearer ") else None
+    # Own session, released before the socket's lifetime starts
+    async with SessionLocal() as session:
+        user = await resolve_token(token, session) if token else None
+        if user is not None:
+            own = await session.execute(
+                text("SELECT 1 FROM notes WHERE id = :id AND user_id = :uid AND deleted_at IS NULL"), {"id": note_id, "uid": user.uid}
+            )
+            if own.fetchone() is None:
+                user = None
+    if user is None:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    conn = collab_hub.join(websocket, user, note_id)
+    try:
+        while True:
+            msg = await websocket.receive()
+            if msg["type"] == "websocket.disconnect":
+                break
+            data = msg.get("bytes")
+            if data:
+                await collab_hub.receive(conn, data)
+    finally:
+        await collab_hub.leave(conn)
@@ -13,6 +13,19 @@ class NoteCreate(BaseModel):
     excerpt: Optional[str] = None
 
 
+class NoteBatchItem(BaseModel):
+    # With id: partial update of that note; without: create (title required)
+    id: Optional[UUID] = None
+    title: Optional[str] = None
+    folderId: Optional[UUID] = None
+    excerpt: Optional[str] = None
+    body: Optional[str] = None
+
+
+class NoteBatch(BaseModel):
+    notes: List[NoteBatchItem]
+
+
 class Block(BaseModel):
     id: UUID
     type: str
@@ -76,3 +89,13 @@ class FolderCreate(BaseModel):
 class FolderUpdate(BaseModel):
     name: Optional[str] = None
     parentId: Optional[UUID] = None
+
+
+class ReindexRequest(BaseModel):
+    rebuildBlocks: bool = False  # re-decode every block's CRDT state too
+    chunkSize: int = Field(default=500, ge=1, le=10000)
+
+
+class SearchConfig(BaseModel):
+    # A Postgres text search configuration name, e.g. "english", "german", "simple"
+    config: str
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .config import env_float
+from .metrics import current_request
+
+log = logging.getLogger("vnote.slowquery")
+
+_WS_RE = re.compile(r"\s+")
+_STR_RE = re.compile(r"'(?:[^']|'')*'")
+_NUM_RE = re.compile(r"(?<![\w$.])-?\d+(?:\.\d+)?\b")
+_WRITE_RE = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|CREATE|ALTER|DROP)\b", re.IGNORECASE)
+
+
+def normalize_sql(statement: str) -> str:
+    """Collapse whitespace and replace literals so equal shapes group together."""
+    s = _STR_RE.sub("?", statement)
+    s = _NUM_RE.sub("?", s)
+    return _WS_RE.sub(" ", s).strip()
+
+
+def _shape(value: Any) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return f"{type(value).__name__}({len(value)})"
+    if isinstance(value, (list, tuple, set)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+def param_shapes(parameters: Any) -> Any:
+    """Types and sizes of bind values, never the values themselves."""
+    if isinstance(parameters, dict):
+        return {k: _shape(v) for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_shape(v) for v in parameters]
+    return _shape(parameters)
+
+
+def _is_read_only(statement: str) -> bool:
+    head = statement.lstrip().upper()
+    return head.startswith(("SELECT", "WITH")) and not _WRITE_RE.search(statement)
+
+
+class SlowQueryLog:
+    """Ring buffer of statements slower than ``threshold_ms``.
+
+    A ``explain_sample`` fraction of slow statements also get an EXPLAIN run on
+    a separate connection in the background. Only read-only statements are
+    ANALYZEd; writes get a plain plan. At most ``max_explains`` run at once.
+    """
+
+    def __init__(
+        self,
+        threshold_ms: float = 250.0,
+        size: int = 200,
+        explain_sample: float = 0.0,
+        explain_timeout_ms: int = 5000,
+        max_explains: int = 2,
+    ):
+        self.threshold = threshold_ms / 1000.0
+        self.entries: Deque[Dict[str, Any]] = deque(maxlen=size)
+        self.explain_sample = explain_sample
+        self.explain_timeout_ms = explain_timeout_ms
+        self.max_explains = max_explains
+        self.total = 0
+        self._explaining = 0
+        self._engine: Optional[AsyncEngine] = None
+
+    def install(self, engine: AsyncEngine) -> None:
+        self._engine = engine
+        sync_engine = engine.sync_engine
+        if not event.contains(sync_engine, "before_cursor_execute", self._before):
+            event.listen(sync_engine, "before_cursor_execute", self._before)
+            event.listen(sync_engine, "after_cursor_execute", self._after)
+            event.listen(sync_engine, "handle_error", self._error)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("vnote_slowlog_start", []).append(time.perf_counter())
+
+    def _error(self, ctx):
+        conn = ctx.connection
+        if conn is not None:
+            starts = conn.info.get("vnote_slowlog_start")
+            if starts:
+                starts.pop()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("vnote_slowlog_start")
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        if elapsed < self.threshold or statement.lstrip()[:7].upper() == "EXPLAIN":
+            return
+        self.record(statement, parameters, elapsed, executemany)
+
+    def record(self, statement: str, parameters: Any, elapsed: float, executemany: bool = False) -> Dict[str, Any]:
+        stats = current_request.get()
+        entry: Dict[str, Any] = {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "durationMs": round(elapsed * 1000.0, 3),
+            "sql": normalize_sql(statement),
+            "params": param_shapes(parameters[0] if executemany and parameters else parameters),
+            "executemany": executemany,
+            "route": stats.route if stats is not None else None,
+            "method": stats.scope.get("method") if stats is not None else None,
+            "plan": None,
+        }
+        self.total += 1
+        self.entries.append(entry)
+        log.warning("slow query %.1fms route=%s sql=%s", entry["durationMs"], entry["route"], entry["sql"][:500])
+        if (
+            self._engine is not None
+            and not executemany
+            and self.explain_sample > 0
+            and self._explaining < self.max_explains
+            and random.random() < self.explain_sample
+        ):
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return entry
+            self._explaining += 1
+            loop.create_task(self._explain(entry, statement, parameters))
+        return entry
+
+    async def _explain(self, entry: Dict[str, Any], statement: str, parameters: Any) -> None:
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if _is_read_only(statement) else "EXPLAIN "
+        try:
+            async with self._engine.connect() as conn:  # type: ignore[union-attr]
+                await conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(self.explain_timeout_ms)}")
+                if isinstance(parameters, (list, tuple)):
+                    res = await conn.exec_driver_sql(prefix + statement, tuple(parameters))
+                else:
+                    res = await conn.exec_driver_sql(prefix + statement, parameters or ())
+                entry["plan"] = "\n".join(str(r[0]) for r in res)
+                # Never keep side effects of an explained statement
+                await conn.rollback()
+        except Exception as e:  # pragma: no cover - depends on the statement
+            entry["plan"] = f"<explain failed: {e.__class__.__name__}: {e}>"
+        finally:
+            self._explaining -= 1
+
+    def snapshot(self, limit: int = 50) -> List[Dict[str, Any]]:
+        items = list(self.entries)[-limit:] if limit > 0 else []
+        items.reverse()
+        return items
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+slow_query_log = SlowQueryLog(
+    threshold_ms=env_float("SLOW_QUERY_MS", 250.0),
+    size=int(env_float("SLOW_QUERY_LOG_SIZE", 200)),
+    explain_sample=env_float("SLOW_QUERY_EXPLAIN_SAMPLE", 0.0),
+    explain_timeout_ms=int(env_float("SLOW_QUERY_EXPLAIN_TIMEOUT_MS", 5000)),
+)
@@ -0,0 +1,28 @@
+"""Reading a block's Yjs updates back from block_versions.
+
+Blocks written before blocks.ydoc_state was maintained (0009) have no
+state of their own until the compactor backfills it; their history is the
+only copy of their content.
+"""
+from typing import List
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# History since the latest checkpoint, oldest first; replaying it gives the state
+HISTORY = text(
+    """
+    SELECT version, kind, ydoc_snapshot FROM block_versions
+    WHERE block_id = :id AND version >= COALESCE(
+      (SELECT max(version) FROM block_versions WHERE block_id = :id AND kind = 'checkpoint' AND version <= :upto), 0)
+      AND version <= :upto
+    ORDER BY version
+    """
+)
+
+
+async def load_history(session: AsyncSession, block_id: UUID, upto: int) -> List[bytes]:
+    """The updates that replayed in order give the block's state as of ``upto``."""
+    res = await session.execute(HISTORY, {"id": block_id, "upto": upto})
+    return [bytes(r.ydoc_snapshot) for r in res]
@@ -0,0 +1,319 @@
+"""Per-block Yjs state: merging pushes and compacting block_versions history."""
+import asyncio
+import logging
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from ..config import env_int
+from ..db import SessionLocal
+from ..index_queue import enqueue_index
+from ..metrics import SIZE_BUCKETS, registry
+from .block_history import HISTORY, load_history
+from .crdt import decode_pool, diff_updates, merge_updates
+from .framing import DELETED, FULL, Frame
+
+log = logging.getLogger("vnote.blocks")
+
+
+async def _merge(updates: List[bytes]) -> tuple:
+    try:
+        return await decode_pool.run(merge_updates, updates, size=sum(len(u) for u in updates))
+    except (asyncio.TimeoutError, BrokenProcessPool):
+        raise HTTPException(status_code=503, detail="Block merge unavailable, retry")
+
+
+async def push_update(
+    session: AsyncSession, block_id: UUID, user_id: UUID, payload: bytes, note_id: Optional[UUID] = None
+) -> Dict[str, Any]:
+    """Merge ``payload`` into the block's state and append it to history.
+
+    Concurrent pushes to one block apply one after another. With ``note_id``,
+    the block must belong to that note. The caller commits.
+    """
+    # Allocating the version takes the row lock, so concurrent pushes to one
+    # block queue here and each sees the state the previous one committed.
+    res = await session.execute(
+        text(
+            f"""
+            UPDATE blocks b SET state_version = b.state_version + 1, updated_at = now()
+            FROM notes n
+            WHERE b.id = :id AND n.id = b.note_id AND n.user_id = :uid{" AND b.note_id = :nid" if note_id is not None else ""}
+            RETURNING b.note_id, b.ydoc_state, b.state_version
+            """
+        ),
+        {"id": block_id, "uid": user_id, **({"nid": note_id} if note_id is not None else {})},
+    )
+    row = res.fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Block not found")
+    version = int(row.state_version)
+    if row.ydoc_state is not None:
+        base = [bytes(row.ydoc_state)]
+    else:
+        # Blocks written before states were maintained: replay once
+        base = await load_history(session, block_id, version - 1)
+    try:
+        state, sv = await _merge(base + [payload])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Yjs update")
+    await session.execute(
+        text("INSERT INTO block_versions (block_id, version, ydoc_snapshot) VALUES (:bid, :ver, :snap)"),
+        {"bid": block_id, "ver": version, "snap": payload},
+    )
+    await session.execute(
+        text("UPDATE blocks SET ydoc_state = :st, state_vector = :sv WHERE id = :id"),
+        {"st": state, "sv": sv, "id": block_id},
+    )
+    # Plain text and search are rebuilt by the index queue, once per burst
+    await enqueue_index(session, [row.note_id], rebuild_blocks=True)
+    return {"blockId": block_id, "noteId": row.note_id, "version": version, "stateVector": sv}
+
+
+async def diff_note(session: AsyncSession, note_id: UUID, user_id: UUID, vectors: Dict[UUID, bytes]) -> List[Frame]:
+    """Frames bringing a client holding ``vectors`` up to date on a note's blocks.
+
+    Blocks come back in document order. Blocks whose vector matches are
+    omitted; ones the client didn't send get their full state; ones the
+    client sent that are gone get a DELETED frame.
+    """
+    own = await session.execute(
+        text("SELECT 1 FROM notes WHERE id = :id AND user_id = :uid AND deleted_at IS NULL"), {"id": note_id, "uid": user_id}
+    )
+    if own.fetchone() is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+    res = await session.execute(
+        text("SELECT id, ydoc_state, state_vector, state_version FROM blocks WHERE note_id = :nid ORDER BY order_idx, id"),
+        {"nid": note_id},
+    )
+    frames: List[Frame] = []
+    pending: List[Tuple[int, bytes, Optional[bytes]]] = []
+    for r in res.fetchall():
+        sv = vectors.get(r.id) or None
+        state, vector = r.ydoc_state, r.state_vector
+        if state is None:
+            # Written before states were maintained: replay its history
+            updates = await load_history(session, r.id, r.state_version)
+            if not updates:
+                frames.append((r.id, FULL, b""))
+                continue
+            try:
+                state, vector = await _merge(updates)
+            except ValueError as e:
+                log.warning("block %s history can't be replayed: %s", r.id, e)
+                frames.append((r.id, FULL, b""))
+                continue
+        if sv is not None and vector is not None and sv == bytes(vector):
+            continue
+        frames.append((r.id, 0 if sv is not None else FULL, b""))
+        pending.append((len(frames) - 1, bytes(state), sv))
+    if pending:
+        try:
+            diffs = await decode_pool.run(
+                diff_updates, [(st, sv) for _, st, sv in pending], size=sum(len(st) for _, st, _ in pending)
+            )
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid state vector")
+        except (asyncio.TimeoutError, BrokenProcessPool):
+            raise HTTPException(status_code=503, detail="Block diff unavailable, retry")
+        for (i, _, _), diff in zip(pending, diffs):
+            frames[i] = (frames[i][0], frames[i][1], diff)
+    present = {f[0] for f in frames}
+    if vectors:
+        alive = await session.execute(
+            text("SELECT id FROM blocks WHERE note_id = :nid AND id = ANY(:ids)"), {"nid": note_id, "ids": list(vectors)}
+        )
+        present.update(r.id for r in alive)
+    frames.extend((bid, DELETED, b"") for bid in vectors if bid not in present)
+    registry.histogram("vnote_block_sync_bytes", SIZE_BUCKETS).observe(float(sum(len(f[2]) for f in frames)))
+    return frames
+
+
+class BlockCompactor:
+    """Folds old update rows into checkpoints and prunes old checkpoints.
+
+    Per block, history is bounded to the newest ``keep_updates`` updates, at
+    most ``checkpoint_every`` more awaiting the next fold, and
+    ``keep_checkpoints`` checkpoints.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker = SessionLocal,
+        interval: float = 60.0,
+        keep_updates: int = 200,
+        checkpoint_every: int = 100,
+        keep_checkpoints: int = 5,
+        batch: int = 20,
+    ):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.keep_updates = max(0, keep_updates)
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.keep_checkpoints = max(1, keep_checkpoints)
+        self.batch = batch
+        self._task: Optional[asyncio.Task] = None
+        self._stop = asyncio.Event()
+
+    async def _backfill(self, block_id: UUID) -> bool:
+        async with self.session_factory() as session:
+            res = await session.execute(
+                text("SELECT note_id FROM blocks WHERE id = :id AND ydoc_state IS NULL FOR UPDATE SKIP LOCKED"), {"id": block_id}
+            )
+            row = res.fetchone()
+            if row is None:
+                return False
+            vres = await session.execute(text("SELECT max(version) FROM block_versions WHERE block_id = :id"), {"id": block_id})
+            upto = int(vres.scalar() or 0)
+            updates = await load_history(session, block_id, upto)
+            state, sv = await decode_pool.run(merge_updates, updates, size=sum(len(u) for u in updates))
+            await session.execute(
+                text(
+                    "UPDATE blocks SET ydoc_state = :st, state_vector = :sv, state_version = :ver,"
+                    " compact_attempts = 0, compact_failed_at = NULL WHERE id = :id"
+                ),
+                {"st": state, "sv": sv, "ver": upto, "id": block_id},
+            )
+            # Its text may never have been cached; rebuild from the new state
+            await enqueue_index(session, [row.note_id], rebuild_blocks=True)
+            await session.commit()
+        return True
+
+    async def compact(self, block_id: UUID) -> bool:
+        async with self.session_factory() as session:
+            res = await session.execute(
+                text("SELECT state_version, checkpoint_version FROM blocks WHERE id = :id FOR UPDATE SKIP LOCKED"),
+                {"id": block_id},
+            )
+            row = res.fetchone()
+            if row is None:
+                return False
+            cutoff = row.state_version - self.keep_updates
+            if cutoff - row.checkpoint_version < self.checkpoint_every:
+                return False
+            hist = (await session.execute(HISTORY, {"id": block_id, "upto": cutoff})).fetchall()
+            if not hist:
+                return False
+            upto = hist[-1].version
+            snap, _ = await decode_pool.run(
+                merge_updates, [bytes(r.ydoc_snapshot) for r in hist], size=sum(len(r.ydoc_snapshot) for r in hist)
+            )
+            # The newest folded row becomes the checkpoint; the rest go
+            await session.execute(
+                text("UPDATE block_versions SET kind = 'checkpoint', ydoc_snapshot = :snap WHERE block_id = :id AND version = :ver"),
+                {"snap": snap, "id": block_id, "ver": upto},
+            )
+            deleted = await session.execute(
+                text("DELETE FROM block_versions WHERE block_id = :id AND kind = 'update' AND version < :ver"),
+                {"id": block_id, "ver": upto},
+            )
+            pruned = await session.execute(
+                text(
+                    """
+                    DELETE FROM block_versions WHERE block_id = :id AND kind = 'checkpoint' AND version < (
+                      SELECT version FROM block_versions WHERE block_id = :id AND kind = 'checkpoint'
+                      ORDER BY version DESC OFFSET :keep LIMIT 1
+                    )
+                    """
+                ),
+                {"id": block_id, "keep": self.keep_checkpoints - 1},
+            )
+            await session.execute(
+                text("UPDATE blocks SET checkpoint_version = :ver, compact_attempts = 0, compact_failed_at = NULL WHERE id = :id"),
+                {"ver": upto, "id": block_id},
+            )
+            await session.commit()
+        registry.inc("vnote_block_versions_compacted_total", float(deleted.rowcount + pruned.rowcount))
+        return True
+
+    async def run_once(self) -> int:
+        # Blocks that failed recently wait out an exponential backoff
+        due = (
+            "(compact_failed_at IS NULL OR compact_failed_at < now()"
+            " - make_interval(secs => LEAST(:max_backoff, :interval * power(2, compact_attempts))))"
+        )
+        params = {"n": self.batch, "interval": max(self.interval, 1.0), "max_backoff": 86400}
+        async with self.session_factory() as session:
+            res = await session.execute(
+                text(
+                    f"""
+                    SELECT b.id, true AS legacy FROM blocks b
+                    WHERE b.ydoc_state IS NULL AND {due}
+                      AND EXISTS (SELECT 1 FROM block_versions v WHERE v.block_id = b.id)
+                    LIMIT :n
+                    """
+                ),
+                params,
+            )
+            candidates = res.fetchall()
+            # Longest uncompacted history first, via idx_blocks_compact_backlog
+            res = await session.execute(
+                text(
+                    f"""
+                    SELECT id, false AS legacy FROM blocks
+                    WHERE ydoc_state IS NOT NULL AND state_version - checkpoint_version >= :threshold AND {due}
+                    ORDER BY state_version - checkpoint_version DESC
+                    LIMIT :n
+                    """
+                ),
+                {**params, "threshold": self.keep_updates + self.checkpoint_every, "n": self.batch - len(candidates)},
+            )
+            candidates += res.fetchall()
+        done = 0
+        for c in candidates:
+            try:
+                if c.legacy:
+                    done += await self._backfill(c.id)
+                else:
+                    done += await self.compact(c.id)
+            except Exception as e:  # corrupt history shouldn't stop other blocks
+                log.warning("compacting block %s failed: %s", c.id, e)
+                await self._record_failure(c.id)
+        return done
+
+    async def _record_failure(self, block_id: UUID) -> None:
+        async with self.session_factory() as session:
+            await session.execute(
+                text("UPDATE blocks SET compact_attempts = compact_attempts + 1, compact_failed_at = now() WHERE id = :id"),
+                {"id": block_id},
+            )
+            await session.commit()
+
+    async def run_forever(self) -> None:
+        while not self._stop.is_set():
+            try:
+                n = await self.run_once()
+            except Exception as e:
+                log.warning("block compactor error: %s", e)
+                n = 0
+            if n < self.batch:
+                try:
+                    await asyncio.wait_for(self._stop.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def start(self) -> None:
+        if self._task is None and self.interval > 0:
+            self._stop = asyncio.Event()
+            self._task = asyncio.create_task(self.run_forever())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._stop.set()
+            await self._task
+            self._task = None
+
+
+block_compactor = BlockCompactor(
+    interval=float(env_int("BLOCK_COMPACT_INTERVAL_SECONDS", 60)),
+    keep_updates=env_int("BLOCK_HISTORY_KEEP_UPDATES", 200),
+    checkpoint_every=env_int("BLOCK_CHECKPOINT_EVERY", 100),
+    keep_checkpoints=env_int("BLOCK_HISTORY_KEEP_CHECKPOINTS", 5),
+)
+
+registry.describe("vnote_block_versions_compacted_total", "block_versions rows removed by compaction")
+registry.describe("vnote_block_sync_bytes", "Payload bytes returned per block sync")
@@ -0,0 +1,431 @@
+"""In-process BM25 inverted index with memory-mapped segments.
+
+Documents get increasing integer docnos; re-indexing a note gives it a new
+docno and the old one is dead from then on. New documents go to an in-memory
+segment of array-backed postings, which is flushed to an immutable segment
+file once it holds ``flush_docs`` documents. Segments are merged when there
+are more than ``max_segments``, dropping dead postings.
+
+Segment file ``<name>.seg`` (little-endian uint32 words, so it can be mapped
+and read with ``memoryview.cast("I")``)::
+
+    magic, n_docs, n_terms, n_postings
+    docnos[n_docs] lengths[n_docs] note_ids[4*n_docs] user_ids[4*n_docs]
+    term_offsets[n_terms + 1] post_docs[n_postings] post_tfs[n_postings]
+
+with its sorted terms, one per line, in ``<name>.terms``. ``manifest.json``
+lists the live segments.
+"""
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from array import array
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+from uuid import UUID, uuid4
+
+MAGIC = 0x314D4256  # "VBM1"
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+_MAX_TOKEN = 64
+
+assert array("I").itemsize == 4
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN.findall(text.casefold()) if len(t) <= _MAX_TOKEN]
+
+
+def _uuid_words(u: UUID) -> Tuple[int, ...]:
+    return struct.unpack("<4I", u.bytes)
+
+
+def _words_uuid(words: Sequence[int]) -> UUID:
+    return UUID(bytes=struct.pack("<4I", *words))
+
+
+class Segment:
+    """Immutable postings, either mapped from a file or built in memory."""
+
+    def __init__(
+        self,
+        terms: List[str],
+        offsets: Sequence[int],
+        post_docs: Sequence[int],
+        post_tfs: Sequence[int],
+        docs: List[Tuple[int, int, UUID, UUID]],
+        name: Optional[str] = None,
+        closer=None,
+    ):
+        self.name = name
+        self.terms = {t: i for i, t in enumerate(terms)}
+        self.offsets = offsets
+        self.post_docs = post_docs
+        self.post_tfs = post_tfs
+        self.docs = docs  # (docno, length, note_id, user_id)
+        self._closer = closer
+        # Queries reading the segment; the index's lock guards these two
+        self.refs = 0
+        self.retired = False
+
+    def postings(self, term: str) -> Tuple[Sequence[int], Sequence[int]]:
+        i = self.terms.get(term)
+        if i is None:
+            return (), ()
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return self.post_docs[lo:hi], self.post_tfs[lo:hi]
+
+    def close(self) -> None:
+        if self._closer is not None:
+            self._closer()
+            self._closer = None
+
+    @classmethod
+    def load(cls, directory: str, name: str) -> "Segment":
+        with open(os.path.join(directory, name + ".terms"), encoding="utf-8") as f:
+            terms = f.read().split("\n") if os.path.getsize(f.name) else []
+        fh = open(os.path.join(directory, name + ".seg"), "rb")
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        words = memoryview(mm).cast("I")
+        if sys.byteorder != "little":
+            raise RuntimeError("BM25 segments are little-endian")
+        magic, n_docs, n_terms, n_post = words[0:4]
+        if magic != MAGIC or n_terms != len(terms):
+            raise ValueError(f"corrupt segment {name}")
+        pos = 4
+        docnos = words[pos:pos + n_docs]
+        pos += n_docs
+        lengths = words[pos:pos + n_docs]
+        pos += n_docs
+        notes = words[pos:pos + 4 * n_docs]
+        pos += 4 * n_docs
+        users = words[pos:pos + 4 * n_docs]
+        pos += 4 * n_docs
+        offsets = words[pos:pos + n_terms + 1]
+        pos += n_terms + 1
+        post_docs = words[pos:pos + n_post]
+        pos += n_post
+        post_tfs = words[pos:pos + n_post]
+        docs = [
+            (docnos[i], lengths[i], _words_uuid(notes[4 * i:4 * i + 4]), _words_uuid(users[4 * i:4 * i + 4]))
+            for i in range(n_docs)
+        ]
+
+        def closer() -> None:
+            for view in (docnos, lengths, notes, users, offsets, post_docs, post_tfs, words):
+                view.release()
+            try:
+                mm.close()
+            except BufferError:
+                pass  # a query still holds a slice; unmapped when it's collected
+            fh.close()
+
+        return cls(terms, offsets, post_docs, post_tfs, docs, name=name, closer=closer)
+
+    @staticmethod
+    def write(
+        directory: str, name: str, postings: Dict[str, Tuple[array, array]], docs: List[Tuple[int, int, UUID, UUID]]
+    ) -> None:
+        terms = sorted(postings)
+        offsets = array("I", [0])
+        post_docs, post_tfs = array("I"), array("I")
+        for t in terms:
+            d, f = postings[t]
+            post_docs.extend(d)
+            post_tfs.extend(f)
+            offsets.append(len(post_docs))
+        head = array("I", [MAGIC, len(docs), len(terms), len(post_docs)])
+        head.extend(d[0] for d in docs)
+        head.extend(d[1] for d in docs)
+        for d in docs:
+            head.extend(_uuid_words(d[2]))
+        for d in docs:
+            head.extend(_uuid_words(d[3]))
+        tmp = os.path.join(directory, name + ".seg.tmp")
+        with open(tmp, "wb") as f:
+            for part in (head, offsets, post_docs, post_tfs):
+                part.tofile(f)
+        os.replace(tmp, os.path.join(directory, name + ".seg"))
+        with open(os.path.join(directory, name + ".terms"), "w", encoding="utf-8") as f:
+            f.write("\n".join(terms))
+
+
+class Bm25Index:
+    """BM25 over (note, user, text) documents; queries are scoped to one user.
+
+    Collection statistics (document count, average length, document
+    frequency) are over all live documents, not per user. Writes are not
+    thread-safe with each other, but ``search``, ``flush`` and ``merge`` may
+    run in other threads: queries hold references on the segments they read,
+    and a segment merged away is only unmapped once the last one is released.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        k1: float = 1.2,
+        b: float = 0.75,
+        flush_docs: int = 1000,
+        max_segments: int = 8,
+    ):
+        self.directory = directory
+        self.k1 = k1
+        self.b = b
+        self.flush_docs = flush_docs
+        self.max_segments = max_segments
+        self.segments: List[Segment] = []
+        self._lock = threading.Lock()
+        self._next = 1
+        self._current: Dict[UUID, int] = {}  # note -> live docno
+        self._docs: Dict[int, Tuple[int, UUID, UUID]] = {}  # live docno -> (length, user, note)
+        self._total_len = 0
+        self._live: Dict[str, Tuple[array, array]] = {}
+        self._live_docs: List[Tuple[int, int, UUID, UUID]] = []
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    # -- state -----------------------------------------------------------
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def _load(self) -> None:
+        path = os.path.join(self.directory, "manifest.json")
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        for name in manifest.get("segments", []):
+            seg = Segment.load(self.directory, name)
+            self.segments.append(seg)
+            for docno, length, note, user in seg.docs:
+                self._adopt(docno, length, note, user)
+        self._next = max(self._next, int(manifest.get("next", 1)))
+
+    def _adopt(self, docno: int, length: int, note: UUID, user: UUID) -> None:
+        old = self._current.get(note)
+        if old is not None:
+            if old > docno:
+                return
+            self._kill(old)
+        self._current[note] = docno
+        self._docs[docno] = (length, user, note)
+        self._total_len += length
+        self._next = max(self._next, docno + 1)
+
+    def _kill(self, docno: int) -> None:
+        doc = self._docs.pop(docno, None)
+        if doc is not None:
+            self._total_len -= doc[0]
+
+    def _save_manifest(self) -> None:
+        if not self.directory:
+            return
+        tmp = os.path.join(self.directory, "manifest.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"segments": [s.name for s in self.segments], "next": self._next}, f)
+        os.replace(tmp, os.path.join(self.directory, "manifest.json"))
+
+    # -- writes ----------------------------------------------------------
+
+    def add(self, note_id: UUID, user_id: UUID, text: str) -> None:
+        """Index ``text`` as the current content of ``note_id``."""
+        tokens = tokenize(text)
+        counts: Dict[str, int] = {}
+        for t in tokens:
+            counts[t] = counts.get(t, 0) + 1
+        with self._lock:
+            docno = self._next
+            self._next += 1
+            for t, tf in counts.items():
+                lst = self._live.get(t)
+                if lst is None:
+                    lst = self._live[t] = (array("I"), array("I"))
+                lst[0].append(docno)
+                lst[1].append(tf)
+            self._live_docs.append((docno, len(tokens), note_id, user_id))
+            self._adopt(docno, len(tokens), note_id, user_id)
+
+    def remove(self, note_id: UUID) -> None:
+        with self._lock:
+            docno = self._current.pop(note_id, None)
+            if docno is not None:
+                self._kill(docno)
+
+    def notes(self) -> Set[UUID]:
+        return set(self._current)
+
+    def needs_flush(self) -> bool:
+        return len(self._live_docs) >= self.flush_docs
+
+    def flush(self) -> bool:
+        """Move the in-memory segment into an immutable one (on disk if configured)."""
+        with self._lock:
+            if not self._live_docs:
+                return False
+            postings, docs = self._live, self._live_docs
+            self._live, self._live_docs = {}, []
+            # Until the new segment is swapped in, queries still need these
+            self._frozen = (postings, docs)
+        try:
+            seg = self._build(postings, docs)
+        except Exception:
+            with self._lock:
+                # Put the documents back in front of anything added since
+                for t, (d, f) in self._live.items():
+                    lst = postings.setdefault(t, (array("I"), array("I")))
+                    lst[0].extend(d)
+                    lst[1].extend(f)
+                self._live, self._live_docs = postings, docs + self._live_docs
+                self._frozen = None
+            raise
+        with self._lock:
+            self.segments.append(seg)
+            self._frozen = None
+            self._save_manifest()
+        return True
+
+    def _build(self, postings: Dict[str, Tuple[array, array]], docs: List[Tuple[int, int, UUID, UUID]]) -> Segment:
+        if not self.directory:
+            terms = sorted(postings)
+            offsets, pd, pt = array("I", [0]), array("I"), array("I")
+            for t in terms:
+                pd.extend(postings[t][0])
+                pt.extend(postings[t][1])
+                offsets.append(len(pd))
+            return Segment(terms, offsets, pd, pt, docs)
+        name = f"seg-{uuid4().hex[:12]}"
+        Segment.write(self.directory, name, postings, docs)
+        return Segment.load(self.directory, name)
+
+    def merge(self, force: bool = False) -> bool:
+        """Merge all segments into one without dead postings."""
+        with self._lock:
+            if len(self.segments) < 2 or (not force and len(self.segments) <= self.max_segments):
+                return False
+            old = list(self.segments)
+            live = set(self._docs)
+        postings: Dict[str, Tuple[array, array]] = {}
+        for seg in old:  # segments hold increasing docnos, so lists stay sorted
+            for t in seg.terms:
+                docs, tfs = seg.postings(t)
+                keep = [(d, f) for d, f in zip(docs, tfs) if d in live]
+                if not keep:
+                    continue
+                lst = postings.get(t)
+                if lst is None:
+                    lst = postings[t] = (array("I"), array("I"))
+                for d, f in keep:
+                    lst[0].append(d)
+                    lst[1].append(f)
+        docs = [d for seg in old for d in seg.docs if d[0] in live]
+        merged = self._build(postings, docs)
+        with self._lock:
+            self.segments = [merged] + [s for s in self.segments if s not in old]
+            self._save_manifest()
+            idle = self._retire(old)
+        for seg in old:
+            # Mapped segments stay readable after their files are unlinked
+            if self.directory and seg.name:
+                for ext in (".seg", ".terms"):
+                    try:
+                        os.remove(os.path.join(self.directory, seg.name + ext))
+                    except OSError:
+                        pass
+        for seg in idle:
+            seg.close()
+        return True
+
+    def _retire(self, segments: List[Segment]) -> List[Segment]:
+        # Under the lock: the segments no query holds can be closed now
+        for seg in segments:
+            seg.retired = True
+        return [seg for seg in segments if seg.refs == 0]
+
+    def close(self) -> None:
+        with self._lock:
+            idle = self._retire(self.segments)
+            self.segments = []
+        for seg in idle:
+            seg.close()
+
+    # -- reads -----------------------------------------------------------
+
+    _frozen: Optional[Tuple[Dict[str, Tuple[array, array]], List]] = None
+
+    def _acquire(self, terms: List[str]) -> Tuple[List[Segment], Dict[str, List[Tuple[array, array]]], int, int]:
+        """Referenced segments, copies of the buffered postings for ``terms``
+        and the collection size, all as of one moment."""
+        with self._lock:
+            segments = list(self.segments)
+            for seg in segments:
+                seg.refs += 1
+            buffered: Dict[str, List[Tuple[array, array]]] = {t: [] for t in terms}
+            for src in ([self._frozen[0]] if self._frozen is not None else []) + [self._live]:
+                for t in terms:
+                    lst = src.get(t)
+                    if lst is not None:
+                        # add() appends to these under the lock, so copy them here
+                        buffered[t].append((lst[0][:], lst[1][:]))
+            return segments, buffered, len(self._docs), self._total_len
+
+    def _release(self, segments: List[Segment]) -> None:
+        with self._lock:
+            for seg in segments:
+                seg.refs -= 1
+            idle = [seg for seg in segments if seg.retired and seg.refs == 0]
+        for seg in idle:
+            seg.close()
+
+    def search(self, user_id: UUID, query: str, k: int = 1000) -> List[Tuple[UUID, float]]:
+        """Top ``k`` of the user's notes matching any query term, best first.
+
+        Scans every posting of the query terms, so callers on an event loop
+        should run it in a thread.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        segments, buffered, n, total_len = self._acquire(terms)
+        try:
+            if n == 0:
+                return []
+            avgdl = total_len / n
+            docs = self._docs
+            k1, b = self.k1, self.b
+            scores: Dict[int, float] = {}
+            notes: Dict[int, UUID] = {}
+            for t in terms:
+                df = 0
+                mine = []
+                for ds, fs in [seg.postings(t) for seg in segments] + buffered[t]:
+                    for d, f in zip(ds, fs):
+                        doc = docs.get(d)  # one lookup: writers may drop it meanwhile
+                        if doc is None:
+                            continue
+                        df += 1
+                        if doc[1] == user_id:
+                            mine.append((d, f, doc))
+                if not mine:
+                    continue
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                for d, f, (length, _, note) in mine:
+                    scores[d] = scores.get(d, 0.0) + idf * f * (k1 + 1) / (f + k1 * (1 - b + b * length / avgdl))
+                    notes[d] = note
+            best = heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+            return [(notes[d], score) for d, score in best]
+        finally:
+            self._release(segments)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "docs": len(self._docs),
+            "segments": len(self.segments),
+            "bufferedDocs": len(self._live_docs),
+            "terms": len(self._live) + sum(len(s.terms) for s in self.segments),
+        }
@@ -0,0 +1,455 @@
+"""Live collaboration rooms for notes.
+
+Each note with open sockets has a room. Incoming Yjs updates are buffered per
+block for ``flush_ms`` and written as one block_versions row per block, then
+fanned out to the room's other sockets through a broker. The in-process broker
+only reaches sockets on this worker; the Postgres broker relays through
+LISTEN/NOTIFY so rooms span workers.
+"""
+import asyncio
+import base64
+import json
+import logging
+import math
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID, uuid4
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from starlette.websockets import WebSocket
+
+from ..auth import CurrentUser
+from ..config import env_int
+from ..db import SessionLocal
+from ..metrics import COUNT_BUCKETS, SIZE_BUCKETS, registry
+from .blockstore import push_update
+from .crdt import decode_pool, merge_updates
+from .framing import AWARENESS, decode_frames, encode_frames
+from .pg_listen import PgListener
+
+log = logging.getLogger("vnote.collab")
+
+
+class Connection:
+    """One socket; sends go through a bounded queue so a slow reader can't stall a room."""
+
+    def __init__(self, ws: WebSocket, user: CurrentUser, note_id: UUID, queue_size: int = 256):
+        self.id = uuid4().hex
+        self.ws = ws
+        self.user = user
+        self.note_id = note_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._writer = asyncio.create_task(self._write())
+
+    async def _write(self) -> None:
+        try:
+            while True:
+                msg = await self.queue.get()
+                if msg is None:
+                    await self.ws.close(code=1013)
+                    return
+                if isinstance(msg, str):
+                    await self.ws.send_text(msg)
+                else:
+                    await self.ws.send_bytes(msg)
+        except Exception:
+            # Socket gone; the reader side notices and leaves the room
+            pass
+
+    def send(self, msg: Any) -> None:
+        try:
+            self.queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            registry.inc("vnote_ws_dropped_total")
+            # Too far behind to catch up; have the client reconnect and resync
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    async def stop(self) -> None:
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+class Room:
+    __slots__ = ("note_id", "conns", "pending", "pending_bytes", "senders", "first_at", "flush_task")
+
+    def __init__(self, note_id: UUID):
+        self.note_id = note_id
+        self.conns: Dict[str, Connection] = {}
+        self.pending: Dict[UUID, List[bytes]] = {}
+        self.pending_bytes = 0
+        self.senders: Dict[str, Connection] = {}
+        self.first_at = 0.0
+        self.flush_task: Optional[asyncio.Task] = None
+
+
+class InProcessBroker:
+    """Delivers only to sockets on this worker."""
+
+    def __init__(self) -> None:
+        self.hub: Optional["CollabHub"] = None
+
+    async def start(self, hub: "CollabHub") -> None:
+        self.hub = hub
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, note_id: UUID, data: bytes, origin: str, sent_at: float, versions: List[Tuple[UUID, int]]) -> None:
+        if self.hub is not None:
+            self.hub.deliver(note_id, data, origin, sent_at)
+
+    async def publish_awareness(self, note_id: UUID, data: bytes, origin: str) -> None:
+        await self.publish(note_id, data, origin, time.time(), [])
+
+
+class PostgresBroker(InProcessBroker):
+    """Delivers locally, then NOTIFYs other workers.
+
+    NOTIFY payloads are capped at 8000 bytes, so larger updates are sent as
+    (block, version) references and receivers read the rows back. Awareness
+    is relayed at most once per room every ``awareness_ms``, carrying each
+    socket's latest state, so cursor chatter doesn't cost a NOTIFY per frame.
+    """
+
+    CHANNEL = "vnote_collab"
+    MAX_INLINE = 6000
+
+    def __init__(self, session_factory: async_sessionmaker = SessionLocal, awareness_ms: int = 50) -> None:
+        super().__init__()
+        self.session_factory = session_factory
+        self.awareness_delay = awareness_ms / 1000.0
+        self.worker = uuid4().hex
+        self.listener = PgListener("collab")
+        self.listener.on_reconnect.append(self._resync)
+        self._awareness: Dict[UUID, Dict[str, bytes]] = {}
+        self._awareness_task: Optional[asyncio.Task] = None
+
+    async def start(self, hub: "CollabHub") -> None:
+        await super().start(hub)
+        await self.listener.listen(self.CHANNEL, self._on_notify)
+        await self.listener.start()
+
+    async def stop(self) -> None:
+        if self._awareness_task is not None:
+            await self._awareness_task
+        await self.listener.stop()
+
+    def _resync(self) -> None:
+        # Updates relayed while we weren't listening never reached our
+        # sockets; closing them makes clients reconnect and resync
+        if self.hub is None:
+            return
+        for room in self.hub.rooms.values():
+            for conn in room.conns.values():
+                conn.send(None)
+
+    async def publish(self, note_id: UUID, data: bytes, origin: str, sent_at: float, versions: List[Tuple[UUID, int]]) -> None:
+        await super().publish(note_id, data, origin, sent_at, versions)
+        msg: Dict[str, Any] = {"w": self.worker, "n": str(note_id), "o": origin, "t": sent_at}
+        encoded = base64.b64encode(data).decode("ascii")
+        if len(encoded) <= self.MAX_INLINE:
+            msg["d"] = encoded
+        elif versions:
+            msg["v"] = [[str(b), v] for b, v in versions]
+        else:
+            return  # oversized awareness: local sockets only
+        await self._notify([json.dumps(msg)])
+
+    async def publish_awareness(self, note_id: UUID, data: bytes, origin: str) -> None:
+        if self.hub is not None:
+            self.hub.deliver(note_id, data, origin, time.time())
+        # A socket's newer awareness supersedes what it sent earlier in the tick
+        self._awareness.setdefault(note_id, {})[origin] = data
+        if self._awareness_task is None:
+            self._awareness_task = asyncio.create_task(self._flush_awareness())
+
+    async def _flush_awareness(self) -> None:
+        try:
+            await asyncio.sleep(self.awareness_delay)
+            pending, self._awareness = self._awareness, {}
+            now = time.time()
+            msgs: List[str] = []
+            for note_id, by_origin in pending.items():
+                batch: List[Any] = []
+                size = 0
+                for data in by_origin.values():
+                    frames = decode_frames(data)
+                    n = len(base64.b64encode(data))
+                    if n > self.MAX_INLINE:
+                        continue  # oversized awareness: local sockets only
+                    if batch and size + n > self.MAX_INLINE:
+                        msgs.append(self._awareness_msg(note_id, batch, now))
+                        batch, size = [], 0
+                    batch.extend(frames)
+                    size += n
+                if batch:
+                    msgs.append(self._awareness_msg(note_id, batch, now))
+            if msgs:
+                await self._notify(msgs)
+        except Exception as e:
+            log.warning("collab awareness relay failed: %s", e)
+        finally:
+            self._awareness_task = None
+            if self._awareness:
+                self._awareness_task = asyncio.create_task(self._flush_awareness())
+
+    def _awareness_msg(self, note_id: UUID, frames: List[Any], sent_at: float) -> str:
+        # Sockets on other workers never include the origin, so none is needed
+        data = base64.b64encode(encode_frames(frames)).decode("ascii")
+        return json.dumps({"w": self.worker, "n": str(note_id), "o": "", "t": sent_at, "d": data})
+
+    async def _notify(self, msgs: List[str]) -> None:
+        async with self.session_factory() as session:
+            await session.execute(
+                text("SELECT pg_notify(:ch, m) FROM unnest(CAST(:msgs AS text[])) AS m"), {"ch": self.CHANNEL, "msgs": msgs}
+            )
+            await session.commit()
+
+    def _on_notify(self, conn: Any, pid: int, channel: str, payload: str) -> None:
+        try:
+            msg = json.loads(payload)
+        except ValueError:
+            return
+        if msg.get("w") == self.worker or self.hub is None:
+            return
+        note_id = UUID(msg["n"])
+        if not self.hub.has_room(note_id):
+            return
+        if "d" in msg:
+            self.hub.deliver(note_id, base64.b64decode(msg["d"]), msg.get("o", ""), msg.get("t", time.time()))
+        else:
+            asyncio.get_running_loop().create_task(self._deliver_refs(note_id, msg))
+
+    async def _deliver_refs(self, note_id: UUID, msg: Dict[str, Any]) -> None:
+        refs = msg.get("v") or []
+        async with self.session_factory() as session:
+            res = await session.execute(
+                text(
+                    """
+                    SELECT v.block_id, v.ydoc_snapshot FROM block_versions v
+                    JOIN unnest(CAST(:ids AS uuid[]), CAST(:vers AS bigint[])) AS t(id, ver)
+                      ON v.block_id = t.id AND v.version = t.ver
+                    """
+                ),
+                {"ids": [UUID(b) for b, _ in refs], "vers": [int(v) for _, v in refs]},
+            )
+            frames = [(r.block_id, 0, bytes(r.ydoc_snapshot)) for r in res]
+        if frames and self.hub is not None:
+            self.hub.deliver(note_id, encode_frames(frames), msg.get("o", ""), msg.get("t", time.time()))
+
+
+class CollabHub:
+    def __init__(
+        self,
+        broker: InProcessBroker,
+        session_factory: async_sessionmaker = SessionLocal,
+        flush_ms: int = 20,
+        max_pending_bytes: int = 1024 * 1024,
+        queue_size: int = 256,
+        max_message_bytes: int = 2 * 1024 * 1024,
+    ):
+        self.broker = broker
+        self.session_factory = session_factory
+        self.flush_delay = flush_ms / 1000.0
+        self.max_pending_bytes = max_pending_bytes
+        self.queue_size = queue_size
+        self.max_message_bytes = max_message_bytes
+        self.rooms: Dict[UUID, Room] = {}
+        self._budget: Optional[Tuple[Any, Any]] = None
+
+    def limit_updates(self, store: Any, rule: Any, max_message_bytes: int) -> None:
+        """Charge each update frame one token of ``rule``'s bucket in ``store``
+        (see ``middleware.RateLimitMiddleware``) and cap message size, so
+        sockets get the same limits as POST /blocks/:id/crdt."""
+        self._budget = (store, rule)
+        self.max_message_bytes = max_message_bytes
+
+    async def _charge(self, conn: Connection) -> float:
+        # Same key the HTTP limiter uses, so both paths spend one budget
+        store, rule = self._budget
+        if rule.scope == "user":
+            ident = "u:" + conn.user.id
+        else:
+            client = getattr(conn.ws, "client", None)
+            ident = "ip:" + (client[0] if client else "anon")
+        key = rule.name + "|" + ident
+        now = time.time()
+        wait = store.take(key, rule.refill_per_sec, rule.burst, now, blocking=False)
+        if wait is None:
+            wait = await asyncio.to_thread(store.take, key, rule.refill_per_sec, rule.burst, now)
+        return wait
+
+    async def start(self) -> None:
+        await self.broker.start(self)
+
+    async def stop(self) -> None:
+        for room in list(self.rooms.values()):
+            if room.flush_task is not None:
+                await room.flush_task
+        await self.broker.stop()
+
+    def connections(self) -> int:
+        return sum(len(r.conns) for r in self.rooms.values())
+
+    def has_room(self, note_id: UUID) -> bool:
+        return note_id in self.rooms
+
+    def join(self, ws: WebSocket, user: CurrentUser, note_id: UUID) -> Connection:
+        conn = Connection(ws, user, note_id, self.queue_size)
+        room = self.rooms.get(note_id)
+        if room is None:
+            room = self.rooms[note_id] = Room(note_id)
+        room.conns[conn.id] = conn
+        conn.start()
+        return conn
+
+    async def leave(self, conn: Connection) -> None:
+        await conn.stop()
+        room = self.rooms.get(conn.note_id)
+        if room is None:
+            return
+        room.conns.pop(conn.id, None)
+        if not room.conns and room.flush_task is None and not room.pending:
+            self.rooms.pop(conn.note_id, None)
+
+    async def receive(self, conn: Connection, data: bytes) -> None:
+        if len(data) > self.max_message_bytes:
+            registry.inc("vnote_ws_rejected_total", reason="too_large")
+            conn.send(json.dumps({"type": "error", "detail": "Message too large"}))
+            return
+        try:
+            frames = decode_frames(data)
+        except ValueError as e:
+            conn.send(json.dumps({"type": "error", "detail": f"Invalid frames: {e}"}))
+            return
+        room = self.rooms[conn.note_id]
+        awareness = [f for f in frames if f[1] & AWARENESS]
+        if awareness:
+            registry.inc("vnote_ws_messages_total", float(len(awareness)), direction="in", kind="awareness")
+            await self.broker.publish_awareness(conn.note_id, encode_frames(awareness), conn.id)
+        for block_id, flags, payload in frames:
+            if flags & AWARENESS or not payload:
+                continue
+            if self._budget is not None:
+                wait = await self._charge(conn)
+                if wait > 0:
+                    # This and the message's later updates are dropped and
+                    # reported to the sender
+                    registry.inc("vnote_ws_rejected_total", reason="rate_limited")
+                    conn.send(json.dumps({"type": "error", "detail": "rate limit exceeded", "retryAfter": max(1, math.ceil(wait))}))
+                    break
+            registry.inc("vnote_ws_messages_total", direction="in", kind="update")
+            if not room.pending:
+                room.first_at = time.time()
+            room.pending.setdefault(block_id, []).append(payload)
+            room.pending_bytes += len(payload)
+            room.senders[conn.id] = conn
+        if room.pending and room.flush_task is None:
+            room.flush_task = asyncio.create_task(self._flush_later(room))
+
+    async def _flush_later(self, room: Room) -> None:
+        try:
+            deadline = time.monotonic() + self.flush_delay
+            while room.pending_bytes < self.max_pending_bytes and time.monotonic() < deadline:
+                await asyncio.sleep(min(0.005, self.flush_delay))
+            await self.flush(room)
+        finally:
+            room.flush_task = None
+            if room.pending:
+                room.flush_task = asyncio.create_task(self._flush_later(room))
+            elif not room.conns:
+                self.rooms.pop(room.note_id, None)
+
+    async def flush(self, room: Room) -> None:
+        pending, senders, first_at = room.pending, room.senders, room.first_at
+        room.pending, room.senders, room.pending_bytes = {}, {}, 0
+        if not pending:
+            return
+        registry.histogram("vnote_ws_batch_updates", COUNT_BUCKETS).observe(float(sum(len(u) for u in pending.values())))
+        user = next(iter(senders.values())).user
+        written: List[Tuple[UUID, bytes, int]] = []
+        errors: Dict[str, str] = {}
+        async with self.session_factory() as session:
+            for block_id, updates in pending.items():
+                try:
+                    async with session.begin_nested():
+                        if len(updates) == 1:
+                            merged = updates[0]
+                        else:
+                            merged, _ = await decode_pool.run(merge_updates, updates, size=sum(len(u) for u in updates))
+                        out = await push_update(session, block_id, user.uid, merged, note_id=room.note_id)
+                    written.append((block_id, merged, out["version"]))
+                except HTTPException as e:
+                    errors[str(block_id)] = str(e.detail)
+                except ValueError:
+                    errors[str(block_id)] = "Invalid Yjs update"
+                except Exception as e:
+                    log.warning("collab flush for block %s failed: %s", block_id, e)
+                    errors[str(block_id)] = "Write failed, resync"
+            await session.commit()
+        registry.histogram("vnote_ws_batch_bytes", SIZE_BUCKETS).observe(float(sum(len(m) for _, m, _ in written)))
+        ack = json.dumps(
+            {"type": "ack", "versions": {str(b): v for b, _, v in written}, **({"errors": errors} if errors else {})}
+        )
+        for conn in senders.values():
+            conn.send(ack)
+        if written:
+            # With a single sender it already has the update; otherwise everyone gets the merge
+            origin = next(iter(senders)) if len(senders) == 1 else ""
+            data = encode_frames([(b, 0, m) for b, m, _ in written])
+            await self.broker.publish(room.note_id, data, origin, first_at, [(b, v) for b, _, v in written])
+
+    async def publish_update(self, note_id: UUID, block_id: UUID, payload: bytes, version: int) -> None:
+        """Fan out an update committed outside a socket (e.g. HTTP push)."""
+        await self.broker.publish(note_id, encode_frames([(block_id, 0, payload)]), "", time.time(), [(block_id, version)])
+
+    def deliver(self, note_id: UUID, data: bytes, origin: str, sent_at: float) -> None:
+        room = self.rooms.get(note_id)
+        if room is None:
+            return
+        n = 0
+        for cid, conn in room.conns.items():
+            if cid != origin:
+                conn.send(data)
+                n += 1
+        registry.inc("vnote_ws_messages_total", float(n), direction="out", kind="fanout")
+        registry.histogram("vnote_ws_fanout_seconds").observe(max(0.0, time.time() - sent_at))
+
+
+def _make_broker() -> InProcessBroker:
+    kind = os.getenv("COLLAB_BROKER", "memory").strip().lower()
+    if kind == "postgres":
+        return PostgresBroker(awareness_ms=env_int("COLLAB_AWARENESS_MS", 50))
+    return InProcessBroker()
+
+
+collab_hub = CollabHub(
+    _make_broker(),
+    flush_ms=env_int("COLLAB_FLUSH_MS", 20),
+    max_pending_bytes=env_int("COLLAB_MAX_PENDING_BYTES", 1024 * 1024),
+    queue_size=env_int("COLLAB_SEND_QUEUE", 256),
+)
+
+registry.describe("vnote_ws_messages_total", "WebSocket frames received and fanned out")
+registry.describe("vnote_ws_batch_updates", "Yjs updates folded into one flush")
+registry.describe("vnote_ws_batch_bytes", "Bytes written per flush")
+registry.describe("vnote_ws_fanout_seconds", "Time from first buffered update to delivery to subscribers")
+registry.describe("vnote_ws_dropped_total", "Sockets dropped for falling behind")
+registry.describe("vnote_ws_rejected_total", "WebSocket messages or update frames refused, by reason")
+registry.gauge(
+    "vnote_ws_connections",
+    lambda: {(("stat", "connections"),): float(collab_hub.connections()), (("stat", "rooms"),): float(len(collab_hub.rooms))},
+    help="Open collaboration sockets (and rooms) on this worker",
+)
@@ -1,9 +1,20 @@
 from __future__ import annotations
 
-from typing import Any
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, List, Optional, Tuple
+
+from ..config import env_int
+from ..metrics import registry
+
+log = logging.getLogger("vnote.crdt")
 
 try:
-    from y_py import YDoc
+    from y_py import YDoc, apply_update, encode_state_as_update, encode_state_vector
 except Exception:  # pragma: no cover
     YDoc = None  # type: ignore
 
@@ -25,13 +36,13 @@ def _collect_text(node: Any) -> str:
     return " ".join([t for t in txt if t])
 
 
-def decode_prosemirror_text_from_update(update: bytes) -> str:
-    if YDoc is None:
-        return ""
+def _decode_text(*updates: bytes) -> str:
+    # Runs in pool workers too, so it must not touch parent-process state
     try:
         with YDoc() as ydoc:
             with ydoc.begin_transaction() as txn:  # type: ignore
-                ydoc.apply_update(update)
+                for update in updates:
+                    ydoc.apply_update(update)
                 frag = ydoc.get_xml_fragment("prosemirror")
                 try:
                     data = frag.to_json(txn)  # type: ignore
@@ -41,3 +52,147 @@ def decode_prosemirror_text_from_update(update: bytes) -> str:
     except Exception:
         return ""
 
+
+def merge_updates(updates: List[bytes]) -> Tuple[bytes, bytes]:
+    """Fold Yjs updates (oldest first) into one state update and its state vector.
+
+    Raises ValueError for a payload y-py can't apply.
+    """
+    doc = YDoc()
+    for i, u in enumerate(updates):
+        try:
+            apply_update(doc, u)
+        except Exception as e:
+            # y-py exceptions don't pickle back from pool workers
+            raise ValueError(f"update {i}: {e}") from None
+    return encode_state_as_update(doc), encode_state_vector(doc)
+
+
+def diff_updates(items: List[Tuple[bytes, Optional[bytes]]]) -> List[bytes]:
+    """For each (state, peer state vector), the update the peer is missing.
+
+    A None vector means the peer has nothing, so the whole state is returned.
+    Raises ValueError for a vector y-py can't decode.
+    """
+    out = []
+    for state, sv in items:
+        if sv is None:
+            out.append(state)
+            continue
+        doc = YDoc()
+        apply_update(doc, state)
+        try:
+            out.append(encode_state_as_update(doc, sv))
+        except Exception as e:
+            raise ValueError(f"state vector: {e}") from None
+    return out
+
+
+def decode_prosemirror_text_from_update(update: bytes) -> str:
+    if YDoc is None:
+        return ""
+    registry.inc("vnote_crdt_decodes_total")
+    return _decode_text(update)
+
+
+class DecodePool:
+    """Process pool for y-py decodes that are too big to run on the event loop.
+
+    Payloads under ``inline_bytes`` are decoded in-process; those over
+    ``max_bytes`` are not decoded at all. At most ``workers`` calls are in the
+    pool at once and ``timeout`` only starts when a call gets a slot, so a
+    backlog doesn't time out calls that never ran. A call that exceeds it or
+    kills its worker raises, and the pool is torn down and recreated on the
+    next call, so a poison payload costs one decode slot, not the API.
+    """
+
+    def __init__(self, workers: int = 2, inline_bytes: int = 16 * 1024, max_bytes: int = 8 * 1024 * 1024, timeout: float = 5.0):
+        self.workers = workers
+        self.inline_bytes = inline_bytes
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = None
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots[0] is not loop:
+            self._slots = (loop, asyncio.Semaphore(self.workers))
+        return self._slots[1]
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: forking a process that owns threads and an event loop is unsafe
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def _reset(self) -> None:
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        # A hung worker ignores shutdown(); terminate it so it can't pile up
+        procs = list(getattr(pool, "_processes", {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+
+    async def run(self, fn: Callable[..., Any], *args: Any, size: int) -> Any:
+        """Call ``fn(*args)`` inline or in the pool depending on ``size``.
+
+        Raises ``asyncio.TimeoutError`` or ``BrokenProcessPool`` after resetting
+        the pool; exceptions raised by ``fn`` itself propagate unchanged.
+        """
+        if self.workers <= 0 or size < self.inline_bytes:
+            start = time.perf_counter()
+            out = fn(*args)
+            registry.histogram("vnote_crdt_decode_seconds", path="inline").observe(time.perf_counter() - start)
+            return out
+        loop = asyncio.get_running_loop()
+        async with self._semaphore():
+            pool = self._get_pool()
+            start = time.perf_counter()
+            try:
+                fut = loop.run_in_executor(pool, fn, *args)
+                out = await asyncio.wait_for(fut, timeout=self.timeout)
+            except (asyncio.TimeoutError, BrokenProcessPool) as e:
+                # Calls that were running alongside one that reset the pool
+                # fail too, but must not tear down its replacement
+                if pool is self._pool:
+                    timed_out = isinstance(e, asyncio.TimeoutError)
+                    registry.inc("vnote_crdt_decode_pool_total", result="timeout" if timed_out else "crashed")
+                    log.warning(
+                        "crdt %s of %d bytes %s; restarting pool",
+                        fn.__name__, size, "timed out" if timed_out else "crashed a worker",
+                    )
+                    self._reset()
+                raise
+        registry.inc("vnote_crdt_decode_pool_total", result="ok")
+        registry.histogram("vnote_crdt_decode_seconds", path="pool").observe(time.perf_counter() - start)
+        return out
+
+    async def decode(self, *updates: bytes) -> str:
+        """Plain text of a block's state, or of the updates that make it up
+        applied in order; raises like ``run`` if the pool fails.
+
+        A failed decode is not the block's text, so callers must not cache it.
+        """
+        if YDoc is None:
+            return ""
+        size = sum(len(u) for u in updates)
+        if size > self.max_bytes:
+            registry.inc("vnote_crdt_decode_pool_total", result="too_large")
+            return ""
+        registry.inc("vnote_crdt_decodes_total")
+        return await self.run(_decode_text, *(bytes(u) for u in updates), size=size)
+
+    def shutdown(self) -> None:
+        self._reset()
+
+
+decode_pool = DecodePool(
+    workers=env_int("CRDT_DECODE_WORKERS", 2),
+    inline_bytes=env_int("CRDT_DECODE_INLINE_BYTES", 16 * 1024),
+    max_bytes=env_int("CRDT_DECODE_MAX_BYTES", 8 * 1024 * 1024),
+    timeout=float(env_int("CRDT_DECODE_TIMEOUT_MS", 5000)) / 1000.0,
+)
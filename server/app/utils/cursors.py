@@ -0,0 +1,24 @@
+import base64
+import json
+from typing import Any, List
+
+from fastapi import HTTPException
+
+
+# Opaque pagination cursors: the keyset values of the last row, JSON-encoded.
+
+
+def encode_cursor(*values: Any) -> str:
+    raw = json.dumps([v if isinstance(v, (int, float, str)) or v is None else str(v) for v in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, arity: int) -> List[Any]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != arity:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
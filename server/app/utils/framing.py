@@ -0,0 +1,49 @@
+"""Length-prefixed binary frames for per-block CRDT payloads.
+
+A message is ``b"VNB1"`` followed by frames of ``<16s B I``: block id bytes,
+flags, payload length, then the payload itself.
+"""
+import struct
+from typing import Iterable, List, Tuple
+from uuid import UUID
+
+MAGIC = b"VNB1"
+_HEAD = struct.Struct("<16sBI")
+
+# Frame flags
+FULL = 0x01  # payload is the whole state, not a diff
+DELETED = 0x02  # block no longer exists; empty payload
+AWARENESS = 0x04  # websocket only: opaque awareness payload, relayed, never stored
+
+Frame = Tuple[UUID, int, bytes]
+
+
+def encode_frames(frames: Iterable[Frame]) -> bytes:
+    parts = [MAGIC]
+    for block_id, flags, payload in frames:
+        parts.append(_HEAD.pack(block_id.bytes, flags, len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def decode_frames(data: bytes, max_frames: int = 100_000) -> List[Frame]:
+    """Parse a framed message; raises ValueError if it is truncated or malformed."""
+    if not data:
+        return []
+    if data[:4] != MAGIC:
+        raise ValueError("bad magic")
+    out: List[Frame] = []
+    pos = 4
+    view = memoryview(data)
+    while pos < len(data):
+        if len(data) - pos < _HEAD.size:
+            raise ValueError("truncated frame header")
+        raw_id, flags, size = _HEAD.unpack_from(data, pos)
+        pos += _HEAD.size
+        if len(data) - pos < size:
+            raise ValueError("truncated frame payload")
+        out.append((UUID(bytes=raw_id), flags, bytes(view[pos:pos + size])))
+        pos += size
+        if len(out) > max_frames:
+            raise ValueError("too many frames")
+    return out
@@ -0,0 +1,375 @@
+"""Per-user link graph held in memory as integer-indexed CSR arrays.
+
+Built lazily from ``links`` the first time a user's graph is read, then kept
+current by the writes of this process: ``rebuild_links_for_notes`` and the
+note routers record their changes on the session, and they are applied when
+it commits. The commit also NOTIFYs ``vnote_graph``, and other processes drop
+that user's graph when they hear it; every graph expires after ``ttl`` seconds.
+"""
+import asyncio
+import logging
+import os
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from uuid import UUID, uuid4
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from ..config import env_float, env_int
+from ..db import PGBOUNCER
+from ..metrics import registry
+from .pg_listen import PgListener
+
+log = logging.getLogger("vnote.graph")
+
+CHANNEL = "vnote_graph"
+_NOTIFY_MAX = 7000  # NOTIFY payloads are capped at 8000 bytes
+_PENDING = "graph_index_ops"
+_EMPTY = array("I")
+
+_NODES = text("SELECT id, title FROM notes WHERE user_id = :uid AND deleted_at IS NULL")
+# Destinations are checked against the node set, so one join is enough
+_EDGES = text(
+    """
+    SELECT l.src_note_id AS src, l.dst_note_id AS dst
+    FROM links l JOIN notes s ON s.id = l.src_note_id
+    WHERE s.user_id = :uid AND s.deleted_at IS NULL
+    """
+)
+
+
+def _csr(n: int, edges: Sequence[Tuple[int, int]], key: int) -> Tuple[array, array]:
+    offsets = array("I", bytes(4 * (n + 1)))
+    for e in edges:
+        offsets[e[key] + 1] += 1
+    for i in range(n):
+        offsets[i + 1] += offsets[i]
+    adj = array("I", bytes(4 * len(edges)))
+    fill = array("I", offsets)
+    other = 1 - key
+    for e in edges:
+        adj[fill[e[key]]] = e[other]
+        fill[e[key]] += 1
+    return offsets, adj
+
+
+class LinkGraph:
+    """Directed link graph over one user's live notes.
+
+    Out- and in-edges are stored CSR-style (an offsets array plus a flat
+    adjacency array). Incremental changes replace whole rows in small
+    overlay dicts; once those grow past a fraction of the graph it is
+    repacked. Deleted notes are only flagged dead until the next repack.
+    """
+
+    def __init__(self, ids: Sequence[UUID], titles: Sequence[str], edges: Iterable[Tuple[int, int]]):
+        self.ids: List[UUID] = list(ids)
+        self.titles: List[str] = list(titles)
+        self.index: Dict[UUID, int] = {nid: i for i, nid in enumerate(self.ids)}
+        self._pack(sorted({(s, t) for s, t in edges if s != t}))
+
+    def _pack(self, edges: Sequence[Tuple[int, int]]) -> None:
+        self._n = len(self.ids)
+        self.alive = bytearray(b"\x01") * self._n
+        self.out_offsets, self.out_adj = _csr(self._n, edges, 0)
+        self.in_offsets, self.in_adj = _csr(self._n, edges, 1)
+        self._out: Dict[int, array] = {}
+        self._in: Dict[int, array] = {}
+
+    def out(self, i: int) -> array:
+        row = self._out.get(i)
+        if row is not None:
+            return row
+        if i >= self._n:
+            return _EMPTY
+        return self.out_adj[self.out_offsets[i] : self.out_offsets[i + 1]]
+
+    def inbound(self, i: int) -> array:
+        row = self._in.get(i)
+        if row is not None:
+            return row
+        if i >= self._n:
+            return _EMPTY
+        return self.in_adj[self.in_offsets[i] : self.in_offsets[i + 1]]
+
+    def degree(self, i: int) -> int:
+        return len(self.out(i)) + len(self.inbound(i))
+
+    @property
+    def nodes(self) -> int:
+        return sum(self.alive)
+
+    def nbytes(self) -> int:
+        rows = sum(len(r) for r in self._out.values()) + sum(len(r) for r in self._in.values())
+        arrays = len(self.out_offsets) + len(self.out_adj) + len(self.in_offsets) + len(self.in_adj)
+        return 4 * (arrays + rows) + 120 * len(self.ids) + sum(len(t) for t in self.titles)
+
+    def upsert_node(self, nid: UUID, title: str) -> int:
+        i = self.index.get(nid)
+        if i is None:
+            i = self.index[nid] = len(self.ids)
+            self.ids.append(nid)
+            self.titles.append(title)
+            self.alive.append(1)
+        else:
+            self.titles[i] = title
+            self.alive[i] = 1
+        return i
+
+    def remove_node(self, nid: UUID) -> None:
+        i = self.index.get(nid)
+        if i is not None:
+            self.alive[i] = 0
+
+    def set_out(self, nid: UUID, targets: Iterable[UUID]) -> None:
+        """Replace the outgoing edges of ``nid``; unknown targets are ignored."""
+        i = self.index.get(nid)
+        if i is None:
+            return
+        new = {self.index[t] for t in targets if t in self.index} - {i}
+        old = set(self.out(i))
+        if new == old:
+            return
+        self._out[i] = array("I", sorted(new))
+        for t in old - new:
+            self._in[t] = array("I", (s for s in self.inbound(t) if s != i))
+        for t in new - old:
+            row = array("I", self.inbound(t))
+            row.append(i)
+            self._in[t] = row
+        if len(self._out) + len(self._in) > max(256, len(self.ids) // 4):
+            self.repack()
+
+    def repack(self) -> None:
+        """Fold the overlays back into fresh arrays, dropping dead nodes."""
+        live = [i for i in range(len(self.ids)) if self.alive[i]]
+        remap = {old: new for new, old in enumerate(live)}
+        edges = [(remap[s], remap[t]) for s in live for t in self.out(s) if t in remap]
+        self.ids = [self.ids[i] for i in live]
+        self.titles = [self.titles[i] for i in live]
+        self.index = {nid: i for i, nid in enumerate(self.ids)}
+        self._pack(sorted(edges))
+
+    def neighborhood(
+        self, root: int, depth: int, max_nodes: int, max_degree: int
+    ) -> Tuple[Dict[int, int], List[Tuple[int, int]], List[int], bool]:
+        """Breadth-first k-hop subgraph around ``root``, following links both ways.
+
+        Nodes with more than ``max_degree`` links are included but not
+        expanded (the root always is), so a hub doesn't pull in half the
+        vault. Returns hop distance per node, the induced edges, the hubs
+        left unexpanded and whether ``max_nodes`` cut the walk short.
+        """
+        hops = {root: 0}
+        frontier = [root]
+        collapsed: List[int] = []
+        truncated = False
+        for d in range(1, depth + 1):
+            nxt = []
+            for u in frontier:
+                if u != root and self.degree(u) > max_degree:
+                    collapsed.append(u)
+                    continue
+                for row in (self.out(u), self.inbound(u)):
+                    for v in row:
+                        if v in hops or not self.alive[v]:
+                            continue
+                        if len(hops) >= max_nodes:
+                            truncated = True
+                            break
+                        hops[v] = d
+                        nxt.append(v)
+                if truncated:
+                    break
+            frontier = nxt
+            if truncated or not frontier:
+                break
+        edges = [(u, v) for u in hops for v in self.out(u) if v in hops]
+        return hops, edges, collapsed, truncated
+
+
+class GraphIndex:
+    """LRU of ``LinkGraph`` per user, at most ``max_users`` of them."""
+
+    def __init__(self, max_users: int = 1000, ttl: float = 600.0, listen_url: Optional[str] = None):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.worker = uuid4().hex
+        self.listener = PgListener("graph", listen_url)
+        # NOTIFYs sent while the connection was down are lost
+        self.listener.on_reconnect.append(lambda: self.drop(None))
+        self.hits = 0
+        self.builds = 0
+        self.build_seconds = 0.0
+        self._graphs: "OrderedDict[str, Tuple[LinkGraph, float]]" = OrderedDict()
+        # Bumped on every change or drop, so a build that raced a write isn't cached
+        self._versions: Dict[str, int] = {}
+        self._building: Dict[str, "asyncio.Future[LinkGraph]"] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_users > 0
+
+    def cached(self, user_id: str) -> Optional[LinkGraph]:
+        entry = self._graphs.get(user_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            self.drop([user_id])
+            return None
+        self._graphs.move_to_end(user_id)
+        return entry[0]
+
+    async def get(self, session: AsyncSession, user_id: str) -> LinkGraph:
+        graph = self.cached(user_id)
+        if graph is not None:
+            self.hits += 1
+            return graph
+        pending = self._building.get(user_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        fut: "asyncio.Future[LinkGraph]" = asyncio.get_running_loop().create_future()
+        self._building[user_id] = fut
+        try:
+            graph = await self._build(session, user_id)
+            fut.set_result(graph)
+            return graph
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # retrieved: waiters re-raise it, no one else needs to
+            raise
+        finally:
+            self._building.pop(user_id, None)
+
+    async def _build(self, session: AsyncSession, user_id: str) -> LinkGraph:
+        version = self._versions.get(user_id, 0)
+        start = time.perf_counter()
+        uid = UUID(user_id)
+        nodes = (await session.execute(_NODES, {"uid": uid})).fetchall()
+        ids = [r.id for r in nodes]
+        index = {nid: i for i, nid in enumerate(ids)}
+        res = await session.execute(_EDGES, {"uid": uid})
+        edges = [(index[r.src], index[r.dst]) for r in res if r.src in index and r.dst in index]
+        graph = LinkGraph(ids, [r.title for r in nodes], edges)
+        self.builds += 1
+        self.build_seconds += time.perf_counter() - start
+        if self.enabled and self._versions.get(user_id, 0) == version:
+            self._graphs[user_id] = (graph, time.monotonic() + self.ttl)
+            while len(self._graphs) > self.max_users:
+                self._graphs.popitem(last=False)
+        return graph
+
+    async def start(self) -> None:
+        # Cached graphs are only safe while other processes' writes are heard
+        if not self.enabled or self.listener.connected:
+            return
+        if PGBOUNCER and not self.listener.url:
+            log.warning("graph cache disabled: DB_PGBOUNCER needs GRAPH_CACHE_LISTEN_URL for LISTEN")
+            self.max_users = 0
+            return
+        try:
+            await self.listener.listen(CHANNEL, self._on_notify)
+            await self.listener.start()
+        except Exception as e:
+            log.warning("graph cache disabled, cannot LISTEN: %s", e)
+            self.max_users = 0
+            await self.stop()
+
+    async def stop(self) -> None:
+        await self.listener.stop()
+
+    def _on_notify(self, conn: Any, pid: int, channel: str, payload: str) -> None:
+        origin, _, users = payload.partition("|")
+        if origin != self.worker:
+            self.drop(None if users == "*" else [u for u in users.split(",") if u])
+
+    def drop(self, user_ids: Optional[Iterable[str]]) -> None:
+        if user_ids is None:
+            user_ids = list(self._graphs)
+        for uid in user_ids:
+            self._graphs.pop(uid, None)
+            self._versions[uid] = self._versions.get(uid, 0) + 1
+        if len(self._versions) > 4 * self.max_users:
+            # Only users with a build in flight need their version kept
+            self._versions = {u: v for u, v in self._versions.items() if u in self._building}
+
+    def apply(self, user_id: str, ops: Sequence[Tuple[Any, ...]]) -> None:
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+        entry = self._graphs.get(user_id)
+        if entry is None:
+            return
+        graph = entry[0]
+        for op in ops:
+            if op[0] == "node":
+                graph.upsert_node(op[1], op[2])
+            elif op[0] == "remove":
+                graph.remove_node(op[1])
+            else:
+                graph.set_out(op[1], op[2])
+
+    def stats(self) -> Dict[str, float]:
+        graphs = [g for g, _ in self._graphs.values()]
+        return {
+            "users": len(graphs),
+            "nodes": sum(len(g.ids) for g in graphs),
+            "bytes": sum(g.nbytes() for g in graphs),
+            "hits": self.hits,
+            "builds": self.builds,
+            "buildSeconds": self.build_seconds,
+        }
+
+
+def _record(session: AsyncSession, user_id: Any, op: Tuple[Any, ...]) -> None:
+    session.info.setdefault(_PENDING, {}).setdefault(str(user_id), []).append(op)
+
+
+def note_upserted(session: AsyncSession, user_id: Any, note_id: UUID, title: str) -> None:
+    """Add or rename a node once ``session`` commits."""
+    _record(session, user_id, ("node", note_id, title))
+
+
+def note_removed(session: AsyncSession, user_id: Any, note_id: UUID) -> None:
+    _record(session, user_id, ("remove", note_id))
+
+
+def links_replaced(session: AsyncSession, user_id: Any, note_id: UUID, targets: Sequence[UUID]) -> None:
+    """``note_id``'s outgoing links are now exactly ``targets`` once ``session`` commits."""
+    _record(session, user_id, ("links", note_id, targets))
+
+
+@event.listens_for(Session, "before_commit")
+def _notify_before_commit(session: Session) -> None:
+    pending = session.info.get(_PENDING)
+    if pending:
+        body = ",".join(sorted(pending))
+        msg = f"{graph_index.worker}|{body if len(body) <= _NOTIFY_MAX else '*'}"
+        session.execute(text("SELECT pg_notify(:ch, :msg)"), {"ch": CHANNEL, "msg": msg})
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_after_commit(session: Session) -> None:
+    pending = session.info.pop(_PENDING, None)
+    if pending:
+        for uid, ops in pending.items():
+            graph_index.apply(uid, ops)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_after_rollback(session: Session) -> None:
+    session.info.pop(_PENDING, None)
+
+
+graph_index = GraphIndex(
+    max_users=env_int("GRAPH_CACHE_USERS", 1000),
+    ttl=env_float("GRAPH_CACHE_TTL_SECONDS", 600.0),
+    listen_url=os.getenv("GRAPH_CACHE_LISTEN_URL") or os.getenv("SEARCH_CACHE_LISTEN_URL") or None,
+)
+registry.gauge(
+    "vnote_graph_index",
+    lambda: {(("stat", k),): float(v) for k, v in graph_index.stats().items()},
+    help="In-memory link graphs: users, nodes, estimated bytes, hits, builds and build time",
+)
@@ -0,0 +1,413 @@
+"""Force-directed graph layout, computed off the API's event loop.
+
+``compute_layout`` is a multilevel, vectorized Fruchterman-Reingold:
+attraction along edges, repulsion between all nodes approximated Barnes-Hut
+style on a grid (exact within a cell, cell centroids beyond it), and a
+little gravity so disconnected components stay on screen. It stops when it
+has cooled or when its time budget runs out, whichever comes first, and can
+warm-start from a previous layout so an edit only nudges the picture.
+
+``GraphLayouts`` runs it in a process pool and caches positions per (user,
+filter). Requests never wait for it: they get the positions known so far
+and ``layout: "pending"`` until the new ones are in.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from ..config import env_int
+from ..metrics import registry
+
+log = logging.getLogger("vnote.graph")
+
+try:
+    import numpy as np
+except Exception:  # pragma: no cover
+    np = None  # type: ignore
+
+EXACT_MAX = 300  # below this, all-pairs repulsion is cheaper than gridding
+COARSEST = 64
+_CHUNK = 1024
+_GRAVITY = 0.02
+
+
+def _exact_repulsion(x: "np.ndarray", y: "np.ndarray") -> Tuple["np.ndarray", "np.ndarray"]:
+    fx = np.empty_like(x)
+    fy = np.empty_like(y)
+    for lo in range(0, len(x), _CHUNK):
+        dx = x[lo : lo + _CHUNK, None] - x
+        dy = y[lo : lo + _CHUNK, None] - y
+        w = dx * dx
+        w += dy * dy
+        np.maximum(w, 1e-4, out=w)
+        np.reciprocal(w, out=w)
+        w[np.arange(len(w)), np.arange(lo, lo + len(w))] = 0.0
+        fx[lo : lo + _CHUNK] = (dx * w).sum(1)
+        fy[lo : lo + _CHUNK] = (dy * w).sum(1)
+    return fx, fy
+
+
+def _grid_repulsion(x: "np.ndarray", y: "np.ndarray") -> Tuple["np.ndarray", "np.ndarray"]:
+    n = len(x)
+    # ~2*sqrt(n) cells balances centroid work (n x cells) against in-cell pairs
+    g = max(2, int(math.ceil(1.5 * n ** 0.25)))
+    lo = np.array([np.percentile(x, 1), np.percentile(y, 1)])
+    hi = np.array([np.percentile(x, 99), np.percentile(y, 99)])
+    while True:
+        h = max(float((hi - lo).max()), 1e-6) / g
+        cell = np.clip(((x - lo[0]) / h).astype(np.int64), 0, g - 1) * g + np.clip(((y - lo[1]) / h).astype(np.int64), 0, g - 1)
+        counts = np.bincount(cell, minlength=g * g)
+        # Dense clusters make in-cell pairs quadratic again; split finer
+        if int((counts * counts).sum()) <= 8 * n * math.sqrt(n) or g >= 256:
+            break
+        g *= 2
+    occ = np.nonzero(counts)[0]
+    mass = counts[occ].astype(float)
+    cx = np.bincount(cell, weights=x, minlength=g * g)[occ] / mass
+    cy = np.bincount(cell, weights=y, minlength=g * g)[occ] / mass
+    fx = np.empty_like(x)
+    fy = np.empty_like(y)
+    for a in range(0, n, _CHUNK):
+        dx = x[a : a + _CHUNK, None] - cx
+        dy = y[a : a + _CHUNK, None] - cy
+        w = dx * dx
+        w += dy * dy
+        np.maximum(w, 1e-4, out=w)
+        np.divide(mass, w, out=w)
+        w[cell[a : a + _CHUNK, None] == occ] = 0.0
+        fx[a : a + _CHUNK] = (dx * w).sum(1)
+        fy[a : a + _CHUNK] = (dy * w).sum(1)
+    # Exact pairs within each cell: enumerate (i, j) over the cell-sorted order
+    order = np.argsort(cell, kind="stable")
+    starts = np.cumsum(counts) - counts
+    sc = cell[order]
+    per = counts[sc]
+    left = np.repeat(np.arange(n), per)
+    right = np.repeat(starts[sc], per) + (np.arange(len(left)) - np.repeat(np.cumsum(per) - per, per))
+    keep = left != right
+    i, j = order[left[keep]], order[right[keep]]
+    dx = x[i] - x[j]
+    dy = y[i] - y[j]
+    w = dx * dx
+    w += dy * dy
+    np.maximum(w, 1e-4, out=w)
+    np.reciprocal(w, out=w)
+    fx += np.bincount(i, weights=dx * w, minlength=n)
+    fy += np.bincount(i, weights=dy * w, minlength=n)
+    return fx, fy
+
+
+def _refine(pos: "np.ndarray", s: "np.ndarray", t: "np.ndarray", temp: float, iters: int, deadline: float) -> int:
+    """Run up to ``iters`` cooling steps in place; returns how many ran."""
+    n = len(pos)
+    x = pos[:, 0].copy()
+    y = pos[:, 1].copy()
+    repulsion = _exact_repulsion if n <= EXACT_MAX else _grid_repulsion
+    cooling = (0.01 / temp) ** (1.0 / max(iters, 1))
+    g = _GRAVITY / math.sqrt(n)
+    done = 0
+    while done < iters and time.perf_counter() < deadline:
+        fx, fy = repulsion(x, y)
+        if len(s):
+            dx = x[t] - x[s]
+            dy = y[t] - y[s]
+            d = np.sqrt(dx * dx + dy * dy)
+            dx *= d
+            dy *= d
+            fx += np.bincount(s, weights=dx, minlength=n) - np.bincount(t, weights=dx, minlength=n)
+            fy += np.bincount(s, weights=dy, minlength=n) - np.bincount(t, weights=dy, minlength=n)
+        r = np.sqrt(x * x + y * y) * g
+        fx -= x * r
+        fy -= y * r
+        length = np.maximum(np.sqrt(fx * fx + fy * fy), 1e-9)
+        step = np.minimum(length, temp) / length
+        x += fx * step
+        y += fy * step
+        temp *= cooling
+        done += 1
+    pos[:, 0] = x
+    pos[:, 1] = y
+    return done
+
+
+def _coarsen(n: int, s: "np.ndarray", t: "np.ndarray", rng: Any) -> Tuple["np.ndarray", int]:
+    """Merge the ends of a random maximal matching: cluster id per node and cluster count."""
+    cluster = [-1] * n
+    m = 0
+    for e in rng.permutation(len(s)).tolist():
+        a, b = int(s[e]), int(t[e])
+        if cluster[a] < 0 and cluster[b] < 0:
+            cluster[a] = cluster[b] = m
+            m += 1
+    for i in range(n):
+        if cluster[i] < 0:
+            cluster[i] = m
+            m += 1
+    return np.asarray(cluster, dtype=np.int64), m
+
+
+def _place_new(pos: "np.ndarray", src: "np.ndarray", dst: "np.ndarray", rng: Any) -> None:
+    """Put nodes without a position (NaN) next to their placed neighbours."""
+    new = np.isnan(pos[:, 0])
+    if not new.any():
+        return
+    placed = ~new
+    for _ in range(3):
+        s_ok = placed[src] & ~placed[dst]
+        t_ok = placed[dst] & ~placed[src]
+        tgt = np.concatenate([dst[s_ok], src[t_ok]])
+        frm = np.concatenate([src[s_ok], dst[t_ok]])
+        if not len(tgt):
+            break
+        cnt = np.bincount(tgt, minlength=len(pos))
+        sx = np.bincount(tgt, weights=pos[frm, 0], minlength=len(pos))
+        sy = np.bincount(tgt, weights=pos[frm, 1], minlength=len(pos))
+        hit = cnt > 0
+        pos[hit, 0] = sx[hit] / cnt[hit]
+        pos[hit, 1] = sy[hit] / cnt[hit]
+        pos[hit] += rng.normal(0.0, 0.3, (int(hit.sum()), 2))
+        placed |= hit
+    rest = ~placed
+    span = max(float(np.abs(pos[placed]).max()), 1.0)
+    pos[rest] = rng.uniform(-span, span, (int(rest.sum()), 2))
+
+
+def compute_layout(
+    n: int,
+    src: Sequence[int],
+    dst: Sequence[int],
+    init: Optional[Sequence[float]] = None,
+    budget: float = 2.0,
+    seed: int = 0,
+) -> Tuple[List[float], int]:
+    """Lay out ``n`` nodes joined by edges ``src[i] -> dst[i]``.
+
+    ``init`` is a flat ``x0, y0, x1, y1, ...`` list, NaN for nodes that have
+    no position yet. With at least half the nodes placed the layout starts
+    cool and only settles the changes; otherwise it is built multilevel:
+    edges are contracted down to ~COARSEST nodes, that graph is laid out
+    cold and each finer level starts from its parent's positions. Returns
+    flat coordinates (ideal edge length 1) and the number of steps run.
+    Runs in pool workers, so it must not touch parent-process state.
+    """
+    start = time.perf_counter()
+    deadline = start + budget
+    if n == 0:
+        return [], 0
+    rng = np.random.default_rng(seed)
+    s = np.asarray(src, dtype=np.int64)
+    t = np.asarray(dst, dtype=np.int64)
+    keep = s != t
+    s, t = s[keep], t[keep]
+    known = 0.0
+    if init is not None:
+        pos = np.asarray(init, dtype=float).reshape(n, 2).copy()
+        known = float((~np.isnan(pos[:, 0])).mean())
+    if known >= 0.5:
+        _place_new(pos, s, t, rng)
+        done = _refine(pos, s, t, 1.0, 60 + int(80 * (1 - known)), deadline)
+    else:
+        levels = [(n, s, t)]
+        maps = []
+        while levels[-1][0] > COARSEST and len(levels) < 30:
+            ln, ls, lt = levels[-1]
+            cluster, m = _coarsen(ln, ls, lt, rng)
+            if m > 0.85 * ln:
+                break  # stars and isolated nodes don't contract further
+            pairs = np.unique(cluster[ls] * m + cluster[lt])
+            cs, ct = pairs // m, pairs % m
+            keep = cs != ct
+            maps.append(cluster)
+            levels.append((m, cs[keep], ct[keep]))
+        ln, ls, lt = levels[-1]
+        pos = rng.uniform(-1.0, 1.0, (ln, 2)) * math.sqrt(ln)
+        # Coarse levels are cheap; keep most of the budget for the finest ones
+        done = _refine(pos, ls, lt, math.sqrt(ln) / 4 + 1.0, 300, start + budget * 0.4)
+        for level in range(len(maps) - 1, -1, -1):
+            fn, fs, ft = levels[level]
+            pos = pos[maps[level]] * math.sqrt(fn / ln) + rng.normal(0.0, 0.1, (fn, 2))
+            ln = fn
+            if level:
+                done += _refine(pos, fs, ft, 1.5, 50, start + budget * 0.6)
+            else:
+                done += _refine(pos, fs, ft, 1.5, 150, deadline)
+    pos -= pos.mean(0)
+    return [round(float(v), 3) for v in pos.ravel()], done
+
+
+class Layout:
+    __slots__ = ("signature", "positions", "pending", "computed_at", "iterations")
+
+    def __init__(self) -> None:
+        self.signature: Optional[int] = None
+        self.positions: Dict[Any, Tuple[float, float]] = {}
+        # The newest graph asked for and not laid out yet: (signature, ids, src, dst)
+        self.pending: Optional[Tuple[int, List[Any], List[int], List[int]]] = None
+        self.computed_at = 0.0
+        self.iterations = 0
+
+
+class GraphLayouts:
+    """Positions per (user, filter), recomputed in a process pool.
+
+    At most one layout per key is in flight; requests arriving meanwhile
+    only replace what it will do next. ``max_entries`` keys are kept, least
+    recently used first. ``budget`` caps one computation's time, and at most
+    ``workers`` are submitted at once, so each is timed only while it runs.
+    """
+
+    def __init__(self, workers: int = 1, budget: float = 2.0, max_nodes: int = 5000, max_entries: int = 500):
+        self.workers = workers
+        self.budget = budget
+        self.max_nodes = max_nodes
+        self.max_entries = max_entries
+        self.computed = 0
+        self.failed = 0
+        self._layouts: "OrderedDict[Hashable, Layout]" = OrderedDict()
+        self._tasks: Dict[Hashable, "asyncio.Task[None]"] = {}
+        self.running = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = None
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots[0] is not loop:
+            self._slots = (loop, asyncio.Semaphore(self.workers))
+        return self._slots[1]
+
+    @property
+    def enabled(self) -> bool:
+        return np is not None and self.workers > 0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn, as for CRDT decodes: never fork the event loop's process
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def _reset(self) -> None:
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        procs = list(getattr(pool, "_processes", {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+
+    def positions(
+        self, key: Hashable, ids: List[Any], src: List[int], dst: List[int]
+    ) -> Tuple[Dict[Any, Tuple[float, float]], str]:
+        """Known positions for this graph, and "ready", "pending" or "unavailable".
+
+        When the graph differs from the one last laid out for ``key`` a new
+        layout is scheduled, warm-started from the current positions.
+        """
+        if not self.enabled or len(ids) > self.max_nodes:
+            return {}, "unavailable"
+        signature = hash((tuple(ids), tuple(src), tuple(dst)))
+        layout = self._layouts.get(key)
+        if layout is None:
+            layout = self._layouts[key] = Layout()
+            while len(self._layouts) > self.max_entries:
+                old, _ = self._layouts.popitem(last=False)
+                task = self._tasks.pop(old, None)
+                if task is not None:
+                    task.cancel()
+        self._layouts.move_to_end(key)
+        if layout.signature == signature:
+            return layout.positions, "ready"
+        layout.pending = (signature, ids, src, dst)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.get_running_loop().create_task(self._run(key, layout))
+        return layout.positions, "pending"
+
+    async def _run(self, key: Hashable, layout: Layout) -> None:
+        try:
+            while layout.pending is not None:
+                async with self._semaphore():
+                    # Take the newest graph only once there is a worker for it
+                    signature, ids, src, dst = layout.pending
+                    layout.pending = None
+                    if signature == layout.signature:
+                        continue  # re-requested while the same graph was laid out
+                    self.running += 1
+                    try:
+                        result = await self._compute(layout, ids, src, dst)
+                    finally:
+                        self.running -= 1
+                if result is None:
+                    return
+                flat, iterations = result
+                layout.positions = {nid: (flat[2 * i], flat[2 * i + 1]) for i, nid in enumerate(ids)}
+                layout.signature = signature
+                layout.computed_at = time.time()
+                layout.iterations = iterations
+                self.computed += 1
+        finally:
+            self._tasks.pop(key, None)
+
+    async def _compute(self, layout: Layout, ids: List[Any], src: List[int], dst: List[int]) -> Optional[Tuple[List[float], int]]:
+        init = None
+        if layout.positions:
+            init = []
+            for nid in ids:
+                init.extend(layout.positions.get(nid, (math.nan, math.nan)))
+        pool = self._get_pool()
+        start = time.perf_counter()
+        fut = asyncio.get_running_loop().run_in_executor(pool, compute_layout, len(ids), src, dst, init, self.budget)
+        try:
+            # Headroom over the budget for pickling and a cold worker start
+            out = await asyncio.wait_for(fut, timeout=self.budget + 30.0)
+        except (asyncio.TimeoutError, BrokenProcessPool) as e:
+            self.failed += 1
+            # A layout running next to one that reset the pool fails too, but
+            # must not tear down its replacement
+            if pool is self._pool:
+                log.warning("graph layout of %d nodes failed (%s); restarting pool", len(ids), type(e).__name__)
+                self._reset()
+            return None
+        except Exception:
+            self.failed += 1
+            log.exception("graph layout of %d nodes failed", len(ids))
+            return None
+        registry.histogram("vnote_graph_layout_seconds").observe(time.perf_counter() - start)
+        return out
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "entries": len(self._layouts),
+            "running": self.running,
+            "queued": len(self._tasks) - self.running,
+            "computed": self.computed,
+            "failed": self.failed,
+            "enabled": float(self.enabled),
+        }
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._reset()
+
+
+graph_layouts = GraphLayouts(
+    workers=env_int("GRAPH_LAYOUT_WORKERS", 1),
+    budget=env_int("GRAPH_LAYOUT_BUDGET_MS", 2000) / 1000.0,
+    max_nodes=env_int("GRAPH_LAYOUT_MAX_NODES", 5000),
+    max_entries=env_int("GRAPH_LAYOUT_CACHE_ENTRIES", 500),
+)
+registry.gauge(
+    "vnote_graph_layouts",
+    lambda: {(("stat", k),): float(v) for k, v in graph_layouts.stats().items()},
+    help="Server-side graph layouts: cached keys, running, queued, computed, failed, enabled",
+)
@@ -0,0 +1,42 @@
+from typing import Any, Iterable, List, Optional
+from uuid import UUID
+
+from fastapi import HTTPException
+
+
+# Primary keys are compared against native uuid binds, never `id::text = :id`,
+# so Postgres can use the btree/PK indexes. Path ids are typed as UUID on the
+# routes (FastAPI answers 422 for garbage); these helpers cover ids that arrive
+# in bodies, query strings or from other queries.
+
+
+def parse_uuid(value: Any) -> Optional[UUID]:
+    if value is None or isinstance(value, UUID):
+        return value
+    try:
+        return UUID(str(value))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def require_uuid(value: Any, detail: str = "Not found", status_code: int = 404) -> UUID:
+    parsed = parse_uuid(value)
+    if parsed is None:
+        raise HTTPException(status_code=status_code, detail=detail)
+    return parsed
+
+
+def optional_uuid(value: Any, detail: str = "Invalid id") -> Optional[UUID]:
+    """None stays None; anything else must be a UUID (422 otherwise)."""
+    if value is None or value == "":
+        return None
+    return require_uuid(value, detail=detail, status_code=422)
+
+
+def uuid_list(values: Iterable[Any]) -> List[UUID]:
+    out: List[UUID] = []
+    for v in values:
+        parsed = parse_uuid(v)
+        if parsed is not None:
+            out.append(parsed)
+    return out
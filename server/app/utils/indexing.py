@@ -1,51 +1,116 @@
+import asyncio
+import logging
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Sequence
+from uuid import UUID
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
-from .crdt import decode_prosemirror_text_from_update
-from sqlalchemy import text
+from .block_history import load_history
+from .crdt import decode_pool
+from ..metrics import registry
+from .ids import require_uuid
+from .search_backend import search_backend
+
+log = logging.getLogger("vnote.index")
+
+
+async def update_note_search(session: AsyncSession, note_id: str | UUID, title: str | None, excerpt: str | None, body: str | None):
+    # Persist plain_text to notes for rebuilds; title/excerpt are already stored
+    nid = require_uuid(note_id)
+    await session.execute(text("UPDATE notes SET plain_text=:pt WHERE id = :id"), {"pt": body or "", "id": nid})
+    await update_notes_search_bulk(session, [nid])
+
+
+async def update_notes_search_bulk(session: AsyncSession, note_ids: Sequence[str | UUID]) -> None:
+    """Reindex many notes from their stored title/excerpt/plain_text."""
+    if not note_ids:
+        return
+    registry.inc("vnote_indexing_calls_total", float(len(note_ids)), kind="note")
+    await search_backend.index_notes(session, [require_uuid(i) for i in note_ids])
+
+
+async def _decode_or_blank(rows: Sequence, sources: Sequence[List[bytes]]) -> list:
+    # One at a time, so a block that times out or crashes the pool only
+    # fails itself; it is cached as blank until its next push
+    out = []
+    for r, updates in zip(rows, sources):
+        try:
+            out.append(await decode_pool.decode(*updates))
+        except (asyncio.TimeoutError, BrokenProcessPool) as e:
+            log.warning("giving up decoding block %s at version %s: %s", r.id, r.version, e.__class__.__name__)
+            registry.inc("vnote_block_text_cache_total", result="undecodable")
+            out.append("")
+    return out
 
 
-async def update_note_search(session: AsyncSession, note_id: str, title: str | None, excerpt: str | None, body: str | None):
-    text_content = " ".join([x for x in [title or "", excerpt or "", body or ""] if x])
-    # Persist plain_text to notes for rebuilds
-    await session.execute(text("UPDATE notes SET plain_text=:pt WHERE id::text=:id"), {"pt": body or "", "id": note_id})
-    up = text(
-        """
-        INSERT INTO note_search (note_id, content_tsv)
-        VALUES (:id::uuid, to_tsvector('english', :txt))
-        ON CONFLICT (note_id) DO UPDATE SET content_tsv = EXCLUDED.content_tsv
-        """
+async def rebuild_note_plaintext_from_blocks(
+    session: AsyncSession, note_id: str | UUID, force: bool = False, give_up: bool = False
+) -> str:
+    """The note's text from its blocks, decoding those whose cache is stale.
+
+    Blocks that predate maintained states are decoded from their history.
+    ``force`` decodes every block, e.g. after a decoder change. ``give_up``
+    caches blank text for blocks that still fail to decode instead of
+    raising, so the rest of the note gets indexed. Blocks are read without
+    locks and decoded before any cache row is written, so the caller holds
+    block locks only from that write to its commit.
+    """
+    nid = require_uuid(note_id)
+    # Unless forced, only blocks whose cached text is older than their merged state
+    stale = await session.execute(
+        text(
+            f"""
+            SELECT id, state_version AS version, ydoc_state AS snap FROM blocks
+            WHERE note_id = :nid
+              {'' if force else 'AND (text_cache_version IS NULL OR text_cache_version < state_version)'}
+            """
+        ),
+        {"nid": nid},
     )
-    await session.execute(up, {"id": note_id, "txt": text_content})
-
-
-async def rebuild_note_plaintext_from_blocks(session: AsyncSession, note_id: str) -> str:
-    # For each block in the note, fetch latest snapshot and decode text
-    sql = text(
-        """
-        SELECT b.id::text AS id,
-               (
-                 SELECT v.ydoc_snapshot FROM block_versions v WHERE v.block_id=b.id ORDER BY v.version DESC LIMIT 1
-               ) AS snap
-        FROM blocks b
-        WHERE b.note_id::text=:nid
-        ORDER BY b.order_idx
-        """
+    rows = stale.fetchall()
+    if rows:
+        registry.inc("vnote_block_text_cache_total", float(len(rows)), result="decoded")
+        sources = []
+        for r in rows:
+            if r.snap is not None:
+                sources.append([bytes(r.snap)])
+            else:
+                # Written before states were kept: its history is the content
+                sources.append(await load_history(session, r.id, r.version))
+        if give_up:
+            txts = await _decode_or_blank(rows, sources)
+        else:
+            # A pool timeout or crash raises out of here before anything is cached,
+            # so the blocks stay stale and the caller's retry decodes them again
+            txts = await asyncio.gather(*(decode_pool.decode(*updates) for updates in sources))
+        await session.execute(
+            text(
+                f"""
+                UPDATE blocks b SET text_cache = t.txt, text_cache_version = t.ver
+                FROM unnest(CAST(:ids AS uuid[]), CAST(:vers AS bigint[]), CAST(:txts AS text[])) AS t(id, ver, txt)
+                WHERE b.id = t.id AND (b.text_cache_version IS NULL OR b.text_cache_version {'<=' if force else '<'} t.ver)
+                """
+            ),
+            {"ids": [r.id for r in rows], "vers": [r.version for r in rows], "txts": txts},
+        )
+    # Reassemble from cached fragments in document order
+    res = await session.execute(
+        text(
+            """
+            SELECT string_agg(text_cache, E'\\n' ORDER BY order_idx)
+            FROM blocks WHERE note_id = :nid AND text_cache <> ''
+            """
+        ),
+        {"nid": nid},
     )
-    res = await session.execute(sql, {"nid": note_id})
-    body_parts: list[str] = []
-    for r in res:
-        snap = r.snap
-        if snap:
-            text_part = decode_prosemirror_text_from_update(bytes(snap))
-            if text_part:
-                body_parts.append(text_part)
-    return "\n".join(body_parts)
-
-
-async def rebuild_and_update_search(session: AsyncSession, note_id: str) -> None:
-    meta = await session.execute(text("SELECT title, excerpt FROM notes WHERE id::text=:id"), {"id": note_id})
+    return res.scalar() or ""
+
+
+async def rebuild_and_update_search(session: AsyncSession, note_id: str | UUID, give_up: bool = False) -> None:
+    registry.inc("vnote_indexing_calls_total", kind="blocks")
+    meta = await session.execute(text("SELECT title, excerpt FROM notes WHERE id = :id"), {"id": require_uuid(note_id)})
     row = meta.fetchone()
     if row is None:
         return
-    body = await rebuild_note_plaintext_from_blocks(session, note_id)
+    body = await rebuild_note_plaintext_from_blocks(session, note_id, give_up=give_up)
     await update_note_search(session, note_id, row.title, row.excerpt, body)
@@ -1,7 +1,10 @@
 import re
-from typing import Iterable, List
+from typing import Dict, List, Sequence, Tuple
+from uuid import UUID, uuid4
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
+from .graph_index import links_replaced, note_upserted
+from .ids import require_uuid
 
 
 WIKILINK_RE = re.compile(r"\[\[([^\]]+)\]\]")
@@ -11,34 +14,72 @@ def extract_wikilinks(text_body: str) -> List[str]:
     return [m.group(1).strip() for m in WIKILINK_RE.finditer(text_body or "")]
 
 
-async def rebuild_links_for_note(session: AsyncSession, user_id: str, note_id: str, body: str | None, create_missing: bool = True):
-    # Remove existing source links
-    await session.execute(text("DELETE FROM links WHERE src_note_id::text=:id"), {"id": note_id})
-    if not body:
+async def rebuild_links_for_note(session: AsyncSession, user_id: str | UUID, note_id: str | UUID, body: str | None, create_missing: bool = True):
+    await rebuild_links_for_notes(session, user_id, [(note_id, body)], create_missing)
+
+
+async def rebuild_links_for_notes(
+    session: AsyncSession,
+    user_id: str | UUID,
+    items: Sequence[Tuple[str | UUID, str | None]],
+    create_missing: bool = True,
+) -> None:
+    """Replace the outgoing links of many notes with a fixed number of statements.
+
+    Titles are resolved after the sources exist, so links between notes
+    written in the same batch resolve to each other.
+    """
+    if not items:
         return
-    titles = extract_wikilinks(body)
-    if not titles:
+    uid = require_uuid(user_id)
+    src_ids = [require_uuid(nid) for nid, _ in items]
+    # Remove existing source links
+    await session.execute(text("DELETE FROM links WHERE src_note_id = ANY(:ids)"), {"ids": src_ids})
+    pairs: List[Tuple[UUID, str]] = []
+    for nid, (_, body) in zip(src_ids, items):
+        for t in extract_wikilinks(body or ""):
+            pairs.append((nid, t))
+    if not pairs:
+        for nid in src_ids:
+            links_replaced(session, uid, nid, [])
         return
+    titles = list(dict.fromkeys(t for _, t in pairs))
     # Find destination notes by exact title
     existing = await session.execute(
-        text("SELECT id, title FROM notes WHERE user_id=:uid::uuid AND title = ANY(:titles)"),
-        {"uid": user_id, "titles": titles},
+        text("SELECT id, title FROM notes WHERE user_id = :uid AND title = ANY(:titles)"),
+        {"uid": uid, "titles": titles},
+    )
+    title_to_id: Dict[str, UUID] = {r.title: r.id for r in existing}
+    missing = [t for t in titles if t not in title_to_id]
+    if missing and create_missing:
+        # Placeholder notes for unresolved titles, one statement for all of them
+        new_ids = [uuid4() for _ in missing]
+        await session.execute(
+            text(
+                """
+                INSERT INTO notes (id, user_id, title)
+                SELECT t.id, :uid, t.title FROM unnest(CAST(:ids AS uuid[]), CAST(:titles AS text[])) AS t(id, title)
+                """
+            ),
+            {"uid": uid, "ids": new_ids, "titles": missing},
+        )
+        title_to_id.update(zip(missing, new_ids))
+        for nid, t in zip(new_ids, missing):
+            note_upserted(session, uid, nid, t)
+    rows = [(src, title_to_id[t], t) for src, t in pairs if t in title_to_id]
+    targets: Dict[UUID, List[UUID]] = {nid: [] for nid in src_ids}
+    for src, dst, _ in rows:
+        targets[src].append(dst)
+    for nid, dsts in targets.items():
+        links_replaced(session, uid, nid, dsts)
+    if not rows:
+        return
+    await session.execute(
+        text(
+            """
+            INSERT INTO links (src_note_id, dst_note_id, label)
+            SELECT * FROM unnest(CAST(:src AS uuid[]), CAST(:dst AS uuid[]), CAST(:lbl AS text[]))
+            """
+        ),
+        {"src": [r[0] for r in rows], "dst": [r[1] for r in rows], "lbl": [r[2] for r in rows]},
     )
-    title_to_id = {r.title: r.id for r in existing}
-    for t in titles:
-        dst = title_to_id.get(t)
-        if not dst and create_missing:
-            # Create placeholder note
-            ins = await session.execute(
-                text("INSERT INTO notes (user_id, title) VALUES (:uid::uuid, :title) RETURNING id"),
-                {"uid": user_id, "title": t},
-            )
-            dst = ins.fetchone()[0]
-            title_to_id[t] = dst
-        if dst:
-            await session.execute(
-                text(
-                    "INSERT INTO links (src_note_id, dst_note_id, label) VALUES (:src::uuid, :dst::uuid, :lbl)"
-                ),
-                {"src": note_id, "dst": str(dst), "lbl": t},
-            )
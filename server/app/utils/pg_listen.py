@@ -0,0 +1,137 @@
+"""LISTEN connections that come back after Postgres drops them.
+
+A listener holds one connection, from the engine's pool or opened directly
+from ``url``. When the server closes it (restart, failover, idle timeout),
+asyncpg reports the termination and the listener reconnects with backoff,
+re-LISTENs every channel and runs ``on_reconnect`` callbacks: NOTIFYs sent
+while it was gone are lost, so callers drop whatever they may have missed.
+"""
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+import asyncpg
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from ..db import engine
+from ..metrics import registry
+
+log = logging.getLogger("vnote.listen")
+
+
+def _plain_dsn(url: str) -> str:
+    # asyncpg takes libpq URLs, not SQLAlchemy's dialect+driver form
+    scheme, sep, rest = url.partition("://")
+    return f"postgresql://{rest}" if sep and scheme.startswith("postgres") else url
+
+
+class PgListener:
+    def __init__(self, name: str, url: Optional[str] = None, min_backoff: float = 0.5, max_backoff: float = 30.0):
+        self.name = name
+        self.url = url
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.on_reconnect: List[Callable[[], None]] = []
+        self._channels: Dict[str, Callable[..., None]] = {}
+        self._conn: Optional[AsyncConnection] = None
+        self._raw: Any = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    @property
+    def connected(self) -> bool:
+        return self._raw is not None
+
+    async def listen(self, channel: str, callback: Callable[..., None]) -> None:
+        self._channels[channel] = callback
+        if self._raw is not None:
+            await self._raw.add_listener(channel, callback)
+
+    async def start(self) -> None:
+        """Connect and LISTEN; raises if the first attempt fails."""
+        self._closing = False
+        if self._raw is None and self._task is None:
+            await self._connect()
+
+    async def stop(self) -> None:
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        raw, self._raw = self._raw, None
+        conn, self._conn = self._conn, None
+        if raw is not None:
+            for channel, callback in self._channels.items():
+                try:
+                    await raw.remove_listener(channel, callback)
+                except Exception:
+                    pass
+        await self._close(conn, raw)
+
+    async def _close(self, conn: Optional[AsyncConnection], raw: Any) -> None:
+        try:
+            if conn is not None:
+                await conn.close()
+            elif raw is not None:
+                await raw.close()
+        except Exception:
+            pass
+
+    async def _connect(self) -> None:
+        conn: Optional[AsyncConnection] = None
+        if self.url:
+            raw = await asyncpg.connect(_plain_dsn(self.url))
+        else:
+            conn = await engine.connect()
+            raw = (await conn.get_raw_connection()).driver_connection
+        try:
+            for channel, callback in self._channels.items():
+                await raw.add_listener(channel, callback)
+        except BaseException:
+            await self._close(conn, raw)
+            raise
+        raw.add_termination_listener(self._on_terminate)
+        self._conn, self._raw = conn, raw
+
+    def _on_terminate(self, raw: Any) -> None:
+        if self._closing or raw is not self._raw:
+            return
+        registry.inc("vnote_pg_listen_reconnects_total", listener=self.name)
+        log.warning("%s LISTEN connection lost; reconnecting", self.name)
+        conn, self._conn, self._raw = self._conn, None, None
+        self._task = asyncio.get_running_loop().create_task(self._reconnect(conn))
+
+    async def _reconnect(self, dead: Optional[AsyncConnection]) -> None:
+        if dead is not None:
+            try:
+                # Don't hand the broken connection back to the pool
+                await dead.invalidate()
+            except Exception:
+                pass
+        delay = self.min_backoff
+        try:
+            while not self._closing:
+                try:
+                    await self._connect()
+                    break
+                except Exception as e:
+                    log.warning("%s LISTEN reconnect failed, retrying in %.1fs: %s", self.name, delay, e)
+                    await asyncio.sleep(delay)
+                    delay = min(self.max_backoff, delay * 2)
+        finally:
+            self._task = None
+        if self._raw is None:
+            return
+        log.info("%s LISTEN connection restored", self.name)
+        for fn in self.on_reconnect:
+            try:
+                fn()
+            except Exception as e:
+                log.warning("%s reconnect callback failed: %s", self.name, e)
+
+
+registry.describe("vnote_pg_listen_reconnects_total", "LISTEN connections lost and re-established, by listener")
@@ -0,0 +1,450 @@
+"""Full-text search backends behind GET /search and the indexing path.
+
+``postgres`` (default) keeps weighted tsvectors in ``note_search``.
+``bm25`` keeps an in-process inverted index (see ``utils.bm25``) and uses
+Postgres only for filters, facets and note metadata; it sees writes made by
+this process only, so run a single API process with INDEX_QUEUE_MODE
+``inprocess`` or ``inline``.
+"""
+import abc
+import asyncio
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session
+
+from ..config import env_int
+from ..db import SessionLocal
+from ..metrics import registry
+from .bm25 import Bm25Index, tokenize
+from .search_cache import mark_changed, search_cache
+
+log = logging.getLogger("vnote.search")
+
+# Matches ranked per query; beyond this only the most recent (postgres)
+# or best-scoring (bm25) are ranked
+CANDIDATES = env_int("SEARCH_CANDIDATES", 1000)
+
+FACETS = ("tags", "folders")
+_FACET_LIMIT = 50
+_HEADLINE_OPTS = "StartSel=<b>,StopSel=</b>,MaxFragments=2,MinWords=5,MaxWords=20"
+_ORDER = "ORDER BY rank DESC, updated_at DESC, id DESC"
+
+# Weighted vector for a note row ``n`` joined to its owner ``u``
+NOTE_TSV_SQL = """
+    setweight(to_tsvector(u.search_config::regconfig, coalesce(n.title, '')), 'A')
+    || setweight(to_tsvector(u.search_config::regconfig, coalesce(n.excerpt, '')), 'B')
+    || setweight(to_tsvector(u.search_config::regconfig, coalesce(n.plain_text, '')), 'C')
+"""
+
+# Keyset position of the last row of the previous page: (rank, updated_at, id)
+After = Optional[Tuple[float, datetime, UUID]]
+
+
+def _filters(folder_id: Optional[UUID], tag: Optional[str], params: Dict[str, Any]) -> List[str]:
+    where = ["n.user_id = :uid", "n.deleted_at IS NULL"]
+    if folder_id:
+        where.append("n.folder_id = :fid")
+        params["fid"] = folder_id
+    if tag:
+        where.append(
+            "EXISTS (SELECT 1 FROM note_tags nt JOIN tags t ON t.id = nt.tag_id"
+            " WHERE nt.note_id = n.id AND t.user_id = :uid AND lower(t.name) = lower(:tag))"
+        )
+        params["tag"] = tag
+    return where
+
+
+async def _page(
+    session: AsyncSession, ctes: str, snippet_sql: str, params: Dict[str, Any], after: After, facets: Sequence[str]
+) -> Dict[str, Any]:
+    """Run ``ctes`` through keyset paging, snippets, the match count and facet
+    counts in one statement.
+
+    ``ctes`` must define ``scored`` (the ranked candidates, at most
+    CANDIDATES) and ``matches``, whose rows are counted: every match when
+    facets are requested, otherwise at least CANDIDATES + 1 of them when
+    there are that many, which is enough to tell the ranking was truncated.
+    """
+    where_after = ""
+    if after is not None:
+        params.update(crank=after[0], cts=after[1], cid=after[2])
+        where_after = "WHERE (rank, updated_at, id) < (CAST(:crank AS real), :cts, :cid)"
+    sql = f"""
+        WITH {ctes},
+        ranked AS (
+          SELECT id, updated_at, rank FROM scored {where_after}
+          {_ORDER}
+          LIMIT :lim
+        ),
+        hits AS (
+          SELECT n.id, n.title, n.excerpt, r.rank, r.updated_at, {snippet_sql} AS snippet
+          FROM ranked r JOIN notes n ON n.id = r.id
+        )"""
+    # One row: the page as JSON next to the match count and facet counts
+    cols = [f"(SELECT coalesce(json_agg(h {_ORDER}), '[]') FROM hits h) AS hits", "(SELECT count(*) FROM matches) AS matched"]
+    if "tags" in facets:
+        cols.append(
+            f"""(SELECT coalesce(json_agg(t), '[]') FROM (
+                  SELECT tg.id, tg.name, count(*) AS count
+                  FROM matches m JOIN note_tags nt ON nt.note_id = m.id JOIN tags tg ON tg.id = nt.tag_id
+                  WHERE tg.user_id = :uid
+                  GROUP BY tg.id, tg.name ORDER BY count DESC, lower(tg.name) LIMIT {_FACET_LIMIT}) t) AS tags"""
+        )
+    if "folders" in facets:
+        # folder_id NULL counts the matches outside any folder
+        cols.append(
+            f"""(SELECT coalesce(json_agg(f), '[]') FROM (
+                  SELECT m.folder_id AS id, fo.name, count(*) AS count
+                  FROM matches m LEFT JOIN folders fo ON fo.id = m.folder_id
+                  GROUP BY m.folder_id, fo.name ORDER BY count DESC, lower(fo.name) LIMIT {_FACET_LIMIT}) f) AS folders"""
+        )
+    res = await session.execute(text(f"{sql} SELECT {', '.join(cols)}"), params)
+    row = res.mappings().one()
+    return {
+        "rows": [{**h, "updated_at": datetime.fromisoformat(h["updated_at"])} for h in row["hits"]],
+        # Paging walks only the ranked candidates, so that is what is counted
+        "total": min(row["matched"], CANDIDATES),
+        "truncated": row["matched"] > CANDIDATES,
+        "facets": {f: row[f] for f in facets},
+    }
+
+
+class SearchBackend(abc.ABC):
+    name = ""
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def index_notes(self, session: AsyncSession, note_ids: Sequence[UUID]) -> None:
+        """Bring the index up to date with these notes' stored text, dropping
+        deleted ones; commits with the caller."""
+
+    @abc.abstractmethod
+    async def search(
+        self,
+        session: AsyncSession,
+        user_id: UUID,
+        q: str,
+        *,
+        folder_id: Optional[UUID] = None,
+        tag: Optional[str] = None,
+        limit: int = 50,
+        after: After = None,
+        facets: Sequence[str] = (),
+    ) -> Dict[str, Any]:
+        """Up to ``limit`` hits after ``after``, best first, with ``total``
+        (matches that can be paged to), ``truncated`` (more matched than
+        were ranked) and the requested ``facets``."""
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+
+class PostgresSearch(SearchBackend):
+    name = "postgres"
+
+    async def index_notes(self, session: AsyncSession, note_ids: Sequence[UUID]) -> None:
+        res = await session.execute(
+            text(
+                f"""
+                WITH up AS (
+                  INSERT INTO note_search (note_id, content_tsv)
+                  SELECT n.id, {NOTE_TSV_SQL}
+                  FROM notes n JOIN users u ON u.id = n.user_id
+                  WHERE n.id = ANY(:ids) AND n.deleted_at IS NULL
+                  ON CONFLICT (note_id) DO UPDATE SET content_tsv = EXCLUDED.content_tsv
+                  RETURNING note_id
+                ),
+                gone AS (
+                  DELETE FROM note_search s USING notes n
+                  WHERE s.note_id = n.id AND n.id = ANY(:ids) AND n.deleted_at IS NOT NULL
+                  RETURNING n.user_id
+                )
+                SELECT n.user_id FROM up JOIN notes n ON n.id = up.note_id
+                UNION SELECT user_id FROM gone
+                """
+            ),
+            {"ids": list(note_ids)},
+        )
+        mark_changed(session, [r.user_id for r in res])
+
+    async def search(self, session, user_id, q, *, folder_id=None, tag=None, limit=50, after=None, facets=()):
+        params: Dict[str, Any] = {"q": q, "uid": user_id, "cap": CANDIDATES, "lim": limit}
+        where = _filters(folder_id, tag, params) + ["s.content_tsv @@ q.query"]
+        # GIN match on the stored vectors, rank only capped candidates, and
+        # build headlines (the expensive part) only for the returned page.
+        if facets:
+            # Facets count every match, so the match set is materialized once
+            # and both the candidates and the counts read from it.
+            source = f"""
+            matches AS MATERIALIZED (
+              SELECT n.id, n.updated_at, n.folder_id
+              FROM note_search s JOIN notes n ON n.id = s.note_id, q
+              WHERE {' AND '.join(where)}
+            ),
+            candidates AS (
+              SELECT m.id, m.updated_at, s.content_tsv
+              FROM (SELECT id, updated_at FROM matches ORDER BY updated_at DESC LIMIT :cap) m
+              JOIN note_search s ON s.note_id = m.id
+            )"""
+        else:
+            # One match past the cap is read only to report truncation
+            source = f"""
+            matches AS MATERIALIZED (
+              SELECT n.id, n.updated_at, s.content_tsv
+              FROM note_search s JOIN notes n ON n.id = s.note_id, q
+              WHERE {' AND '.join(where)}
+              ORDER BY n.updated_at DESC
+              LIMIT :cap + 1
+            ),
+            candidates AS (
+              SELECT id, updated_at, content_tsv FROM matches ORDER BY updated_at DESC LIMIT :cap
+            )"""
+        ctes = f"""
+        q AS (
+          SELECT u.search_config::regconfig AS cfg, websearch_to_tsquery(u.search_config::regconfig, :q) AS query
+          FROM users u WHERE u.id = :uid
+        ),{source},
+        scored AS (
+          SELECT c.id, c.updated_at, ts_rank_cd(c.content_tsv, q.query)::real AS rank
+          FROM candidates c, q
+        )"""
+        snippet = (
+            "ts_headline((SELECT cfg FROM q), coalesce(nullif(n.plain_text, ''), n.excerpt, n.title),"
+            f" (SELECT query FROM q), '{_HEADLINE_OPTS}')"
+        )
+        return await _page(session, ctes, snippet, params, after, facets)
+
+
+def _snippet(body: str, terms: Sequence[str], words: int = 20) -> str:
+    """First window of ``words`` words containing a query term, terms in <b>."""
+    if not body:
+        return ""
+    wanted = set(terms)
+    tokens = re.findall(r"\S+", body)
+    hit = next((i for i, w in enumerate(tokens) if any(t in wanted for t in tokenize(w))), 0)
+    start = max(0, hit - words // 4)
+    out = []
+    for w in tokens[start:start + words]:
+        out.append(f"<b>{w}</b>" if any(t in wanted for t in tokenize(w)) else w)
+    return " ".join(out)
+
+
+_BM25_PENDING = "bm25_pending"
+
+
+class Bm25Search(SearchBackend):
+    """BM25 over title and plain_text from an in-process index.
+
+    Built by streaming the notes table at startup (while serving whatever
+    segments are on disk) and updated from committed writes afterwards.
+    Queries are bags of words; web-search operators are not interpreted.
+    """
+
+    name = "bm25"
+
+    def __init__(
+        self,
+        directory: Optional[str],
+        session_factory: async_sessionmaker = SessionLocal,
+        flush_docs: int = 1000,
+        max_segments: int = 8,
+        interval: float = 30.0,
+        rebuild_on_start: bool = True,
+    ):
+        self.directory = directory
+        self.session_factory = session_factory
+        self.flush_docs = flush_docs
+        self.max_segments = max_segments
+        self.interval = interval
+        self.rebuild_on_start = rebuild_on_start
+        self.index: Optional[Bm25Index] = None
+        self.ready = False
+        self._touched: Optional[set] = None  # notes written while a rebuild streams
+        self._task: Optional[asyncio.Task] = None
+        self._stop = asyncio.Event()
+
+    def _index(self) -> Bm25Index:
+        if self.index is None:
+            try:
+                self.index = Bm25Index(self.directory, flush_docs=self.flush_docs, max_segments=self.max_segments)
+            except (OSError, ValueError) as e:
+                log.warning("bm25 segments in %s unusable (%s); keeping the index in memory", self.directory, e)
+                self.index = Bm25Index(None, flush_docs=self.flush_docs, max_segments=self.max_segments)
+        return self.index
+
+    async def index_notes(self, session: AsyncSession, note_ids: Sequence[UUID]) -> None:
+        # Read inside the caller's transaction; applied only once it commits
+        res = await session.execute(
+            text("SELECT id, user_id, title, plain_text, deleted_at IS NOT NULL AS deleted FROM notes WHERE id = ANY(:ids)"),
+            {"ids": list(note_ids)},
+        )
+        rows = res.fetchall()
+        session.info.setdefault(_BM25_PENDING, []).extend(rows)
+        mark_changed(session, {r.user_id for r in rows})
+
+    def apply(self, rows: Sequence[Any]) -> None:
+        index = self._index()
+        for r in rows:
+            if self._touched is not None:
+                self._touched.add(r.id)
+            if r.deleted:
+                index.remove(r.id)
+            else:
+                index.add(r.id, r.user_id, f"{r.title or ''}\n{r.plain_text or ''}")
+
+    async def rebuild(self) -> int:
+        """Re-index every note by streaming the notes table."""
+        index = self._index()
+        self._touched = set()
+        seen = set()
+        start = time.perf_counter()
+        try:
+            async with self.session_factory() as session:
+                result = await session.stream(
+                    text("SELECT id, user_id, title, plain_text FROM notes WHERE deleted_at IS NULL"),
+                    execution_options={"yield_per": 500},
+                )
+                async for part in result.partitions():
+                    for r in part:
+                        seen.add(r.id)
+                        if r.id not in self._touched:
+                            index.add(r.id, r.user_id, f"{r.title or ''}\n{r.plain_text or ''}")
+                    if index.needs_flush():
+                        await asyncio.to_thread(index.flush)
+            for nid in index.notes() - seen - self._touched:
+                index.remove(nid)
+        finally:
+            self._touched = None
+        await asyncio.to_thread(index.flush)
+        await asyncio.to_thread(index.merge, True)
+        self.ready = True
+        search_cache.bump_all()
+        log.info("bm25 index built: %d notes in %.1fs", len(seen), time.perf_counter() - start)
+        return len(seen)
+
+    async def maintain(self) -> None:
+        index = self._index()
+        if index.needs_flush() or (index.stats()["bufferedDocs"] and self.directory):
+            await asyncio.to_thread(index.flush)
+        await asyncio.to_thread(index.merge)
+
+    async def run_forever(self) -> None:
+        if self.rebuild_on_start or not len(self._index()):
+            try:
+                await self.rebuild()
+            except Exception as e:
+                log.warning("bm25 rebuild failed: %s", e)
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.maintain()
+            except Exception as e:
+                log.warning("bm25 maintenance failed: %s", e)
+
+    async def start(self) -> None:
+        from ..index_queue import MODE
+
+        if MODE == "external":
+            log.warning("SEARCH_BACKEND=bm25 only sees writes indexed in this process; INDEX_QUEUE_MODE=external bypasses it")
+        if self._task is None:
+            self._stop = asyncio.Event()
+            self._task = asyncio.create_task(self.run_forever())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._stop.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        if self.index is not None:
+            try:
+                await asyncio.to_thread(self.index.flush)
+            except Exception as e:
+                log.warning("bm25 flush on shutdown failed: %s", e)
+
+    async def search(self, session, user_id, q, *, folder_id=None, tag=None, limit=50, after=None, facets=()):
+        start = time.perf_counter()
+        # One hit past the cap is fetched only to report truncation
+        # Scoring walks every user's postings for the terms, so off the loop
+        hits = await asyncio.to_thread(self._index().search, user_id, q, CANDIDATES + 1)
+        registry.histogram("vnote_search_bm25_seconds").observe(time.perf_counter() - start)
+        if not hits:
+            return {"rows": [], "total": 0, "truncated": False, "facets": {f: [] for f in facets}}
+        params: Dict[str, Any] = {
+            "uid": user_id,
+            "lim": limit,
+            "cap": CANDIDATES,
+            "ids": [h[0] for h in hits],
+            "scores": [h[1] for h in hits],
+        }
+        where = _filters(folder_id, tag, params)
+        ctes = f"""
+        matches AS MATERIALIZED (
+          SELECT n.id, n.updated_at, n.folder_id, c.rank
+          FROM unnest(CAST(:ids AS uuid[]), CAST(:scores AS real[])) AS c(id, rank)
+          JOIN notes n ON n.id = c.id
+          WHERE {' AND '.join(where)}
+        ),
+        scored AS (SELECT id, updated_at, rank FROM matches ORDER BY rank DESC LIMIT :cap)"""
+        page = await _page(session, ctes, "n.plain_text", params, after, facets)
+        terms = tokenize(q)
+        for r in page["rows"]:
+            r["snippet"] = _snippet(r["snippet"] or r["excerpt"] or r["title"] or "", terms)
+        return page
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "ready": self.ready, **(self.index.stats() if self.index else {})}
+
+
+def _make_backend() -> SearchBackend:
+    kind = os.getenv("SEARCH_BACKEND", "postgres").strip().lower()
+    if kind == "bm25":
+        return Bm25Search(
+            os.getenv("SEARCH_BM25_DIR", "/data/bm25") or None,
+            flush_docs=env_int("SEARCH_BM25_FLUSH_DOCS", 1000),
+            max_segments=env_int("SEARCH_BM25_MAX_SEGMENTS", 8),
+            interval=float(env_int("SEARCH_BM25_MERGE_SECONDS", 30)),
+        )
+    if kind != "postgres":
+        log.warning("unknown SEARCH_BACKEND %r, using postgres", kind)
+    return PostgresSearch()
+
+
+search_backend = _make_backend()
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_after_commit(session: Session) -> None:
+    rows = session.info.pop(_BM25_PENDING, None)
+    if rows and isinstance(search_backend, Bm25Search):
+        try:
+            search_backend.apply(rows)
+        except Exception as e:  # the commit already happened; the next rebuild catches up
+            log.warning("bm25 update failed: %s", e)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_after_rollback(session: Session) -> None:
+    session.info.pop(_BM25_PENDING, None)
+
+
+registry.describe("vnote_search_bm25_seconds", "In-process BM25 scoring time per query")
@@ -0,0 +1,185 @@
+"""Search result cache, invalidated by per-user content generations.
+
+Any transaction that changes what a user's searches would return calls
+``mark_changed``; when it commits, the user's generation is bumped here and
+NOTIFYed to other processes, and cached results from older generations stop
+matching. Until then a repeated search is served without touching Postgres.
+"""
+import itertools
+import logging
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from uuid import uuid4
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from ..config import env_float
+from ..db import PGBOUNCER
+from ..metrics import registry
+from .pg_listen import PgListener
+
+log = logging.getLogger("vnote.search")
+
+CHANNEL = "vnote_search_gen"
+_NOTIFY_MAX = 7000  # NOTIFY payloads are capped at 8000 bytes
+_PENDING = "search_cache_users"
+
+
+class SearchCache:
+    """LRU of search responses bounded by ``max_bytes`` of estimated size.
+
+    Keys carry the user's generation at the time the query started, so a
+    result computed concurrently with a write is never served after it.
+    """
+
+    def __init__(self, max_bytes: int = 32 << 20, max_users: int = 100000, listen_url: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.max_users = max_users
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.worker = uuid4().hex
+        self._clock = itertools.count(1)
+        # Users evicted from _gens read as _floor, which no cached entry predates
+        self._floor = 0
+        self._gens: "OrderedDict[str, int]" = OrderedDict()
+        self._entries: "OrderedDict[Tuple[Any, ...], Tuple[int, Any, int]]" = OrderedDict()
+        self.listener = PgListener("search_cache", listen_url)
+        self.listener.on_reconnect.append(self.bump_all)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def generation(self, user_id: str) -> int:
+        return self._gens.get(user_id, self._floor)
+
+    def get(self, user_id: str, key: Tuple[Any, ...]) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        full = (user_id,) + key
+        entry = self._entries.get(full)
+        if entry is None or entry[0] != self.generation(user_id):
+            if entry is not None:
+                self._drop(full)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(full)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id: str, key: Tuple[Any, ...], gen: int, value: Any, size: int) -> None:
+        """Store ``value``, computed from data as of generation ``gen``."""
+        if not self.enabled or gen != self.generation(user_id) or size > self.max_bytes // 8:
+            return
+        full = (user_id,) + key
+        if full in self._entries:
+            self._drop(full)
+        self._entries[full] = (gen, value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, full: Tuple[Any, ...]) -> None:
+        _, _, size = self._entries.pop(full)
+        self.bytes -= size
+
+    def bump(self, user_ids: Iterable[str]) -> None:
+        for uid in user_ids:
+            self._gens[uid] = next(self._clock)
+            self._gens.move_to_end(uid)
+        while len(self._gens) > self.max_users:
+            self._gens.popitem(last=False)
+            self._floor = next(self._clock)
+
+    def bump_all(self) -> None:
+        self._gens.clear()
+        self._floor = next(self._clock)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "maxBytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+    async def start(self) -> None:
+        # Other processes' commits arrive as NOTIFYs
+        if not self.enabled or self.listener.connected:
+            return
+        if PGBOUNCER and not self.listener.url:
+            # A transaction-pooled connection drops LISTEN registrations
+            log.warning("search cache disabled: DB_PGBOUNCER needs SEARCH_CACHE_LISTEN_URL for LISTEN")
+            self.max_bytes = 0
+            return
+        try:
+            await self.listener.listen(CHANNEL, self._on_notify)
+            await self.listener.start()
+        except Exception as e:
+            # Without the listener other workers' writes would go unseen
+            log.warning("search cache disabled, cannot LISTEN: %s", e)
+            self.max_bytes = 0
+            await self.stop()
+
+    async def stop(self) -> None:
+        await self.listener.stop()
+
+    def _on_notify(self, conn: Any, pid: int, channel: str, payload: str) -> None:
+        origin, _, users = payload.partition("|")
+        if origin == self.worker:
+            return
+        if users == "*":
+            self.bump_all()
+        else:
+            self.bump(u for u in users.split(",") if u)
+
+
+def mark_changed(session: AsyncSession, user_ids: Iterable[Any]) -> None:
+    """Invalidate these users' cached searches once ``session`` commits."""
+    session.info.setdefault(_PENDING, set()).update(str(u) for u in user_ids)
+
+
+def _payload(users: List[str]) -> str:
+    body = ",".join(users)
+    return f"{search_cache.worker}|{body if len(body) <= _NOTIFY_MAX else '*'}"
+
+
+@event.listens_for(Session, "before_commit")
+def _notify_before_commit(session: Session) -> None:
+    users = session.info.get(_PENDING)
+    if users:
+        # Transactional: delivered to other processes only if the commit succeeds
+        session.execute(text("SELECT pg_notify(:ch, :msg)"), {"ch": CHANNEL, "msg": _payload(sorted(users))})
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_after_commit(session: Session) -> None:
+    users = session.info.pop(_PENDING, None)
+    if users:
+        search_cache.bump(users)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_after_rollback(session: Session) -> None:
+    session.info.pop(_PENDING, None)
+
+
+search_cache = SearchCache(
+    max_bytes=int(env_float("SEARCH_CACHE_MB", 32.0) * (1 << 20)),
+    listen_url=os.getenv("SEARCH_CACHE_LISTEN_URL") or None,
+)
+registry.gauge(
+    "vnote_search_cache",
+    lambda: {(("stat", k),): float(v) for k, v in search_cache.stats().items()},
+    help="Search result cache: entries, bytes, hits, misses, evictions and hit rate",
+)
@@ -0,0 +1,80 @@
+"""Per-user LRU of recently opened note titles for the quick switcher."""
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+from uuid import UUID
+
+from ..config import env_int
+from ..metrics import registry
+
+
+class RecentTitles:
+    """Up to ``per_user`` recently opened notes for each of ``max_users`` users.
+
+    Per process and refreshed only by this worker's reads and writes, so
+    entries expire after ``ttl`` seconds to bound staleness from other workers.
+    """
+
+    def __init__(self, max_users: int = 5000, per_user: int = 50, ttl: float = 300.0):
+        self.max_users = max_users
+        self.per_user = per_user
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._users: "OrderedDict[str, OrderedDict[UUID, Tuple[str, float]]]" = OrderedDict()
+
+    def touch(self, user_id: str, note_id: UUID, title: str) -> None:
+        if self.max_users <= 0 or self.per_user <= 0:
+            return
+        notes = self._users.get(user_id)
+        if notes is None:
+            notes = self._users[user_id] = OrderedDict()
+        notes[note_id] = (title, time.monotonic() + self.ttl)
+        notes.move_to_end(note_id)
+        while len(notes) > self.per_user:
+            notes.popitem(last=False)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def rename(self, user_id: str, note_id: UUID, title: str) -> None:
+        notes = self._users.get(user_id)
+        if notes is not None and note_id in notes:
+            notes[note_id] = (title, notes[note_id][1])
+
+    def forget(self, user_id: str, note_id: UUID) -> None:
+        notes = self._users.get(user_id)
+        if notes is not None:
+            notes.pop(note_id, None)
+
+    def match(self, user_id: str, q: str) -> List[Tuple[UUID, str]]:
+        """Titles starting with ``q`` (case-insensitive), most recently opened first."""
+        notes = self._users.get(user_id)
+        if not notes:
+            return []
+        now = time.monotonic()
+        needle = q.casefold()
+        out = []
+        for nid in [n for n, (_, dl) in notes.items() if dl <= now]:
+            del notes[nid]
+        for nid, (title, _) in reversed(notes.items()):
+            if title.casefold().startswith(needle):
+                out.append((nid, title))
+        return out
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+recent_titles = RecentTitles(per_user=env_int("RECENT_TITLES_PER_USER", 50))
+registry.gauge(
+    "vnote_recent_titles",
+    lambda: {(("stat", k),): float(v) for k, v in recent_titles.stats().items()},
+    help="Quick-switcher cache: users tracked, hits, misses and hit rate",
+)
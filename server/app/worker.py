@@ -0,0 +1,40 @@
+"""Standalone indexing worker: ``python -m app.worker``.
+
+Runs the index queue and block compactor and resumes stalled admin reindex
+jobs; start any number of these next to the API with INDEX_QUEUE_MODE=external.
+"""
+import asyncio
+import logging
+import signal
+
+from .db import engine
+from .index_queue import index_worker
+from .metrics import instrument_engine
+from .reindex import reindexer
+from .slowlog import slow_query_log
+from .utils.blockstore import block_compactor
+from .utils.crdt import decode_pool
+
+
+async def main() -> None:
+    instrument_engine(engine.sync_engine)
+    slow_query_log.install(engine)
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await index_worker.start()
+    await block_compactor.start()
+    await reindexer.start()
+    logging.getLogger("vnote.index").info("index worker started")
+    await stop.wait()
+    await index_worker.stop()
+    await block_compactor.stop()
+    await reindexer.stop()
+    decode_pool.shutdown()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    asyncio.run(main())
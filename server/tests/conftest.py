@@ -2,6 +2,7 @@ import os
 import asyncio
 import pytest
 from httpx import AsyncClient, ASGITransport
+from sqlalchemy import text
 from app.main import app
 from app.db import engine
 
@@ -9,7 +10,7 @@ from app.db import engine
 async def _db_available() -> bool:
     try:
         async with engine.connect() as conn:
-            await conn.execute("SELECT 1")
+            await conn.execute(text("SELECT 1"))
         return True
     except Exception:
         return False
@@ -0,0 +1,16 @@
+import pytest
+from httpx import ASGITransport, AsyncClient
+
+from app import auth
+from app.main import app
+
+
+@pytest.mark.anyio
+async def test_admin_requires_token(monkeypatch):
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        monkeypatch.setattr(auth, "ADMIN_TOKEN", "")
+        assert (await ac.get("/admin/reindex-search")).status_code == 403
+        monkeypatch.setattr(auth, "ADMIN_TOKEN", "secret")
+        assert (await ac.post("/admin/reindex-search")).status_code == 401
+        r = await ac.get("/admin/auth-cache", headers={"Authorization": "Bearer wrong"})
+        assert r.status_code == 401
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta, timezone
+
+from app.auth import CurrentUser, TokenCache
+
+
+def test_token_cache_hits_and_lru_eviction():
+    cache = TokenCache(max_entries=2, ttl=60)
+    a, b, c = (CurrentUser(id=str(i), email=f"{i}@example.com") for i in range(3))
+    assert cache.get("ta") is None
+    cache.put("ta", a)
+    cache.put("tb", b)
+    assert cache.get("ta") is a  # ta becomes most recently used
+    cache.put("tc", c)  # evicts tb
+    assert cache.get("tb") is None
+    assert cache.get("tc") is c
+    stats = cache.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 2 and stats["entries"] == 2
+
+
+def test_token_cache_respects_expiry_and_invalidation():
+    cache = TokenCache(max_entries=10, ttl=60)
+    u = CurrentUser(id="u1", email="u1@example.com")
+    cache.put("expired", u, datetime.now(timezone.utc) - timedelta(seconds=1))
+    assert cache.get("expired") is None
+    cache.put("t1", u, datetime.now(timezone.utc) + timedelta(hours=1))
+    cache.put("t2", u)
+    cache.invalidate("t1")
+    assert cache.get("t1") is None
+    cache.invalidate_user("u1")
+    assert cache.get("t2") is None
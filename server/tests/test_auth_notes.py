@@ -25,3 +25,60 @@ async def test_auth_and_notes_flow(client):
     arr = r2.json()
     assert isinstance(arr, list)
 
+
+
+@pytest.mark.anyio
+async def test_notes_keyset_pages_and_etag(client):
+    token = await register_and_login(client)
+    h = {"Authorization": f"Bearer {token}"}
+    for i in range(5):
+        r = await client.post("/notes", headers=h, json={"title": f"Page {i}"})
+        assert r.status_code == 200
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        r = await client.get("/notes", headers=h, params=params)
+        assert r.status_code == 200
+        seen.extend(n["id"] for n in r.json())
+        cursor = r.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert len(seen) == 5 and len(set(seen)) == 5
+    r = await client.get("/notes", headers=h)
+    r2 = await client.get("/notes", headers={**h, "If-None-Match": r.headers["etag"]})
+    assert r2.status_code == 304
+    # A tag rename changes ?tag= listings without touching any note
+    tid = (await client.post("/tags", headers=h, json={"name": "etag"})).json()["id"]
+    r = await client.get("/notes", headers=h, params={"tag": "etag"})
+    await client.patch(f"/tags/{tid}", headers=h, json={"name": "etag2"})
+    r2 = await client.get("/notes", headers={**h, "If-None-Match": r.headers["etag"]}, params={"tag": "etag"})
+    assert r2.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_notes_batch_links_within_batch(client):
+    token = await register_and_login(client)
+    h = {"Authorization": f"Bearer {token}"}
+    r = await client.post(
+        "/notes/batch",
+        headers=h,
+        json={"notes": [
+            {"title": "Alpha", "body": "see [[Beta]]"},
+            {"title": "Beta", "body": "back to [[Alpha]]"},
+            {"body": "no title"},
+            {"id": str(uuid.uuid4()), "title": "Ghost"},
+        ]},
+    )
+    assert r.status_code == 200
+    out = r.json()
+    assert (out["created"], out["updated"], out["errors"]) == (2, 0, 2)
+    alpha, beta = out["results"][0]["id"], out["results"][1]["id"]
+    r = await client.get(f"/notes/{beta}/backlinks", headers=h)
+    assert [b["id"] for b in r.json()] == [alpha]
+    r = await client.post("/notes/batch", headers=h, json={"notes": [{"id": alpha, "body": "now plain"}]})
+    assert r.json()["updated"] == 1
+    r = await client.get(f"/notes/{beta}/backlinks", headers=h)
+    assert r.json() == []
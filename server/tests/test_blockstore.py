@@ -0,0 +1,202 @@
+import uuid
+import pytest
+from sqlalchemy import text
+from y_py import YDoc, apply_update, encode_state_as_update, encode_state_vector
+
+from app.db import SessionLocal
+from app.utils.blockstore import BlockCompactor
+from app.utils.crdt import merge_updates
+
+
+def _edits(n: int):
+    """n incremental updates, each appending one character."""
+    doc = YDoc()
+    out = []
+    for i in range(n):
+        sv = encode_state_vector(doc)
+        with doc.begin_transaction() as txn:
+            doc.get_text("t").extend(txn, str(i % 10))
+        out.append(encode_state_as_update(doc, sv))
+    return out
+
+
+def _text(state: bytes) -> str:
+    doc = YDoc()
+    apply_update(doc, state)
+    return str(doc.get_text("t"))
+
+
+def test_merge_updates_folds_increments():
+    state, sv = merge_updates(_edits(5))
+    assert _text(state) == "01234"
+    assert sv
+
+
+def test_merge_updates_rejects_garbage():
+    with pytest.raises(ValueError):
+        merge_updates([b"\xff\xff\xff"])
+
+
+@pytest.mark.anyio
+async def test_compaction_bounds_history_and_keeps_state(client):
+    r = await client.post("/auth/register", json={"email": f"cmp-{uuid.uuid4().hex[:8]}@example.com", "password": "pass1234"})
+    h = {"Authorization": f"Bearer {r.json()['accessToken']}"}
+    nid = (await client.post("/notes", headers=h, json={"title": "Compact"})).json()["id"]
+    async with SessionLocal() as s:
+        res = await s.execute(text("INSERT INTO blocks (note_id, type, order_idx) VALUES (:nid, 'paragraph', 1) RETURNING id"), {"nid": uuid.UUID(nid)})
+        bid = res.scalar()
+        await s.commit()
+    edits = _edits(12)
+    for e in edits:
+        r = await client.post(f"/blocks/{bid}/crdt", headers=h, content=e)
+        assert r.status_code == 200
+    assert (await client.post(f"/blocks/{bid}/crdt", headers=h, content=b"\xff\xff\xff")).status_code == 400
+
+    compactor = BlockCompactor(keep_updates=2, checkpoint_every=3, keep_checkpoints=1)
+    while await compactor.compact(bid):
+        pass
+    async with SessionLocal() as s:
+        rows = (await s.execute(text("SELECT version, kind, ydoc_snapshot FROM block_versions WHERE block_id = :id ORDER BY version"), {"id": bid})).fetchall()
+        state = (await s.execute(text("SELECT ydoc_state FROM blocks WHERE id = :id"), {"id": bid})).scalar()
+    assert [r.kind for r in rows].count("checkpoint") == 1
+    assert len(rows) <= 1 + 2 + 3
+    assert _text(bytes(state)) == "012345678901"
+    replayed, _ = merge_updates([bytes(r.ydoc_snapshot) for r in rows])
+    assert _text(replayed) == "012345678901"
+
+
+@pytest.mark.anyio
+async def test_sync_returns_only_missing_updates(client):
+    from app.utils.framing import DELETED, FULL, decode_frames, encode_frames
+
+    r = await client.post("/auth/register", json={"email": f"sv-{uuid.uuid4().hex[:8]}@example.com", "password": "pass1234"})
+    h = {"Authorization": f"Bearer {r.json()['accessToken']}"}
+    nid = (await client.post("/notes", headers=h, json={"title": "Sync"})).json()["id"]
+    async with SessionLocal() as s:
+        res = await s.execute(
+            text("INSERT INTO blocks (note_id, type, order_idx) SELECT :nid, 'paragraph', g FROM generate_series(1, 2) g RETURNING id"),
+            {"nid": uuid.UUID(nid)},
+        )
+        a, b = [row[0] for row in res]
+        await s.commit()
+    edits = _edits(4)
+    for e in edits[:3]:
+        await client.post(f"/blocks/{a}/crdt", headers=h, content=e)
+    await client.post(f"/blocks/{b}/crdt", headers=h, content=edits[0])
+
+    # Cold open: full state for both blocks, in order
+    r = await client.post(f"/notes/{nid}/blocks/sync", headers=h, content=b"")
+    frames = decode_frames(r.content)
+    assert [(f[0], f[1]) for f in frames] == [(a, FULL), (b, FULL)]
+    assert _text(frames[0][2]) == "012"
+
+    # Client has a's state; one more edit lands on the server
+    _, sv_a = merge_updates(edits[:3])
+    _, sv_b = merge_updates(edits[:1])
+    await client.post(f"/blocks/{a}/crdt", headers=h, content=edits[3])
+    gone = uuid.uuid4()
+    body = encode_frames([(a, 0, sv_a), (b, 0, sv_b), (gone, 0, sv_b)])
+    r = await client.post(f"/notes/{nid}/blocks/sync", headers=h, content=body)
+    frames = decode_frames(r.content)
+    assert [(f[0], f[1]) for f in frames] == [(a, 0), (gone, DELETED)]
+    assert len(frames[0][2]) < len(merge_updates(edits)[0])
+    state = merge_updates(edits[:3] + [frames[0][2]])[0]
+    assert _text(state) == "0123"
+
+
+@pytest.mark.anyio
+async def test_concurrent_pushes_get_distinct_versions(client):
+    import asyncio
+
+    r = await client.post("/auth/register", json={"email": f"cc-{uuid.uuid4().hex[:8]}@example.com", "password": "pass1234"})
+    h = {"Authorization": f"Bearer {r.json()['accessToken']}"}
+    nid = (await client.post("/notes", headers=h, json={"title": "Race"})).json()["id"]
+    async with SessionLocal() as s:
+        res = await s.execute(text("INSERT INTO blocks (note_id, type, order_idx) VALUES (:nid, 'paragraph', 1) RETURNING id"), {"nid": uuid.UUID(nid)})
+        bid = res.scalar()
+        await s.commit()
+    edits = _edits(6)
+    rs = await asyncio.gather(*(client.post(f"/blocks/{bid}/crdt", headers=h, content=e) for e in edits))
+    assert [r.status_code for r in rs] == [200] * 6
+    assert sorted(r.json()["version"] for r in rs) == list(range(1, 7))
+
+
+@pytest.mark.anyio
+async def test_failed_compaction_backs_off(client):
+    r = await client.post("/auth/register", json={"email": f"bo-{uuid.uuid4().hex[:8]}@example.com", "password": "pass1234"})
+    h = {"Authorization": f"Bearer {r.json()['accessToken']}"}
+    nid = (await client.post("/notes", headers=h, json={"title": "Corrupt"})).json()["id"]
+    async with SessionLocal() as s:
+        res = await s.execute(text("INSERT INTO blocks (note_id, type, order_idx) VALUES (:nid, 'paragraph', 1) RETURNING id"), {"nid": uuid.UUID(nid)})
+        bid = res.scalar()
+        # legacy history that can't be merged
+        await s.execute(text("INSERT INTO block_versions (block_id, version, ydoc_snapshot) VALUES (:id, 1, :snap)"), {"id": bid, "snap": b"\xff\xff\xff"})
+        await s.commit()
+    compactor = BlockCompactor(batch=100000)
+    await compactor.run_once()
+    await compactor.run_once()
+    async with SessionLocal() as s:
+        row = (await s.execute(text("SELECT compact_attempts, compact_failed_at FROM blocks WHERE id = :id"), {"id": bid})).fetchone()
+    # the second pass skipped it
+    assert row.compact_attempts == 1 and row.compact_failed_at is not None
+
+
+async def _legacy_block(client, updates):
+    """A block as written before 0009: history rows, no maintained state."""
+    r = await client.post("/auth/register", json={"email": f"leg-{uuid.uuid4().hex[:8]}@example.com", "password": "pass1234"})
+    h = {"Authorization": f"Bearer {r.json()['accessToken']}"}
+    nid = (await client.post("/notes", headers=h, json={"title": "Legacy"})).json()["id"]
+    async with SessionLocal() as s:
+        res = await s.execute(
+            text("INSERT INTO blocks (note_id, type, order_idx, state_version) VALUES (:nid, 'paragraph', 1, :n) RETURNING id"),
+            {"nid": uuid.UUID(nid), "n": len(updates)},
+        )
+        bid = res.scalar()
+        for i, u in enumerate(updates, 1):
+            await s.execute(text("INSERT INTO block_versions (block_id, version, ydoc_snapshot) VALUES (:id, :v, :snap)"), {"id": bid, "v": i, "snap": u})
+        await s.commit()
+    return h, nid, bid
+
+
+@pytest.mark.anyio
+async def test_legacy_block_text_comes_from_history(client, monkeypatch):
+    from app.utils.crdt import decode_pool
+    from app.utils.indexing import rebuild_note_plaintext_from_blocks
+
+    edits = _edits(3)
+    h, nid, bid = await _legacy_block(client, edits)
+    seen = []
+
+    async def decode(*updates):
+        seen.append(list(updates))
+        return "from history"
+
+    monkeypatch.setattr(decode_pool, "decode", decode)
+    async with SessionLocal() as s:
+        assert await rebuild_note_plaintext_from_blocks(s, nid) == "from history"
+        await s.commit()
+    assert seen == [edits]
+    # backfilling its state asks for the note's text to be rebuilt from it
+    assert await BlockCompactor()._backfill(bid)
+    async with SessionLocal() as s:
+        job = (await s.execute(text("SELECT rebuild_blocks FROM index_jobs WHERE note_id = :id"), {"id": nid})).fetchone()
+        state = (await s.execute(text("SELECT ydoc_state FROM blocks WHERE id = :id"), {"id": bid})).scalar()
+    assert job is not None and job.rebuild_blocks
+    assert _text(bytes(state)) == "012"
+
+
+@pytest.mark.anyio
+async def test_sync_replays_history_of_legacy_blocks(client):
+    from app.utils.framing import FULL, decode_frames, encode_frames
+
+    edits = _edits(4)
+    h, nid, bid = await _legacy_block(client, edits)
+    r = await client.post(f"/notes/{nid}/blocks/sync", headers=h, content=b"")
+    frames = decode_frames(r.content)
+    assert [(f[0], f[1]) for f in frames] == [(bid, FULL)] and _text(frames[0][2]) == "0123"
+    # a client holding part of it gets only the rest
+    state, sv = merge_updates(edits[:2])
+    r = await client.post(f"/notes/{nid}/blocks/sync", headers=h, content=encode_frames([(bid, 0, sv)]))
+    frames = decode_frames(r.content)
+    assert [(f[0], f[1]) for f in frames] == [(bid, 0)]
+    assert _text(merge_updates([state, frames[0][2]])[0]) == "0123"
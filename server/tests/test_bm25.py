@@ -0,0 +1,63 @@
+import uuid
+
+from app.utils.bm25 import Bm25Index
+from app.utils.search_backend import _snippet
+
+
+def test_bm25_ranks_and_scopes_to_user():
+    ix = Bm25Index()
+    alice, bob = uuid.uuid4(), uuid.uuid4()
+    dense, sparse, other = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    ix.add(dense, alice, "otter otter otter river")
+    ix.add(sparse, alice, "an otter among many many other words in a long paragraph")
+    ix.add(other, bob, "otter")
+    ix.add(uuid.uuid4(), alice, "nothing relevant")
+    assert [n for n, _ in ix.search(alice, "Otter")] == [dense, sparse]
+    assert [n for n, _ in ix.search(bob, "otter river")] == [other]
+    assert ix.search(alice, "") == []
+
+
+def test_bm25_updates_survive_flush_merge_and_reload(tmp_path):
+    user = uuid.uuid4()
+    a, b = uuid.uuid4(), uuid.uuid4()
+    ix = Bm25Index(str(tmp_path), flush_docs=1, max_segments=2)
+    ix.add(a, user, "heron")
+    ix.flush()
+    ix.add(b, user, "heron egret")
+    ix.flush()
+    ix.add(a, user, "kingfisher")  # supersedes the first version of a
+    ix.flush()
+    assert [n for n, _ in ix.search(user, "heron")] == [b]
+    assert ix.merge() and len(ix.segments) == 1
+    assert ix.search(user, "kingfisher")[0][0] == a
+    ix.remove(b)
+    assert ix.search(user, "egret") == []
+    ix.close()
+
+    reloaded = Bm25Index(str(tmp_path))
+    assert [n for n, _ in reloaded.search(user, "heron")] == [b]  # removals aren't persisted; a rebuild drops them
+    assert [n for n, _ in reloaded.search(user, "kingfisher")] == [a]
+    reloaded.close()
+
+
+def test_bm25_snippet_marks_terms():
+    body = "intro " * 30 + "the Quick fox jumps"
+    snip = _snippet(body, ["quick"])
+    assert "<b>Quick</b>" in snip and len(snip.split()) <= 20
+    assert _snippet("", ["x"]) == ""
+
+
+def test_bm25_merge_keeps_segments_a_query_holds(tmp_path):
+    user = uuid.uuid4()
+    ix = Bm25Index(str(tmp_path), flush_docs=1, max_segments=1)
+    for word in ("stoat", "stoat weasel"):
+        ix.add(uuid.uuid4(), user, word)
+        ix.flush()
+    # a query in another thread holds the segments it started with
+    held, _, _, _ = ix._acquire(["stoat"])
+    assert ix.merge() and len(ix.segments) == 1
+    assert sum(len(seg.postings("stoat")[0]) for seg in held) == 2
+    ix._release(held)
+    assert all(seg._closer is None for seg in held)
+    assert len(ix.search(user, "stoat")) == 2
+    ix.close()
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import uuid
+import pytest
+from sqlalchemy import text
+from y_py import YDoc, encode_state_as_update, encode_state_vector
+
+from app.auth import CurrentUser
+from app.db import SessionLocal
+from app.utils.collab import CollabHub, InProcessBroker, PostgresBroker
+from app.utils.crdt import merge_updates
+from app.utils.framing import AWARENESS, decode_frames, encode_frames
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        self.sent.append(("close", code))
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.anyio
+async def test_awareness_fans_out_to_others_only():
+    hub = CollabHub(InProcessBroker())
+    await hub.start()
+    note = uuid.uuid4()
+    user = CurrentUser(id=str(uuid.uuid4()), email="a@example.com")
+    a, b = FakeSocket(), FakeSocket()
+    ca = hub.join(a, user, note)
+    hub.join(b, user, note)
+    msg = encode_frames([(uuid.UUID(int=0), AWARENESS, b"cursor")])
+    await hub.receive(ca, msg)
+    await _settle()
+    assert b.sent == [msg] and a.sent == []
+    await hub.receive(ca, b"junk")
+    await _settle()
+    assert json.loads(a.sent[-1])["type"] == "error"
+    await hub.leave(ca)
+    assert hub.connections() == 1
+
+
+@pytest.mark.anyio
+async def test_awareness_notify_is_coalesced_per_room():
+    import base64
+
+    broker = PostgresBroker(awareness_ms=20)
+    sent = []
+
+    async def capture(msgs):
+        sent.append(msgs)
+
+    broker._notify = capture
+    # no start(): this exercises the relay without a LISTEN connection
+    hub = CollabHub(broker)
+    broker.hub = hub
+    note = uuid.uuid4()
+    user = CurrentUser(id=str(uuid.uuid4()), email="a@example.com")
+    a, b, c = FakeSocket(), FakeSocket(), FakeSocket()
+    ca, cb = hub.join(a, user, note), hub.join(b, user, note)
+    hub.join(c, user, note)
+    for i in range(5):
+        await hub.receive(ca, encode_frames([(uuid.UUID(int=1), AWARENESS, f"a{i}".encode())]))
+    await hub.receive(cb, encode_frames([(uuid.UUID(int=2), AWARENESS, b"b0")]))
+    await _settle()
+    # local sockets get every frame straight away
+    assert len(c.sent) == 6
+    await asyncio.sleep(0.1)
+    assert len(sent) == 1 and len(sent[0]) == 1
+    msg = json.loads(sent[0][0])
+    frames = decode_frames(base64.b64decode(msg["d"]))
+    assert sorted(f[2] for f in frames) == [b"a4", b"b0"]
+
+
+@pytest.mark.anyio
+async def test_socket_updates_share_the_crdt_limits():
+    import time
+    from app.middleware import MemoryBucketStore, parse_rate_rules
+
+    hub = CollabHub(InProcessBroker(), flush_ms=60000)
+    store = MemoryBucketStore()
+    rule = parse_rate_rules("POST /blocks/*/crdt=2/user")[0]
+    hub.limit_updates(store, rule, 128)
+    note = uuid.uuid4()
+    user = CurrentUser(id=str(uuid.uuid4()), email="a@example.com")
+    ws = FakeSocket()
+    conn = hub.join(ws, user, note)
+    await hub.receive(conn, encode_frames([(uuid.uuid4(), 0, b"x" * 200)]))
+    await _settle()
+    assert json.loads(ws.sent[-1])["detail"] == "Message too large"
+    blocks = [uuid.uuid4() for _ in range(3)]
+    await hub.receive(conn, encode_frames([(b, 0, b"u") for b in blocks]))
+    await _settle()
+    room = hub.rooms[note]
+    assert list(room.pending) == blocks[:2]
+    assert json.loads(ws.sent[-1])["detail"] == "rate limit exceeded"
+    # the HTTP limiter charges the same bucket
+    assert store.take(rule.name + "|u:" + user.id, rule.refill_per_sec, rule.burst, time.time()) > 0
+    # drop the batch rather than write it
+    room.pending, task = {}, room.flush_task
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await hub.leave(conn)
+
+
+@pytest.mark.anyio
+async def test_slow_socket_is_dropped():
+    hub = CollabHub(InProcessBroker(), queue_size=2)
+    await hub.start()
+    note = uuid.uuid4()
+    user = CurrentUser(id=str(uuid.uuid4()), email="a@example.com")
+    slow = FakeSocket()
+    conn = hub.join(slow, user, note)
+    await conn.stop()  # writer never drains
+    for _ in range(3):
+        hub.deliver(note, b"x", "", 0.0)
+    assert conn.queue.get_nowait() is None
+
+
+@pytest.mark.anyio
+async def test_updates_are_batched_into_one_version(client):
+    r = await client.post("/auth/register", json={"email": f"ws-{uuid.uuid4().hex[:8]}@example.com", "password": "pass1234"})
+    token = r.json()["accessToken"]
+    h = {"Authorization": f"Bearer {token}"}
+    nid = uuid.UUID((await client.post("/notes", headers=h, json={"title": "Live"})).json()["id"])
+    async with SessionLocal() as s:
+        res = await s.execute(text("INSERT INTO blocks (note_id, type, order_idx) VALUES (:nid, 'paragraph', 1) RETURNING id"), {"nid": nid})
+        bid = res.scalar()
+        uid = (await s.execute(text("SELECT user_id FROM notes WHERE id = :id"), {"id": nid})).scalar()
+        await s.commit()
+    doc = YDoc()
+    edits = []
+    for ch in "abc":
+        sv = encode_state_vector(doc)
+        with doc.begin_transaction() as txn:
+            doc.get_text("t").extend(txn, ch)
+        edits.append(encode_state_as_update(doc, sv))
+
+    hub = CollabHub(InProcessBroker(), flush_ms=50)
+    await hub.start()
+    user = CurrentUser(id=str(uid), email="x@example.com")
+    a, b = FakeSocket(), FakeSocket()
+    ca = hub.join(a, user, nid)
+    hub.join(b, user, nid)
+    for e in edits:
+        await hub.receive(ca, encode_frames([(bid, 0, e)]))
+    await hub.stop()
+    await _settle()
+    async with SessionLocal() as s:
+        n = (await s.execute(text("SELECT count(*) FROM block_versions WHERE block_id = :id"), {"id": bid})).scalar()
+    assert n == 1
+    ack = json.loads(a.sent[-1])
+    assert ack["type"] == "ack" and ack["versions"] == {str(bid): 1}
+    frames = decode_frames(b.sent[-1])
+    assert frames[0][0] == bid
+    merged, _ = merge_updates([frames[0][2]])
+    assert merged == merge_updates(edits)[0]
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import pytest
+from y_py import YDoc, encode_state_as_update
+
+from app.metrics import registry
+from app.utils.crdt import DecodePool
+
+
+def _update() -> bytes:
+    doc = YDoc()
+    with doc.begin_transaction() as txn:
+        doc.get_text("t").extend(txn, "x" * 64)
+    return encode_state_as_update(doc)
+
+
+def _count(result: str) -> float:
+    return registry.counters.get(("vnote_crdt_decode_pool_total", (("result", result),)), 0.0)
+
+
+@pytest.mark.anyio
+async def test_small_payloads_stay_inline():
+    pool = DecodePool(workers=1, inline_bytes=1 << 20)
+    assert isinstance(await pool.decode(_update()), str)
+    assert pool._pool is None
+
+
+@pytest.mark.anyio
+async def test_oversized_payloads_are_skipped():
+    pool = DecodePool(workers=1, max_bytes=4)
+    before = _count("too_large")
+    assert await pool.decode(_update()) == ""
+    assert _count("too_large") == before + 1
+
+
+@pytest.mark.anyio
+async def test_pool_decode_and_timeout_reset():
+    pool = DecodePool(workers=1, inline_bytes=0, timeout=30.0)
+    try:
+        assert isinstance(await pool.decode(_update()), str)
+        assert pool._pool is not None
+        pool.timeout = 0.0
+        before = _count("timeout")
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.decode(_update())
+        assert _count("timeout") == before + 1
+        assert pool._pool is None
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.anyio
+async def test_timeout_only_counts_running_time():
+    pool = DecodePool(workers=1, inline_bytes=0, timeout=2.5)
+    try:
+        # twelve 0.3s calls through one worker take longer than the timeout in
+        # total, but each is timed only once it holds the worker
+        await asyncio.gather(*(pool.run(time.sleep, 0.3, size=1) for _ in range(12)))
+        assert pool._pool is not None
+    finally:
+        pool.shutdown()
@@ -0,0 +1,24 @@
+import uuid
+import pytest
+
+from app.utils.framing import DELETED, FULL, decode_frames, encode_frames
+
+
+def test_frames_round_trip():
+    frames = [(uuid.uuid4(), FULL, b"state"), (uuid.uuid4(), 0, b""), (uuid.uuid4(), DELETED, b"")]
+    data = encode_frames(frames)
+    assert data.startswith(b"VNB1")
+    assert decode_frames(data) == frames
+    assert decode_frames(b"") == []
+
+
+@pytest.mark.parametrize("cut", [1, 5, 10])
+def test_truncated_frames_are_rejected(cut):
+    data = encode_frames([(uuid.uuid4(), 0, b"0123456789")])
+    with pytest.raises(ValueError):
+        decode_frames(data[:-cut])
+
+
+def test_bad_magic_is_rejected():
+    with pytest.raises(ValueError):
+        decode_frames(b"XXXX")
@@ -0,0 +1,168 @@
+import uuid
+import pytest
+
+
+def test_link_graph_incremental_updates_and_pruning():
+    from app.utils.graph_index import LinkGraph
+
+    ids = [uuid.uuid4() for _ in range(6)]
+    # 0 -> 1 -> 2 -> 3, and 5 is a hub linking to 1..4
+    g = LinkGraph(ids, [f"n{i}" for i in range(6)], [(0, 1), (1, 2), (2, 3), (5, 1), (5, 2), (5, 3), (5, 4), (0, 1)])
+    assert list(g.out(0)) == [1] and sorted(g.inbound(1)) == [0, 5]
+    hops, edges, collapsed, truncated = g.neighborhood(0, 2, 100, 3)
+    assert hops == {0: 0, 1: 1, 2: 2, 5: 2} and not truncated
+    assert sorted(edges) == [(0, 1), (1, 2), (5, 1), (5, 2)]
+    # the hub is reached at depth 1 from 1, but not expanded
+    hops, _, collapsed, _ = g.neighborhood(1, 2, 100, 3)
+    assert 4 not in hops and collapsed == [5]
+    assert len(g.neighborhood(5, 1, 3, 3)[0]) == 3 and g.neighborhood(5, 1, 3, 3)[3]
+
+    new = uuid.uuid4()
+    g.upsert_node(new, "new")
+    g.set_out(ids[3], [new, ids[0], uuid.uuid4()])
+    assert sorted(g.inbound(0)) == [3] and list(g.inbound(6)) == [3]
+    g.set_out(ids[5], [])
+    assert sorted(g.inbound(1)) == [0] and g.degree(5) == 0
+    g.remove_node(ids[2])
+    assert 2 not in g.neighborhood(1, 1, 100, 50)[0]
+    g.repack()
+    assert new in g.index and ids[2] not in g.index
+    assert sorted((g.ids[s], g.ids[t]) for s in range(len(g.ids)) for t in g.out(s)) == sorted(
+        [(ids[0], ids[1]), (ids[3], new), (ids[3], ids[0])]
+    )
+
+
+@pytest.mark.anyio
+async def test_graph_cache_hears_other_processes(monkeypatch):
+    from app.utils import graph_index as gi
+
+    index = gi.GraphIndex()
+    u1, u2 = str(uuid.uuid4()), str(uuid.uuid4())
+    for u in (u1, u2):
+        index._graphs[u] = (gi.LinkGraph([], [], []), float("inf"))
+    index._on_notify(None, 0, gi.CHANNEL, f"{index.worker}|{u1}")
+    assert index.cached(u1) is not None
+    index._on_notify(None, 0, gi.CHANNEL, f"other|{u1}")
+    assert index.cached(u1) is None and index.cached(u2) is not None
+    index._on_notify(None, 0, gi.CHANNEL, "other|*")
+    assert index.cached(u2) is None
+    # without a LISTEN connection nothing may be cached
+    monkeypatch.setattr(gi, "PGBOUNCER", True)
+    await index.start()
+    assert not index.enabled
+
+
+def test_layout_pulls_linked_nodes_together_and_warm_starts():
+    np = pytest.importorskip("numpy")
+    from app.utils.graph_layout import compute_layout
+
+    from app.utils.graph_layout import _exact_repulsion, _grid_repulsion
+
+    # the grid approximation stays close to all-pairs repulsion
+    x, y = np.random.default_rng(1).normal(0, 20, (2, 1000))
+    exact, grid = np.stack(_exact_repulsion(x, y)), np.stack(_grid_repulsion(x, y))
+    assert np.linalg.norm(exact - grid, axis=0).mean() < 0.1 * np.linalg.norm(exact, axis=0).mean()
+    # two 60-node rings joined by one edge, enough to be coarsened
+    src = list(range(120)) + [0]
+    dst = [(i + 1) % 60 + (60 if i >= 60 else 0) for i in range(120)] + [60]
+    flat, steps = compute_layout(120, src, dst, budget=5.0)
+    pos = np.array(flat).reshape(120, 2)
+    assert steps > 0 and np.isfinite(pos).all()
+    linked = np.linalg.norm(pos[src] - pos[dst], axis=1).mean()
+    assert linked < np.linalg.norm(pos[:60].mean(0) - pos[60:].mean(0))
+    # one more node hanging off node 5: the rest barely moves
+    warm, _ = compute_layout(121, src + [120], dst + [5], flat + [float("nan")] * 2, budget=5.0)
+    moved = np.linalg.norm(np.array(warm[:240]).reshape(120, 2) - pos, axis=1)
+    assert moved.mean() < linked and np.linalg.norm(np.array(warm[240:]) - pos[5]) < 3 * linked
+
+
+@pytest.mark.anyio
+async def test_layouts_are_computed_in_background_and_cached():
+    pytest.importorskip("numpy")
+    import asyncio
+    from app.utils.graph_layout import GraphLayouts
+
+    layouts = GraphLayouts(workers=1, budget=0.5, max_nodes=10)
+    try:
+        ids = ["a", "b", "c"]
+        positions, status = layouts.positions("k", ids, [0, 1], [1, 2])
+        assert (positions, status) == ({}, "pending")
+        for _ in range(300):
+            positions, status = layouts.positions("k", ids, [0, 1], [1, 2])
+            if status == "ready":
+                break
+            await asyncio.sleep(0.1)
+        assert status == "ready" and set(positions) == set(ids)
+        # a changed graph keeps serving the old positions while it is redone
+        positions, status = layouts.positions("k", ids + ["d"], [0, 1, 2], [1, 2, 3])
+        assert status == "pending" and set(positions) == set(ids)
+        assert layouts.positions("k", list("abcdefghijk"), [], [])[1] == "unavailable"
+    finally:
+        await layouts.stop()
+
+
+@pytest.mark.anyio
+async def test_layouts_queue_for_a_worker_instead_of_timing_out():
+    pytest.importorskip("numpy")
+    import asyncio
+    from app.utils.graph_layout import GraphLayouts
+
+    layouts = GraphLayouts(workers=1, budget=0.2, max_nodes=10)
+    try:
+        for k in range(4):
+            layouts.positions(k, ["a", "b"], [0], [1])
+        peak = 0
+        for _ in range(300):
+            peak = max(peak, layouts.running)
+            if all(layouts.positions(k, ["a", "b"], [0], [1])[1] == "ready" for k in range(4)):
+                break
+            await asyncio.sleep(0.05)
+        assert peak == 1 and layouts.computed == 4 and layouts.failed == 0
+    finally:
+        await layouts.stop()
+
+
+async def _login(client):
+    r = await client.post("/auth/register", json={"email": f"g-{uuid.uuid4().hex[:8]}@example.com", "password": "pass1234"})
+    return {"Authorization": f"Bearer {r.json()['accessToken']}"}
+
+
+@pytest.mark.anyio
+async def test_neighborhood_follows_link_edits(client):
+    h = await _login(client)
+    a = (await client.post("/notes", headers=h, json={"title": "A", "body": "see [[B]]"})).json()["id"]
+    r = await client.get("/graph/neighborhood", headers=h, params={"noteId": a, "depth": 2})
+    assert r.status_code == 200
+    assert {n["label"]: n["depth"] for n in r.json()["nodes"]} == {"A": 0, "B": 1}
+    b = next(n["id"] for n in r.json()["nodes"] if n["label"] == "B")
+    # served from the cached graph, updated by the commit
+    await client.patch(f"/notes/{b}", headers=h, json={"body": "on to [[C]]"})
+    r = await client.get("/graph/neighborhood", headers=h, params={"noteId": a, "depth": 2})
+    assert {n["label"]: n["depth"] for n in r.json()["nodes"]} == {"A": 0, "B": 1, "C": 2}
+    assert len(r.json()["edges"]) == 2
+    await client.delete(f"/notes/{b}", headers=h)
+    r = await client.get("/graph/neighborhood", headers=h, params={"noteId": a, "depth": 2})
+    assert [n["label"] for n in r.json()["nodes"]] == ["A"]
+    r = await client.get("/graph/neighborhood", headers=h, params={"noteId": b})
+    assert r.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_graph_returns_layout_coordinates(client):
+    pytest.importorskip("numpy")
+    import asyncio
+
+    h = await _login(client)
+    await client.post("/notes/batch", headers=h, json={"notes": [{"title": "Hub", "body": "[[X]] [[Y]] [[Z]]"}, {"title": "X", "body": "[[Y]]"}]})
+    for _ in range(300):
+        r = await client.get("/graph", headers=h)
+        if r.json()["layout"] == "ready":
+            break
+        await asyncio.sleep(0.1)
+    body = r.json()
+    assert body["layout"] == "ready" and len(body["edges"]) == 4
+    assert {n["label"] for n in body["nodes"]} == {"Hub", "X", "Y", "Z"}
+    assert all(isinstance(n["x"], float) and isinstance(n["y"], float) for n in body["nodes"])
+    r = await client.get("/graph", headers=h, params={"limit": 2})
+    labels = [n["label"] for n in r.json()["nodes"]]
+    assert len(labels) == 2 and "Hub" in labels
@@ -0,0 +1,99 @@
+import uuid
+import pytest
+from sqlalchemy import text
+
+from app.db import SessionLocal
+from app.index_queue import IndexWorker, enqueue_index, index_worker
+
+
+async def register_and_login(client):
+    r = await client.post("/auth/register", json={"email": f"idx-{uuid.uuid4().hex[:8]}@example.com", "password": "pass1234"})
+    return r.json()["accessToken"]
+
+
+@pytest.mark.anyio
+async def test_repeated_writes_coalesce_into_one_job(client):
+    token = await register_and_login(client)
+    h = {"Authorization": f"Bearer {token}"}
+    r = await client.post("/notes", headers=h, json={"title": "Queued", "body": "first"})
+    nid = r.json()["id"]
+    for i in range(3):
+        r = await client.patch(f"/notes/{nid}", headers=h, json={"body": f"rev {i} zebra"})
+        assert r.status_code == 200
+    async with SessionLocal() as s:
+        res = await s.execute(text("SELECT count(*) FROM index_jobs WHERE note_id = :id"), {"id": nid})
+        assert res.scalar() in (0, 1)
+    assert await index_worker.wait_for([nid])
+    async with SessionLocal() as s:
+        res = await s.execute(
+            text("SELECT content_tsv @@ plainto_tsquery('english', 'zebra') FROM note_search WHERE note_id = :id"), {"id": nid}
+        )
+        assert res.scalar() is True
+
+
+@pytest.mark.anyio
+async def test_rerequest_during_processing_stays_queued(client):
+    token = await register_and_login(client)
+    h = {"Authorization": f"Bearer {token}"}
+    nid = (await client.post("/notes", headers=h, json={"title": "Race"})).json()["id"]
+    jobs = await index_worker._claim([nid])
+    assert len(jobs) == 1
+    async with SessionLocal() as s:
+        await enqueue_index(s, [nid])
+        await s.commit()
+    async with SessionLocal() as s:
+        await index_worker._complete(s, jobs)
+        await s.commit()
+        res = await s.execute(text("SELECT claimed_until FROM index_jobs WHERE note_id = :id"), {"id": nid})
+        row = res.fetchone()
+    assert row is not None and row.claimed_until is None
+    assert await index_worker.wait_for([nid])
+
+
+@pytest.mark.anyio
+async def test_busy_note_is_claimed_after_max_delay(client):
+    token = await register_and_login(client)
+    h = {"Authorization": f"Bearer {token}"}
+    nid = (await client.post("/notes", headers=h, json={"title": "Busy"})).json()["id"]
+    async with SessionLocal() as s:
+        await s.execute(
+            text("UPDATE index_jobs SET first_requested_at = clock_timestamp() - interval '1 hour' WHERE note_id = :id"), {"id": nid}
+        )
+        await s.commit()
+    # still being edited, so never quiet for the debounce; zero lease leaves other jobs claimable
+    worker = IndexWorker(batch=10000, debounce=3600, lease=0, max_delay=60)
+    jobs = await worker._claim()
+    assert str(nid) in {str(j.note_id) for j in jobs}
+    assert await index_worker.wait_for([nid])
+
+
+@pytest.mark.anyio
+async def test_undecodable_block_is_indexed_blank_after_max_attempts(client, monkeypatch):
+    import asyncio
+    from app.utils.crdt import decode_pool
+
+    token = await register_and_login(client)
+    h = {"Authorization": f"Bearer {token}"}
+    nid = (await client.post("/notes", headers=h, json={"title": "Stuck"})).json()["id"]
+    async with SessionLocal() as s:
+        bid = (await s.execute(text("INSERT INTO blocks (note_id, type, order_idx) VALUES (:nid, 'paragraph', 1) RETURNING id"), {"nid": uuid.UUID(nid)})).scalar()
+        await s.commit()
+    assert (await client.post(f"/blocks/{bid}/crdt", headers=h, content=b"\x00\x00")).status_code == 200
+
+    async def hang(update):
+        raise asyncio.TimeoutError()
+
+    monkeypatch.setattr(decode_pool, "decode", hang)
+    worker = IndexWorker(lease=0, max_attempts=2)
+    for _ in range(2):
+        async with SessionLocal() as s:
+            # skip the retry backoff
+            await s.execute(text("UPDATE index_jobs SET claimed_until = NULL WHERE note_id = :id"), {"id": nid})
+            await s.commit()
+        assert await worker.run_once([nid]) == 1
+    async with SessionLocal() as s:
+        assert (await s.execute(text("SELECT count(*) FROM index_jobs WHERE note_id = :id"), {"id": nid})).scalar() == 0
+        row = (await s.execute(text("SELECT text_cache, text_cache_version, state_version FROM blocks WHERE id = :id"), {"id": bid})).fetchone()
+    assert row.text_cache == "" and row.text_cache_version == row.state_version
+    r = await client.get("/search", headers=h, params={"q": "Stuck"})
+    assert nid in [hit["id"] for hit in r.json()["results"]]
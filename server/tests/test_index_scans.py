@@ -0,0 +1,78 @@
+import re
+import uuid
+import pytest
+from sqlalchemy import event, text
+from app.auth import token_cache
+from app.db import engine
+
+
+# Tables the routers look rows up in; catalog and CTE scans don't count
+APP_TABLES = {
+    "users", "sessions", "notes", "links", "blocks", "block_versions", "folders", "tags",
+    "note_tags", "attachments", "repos", "repo_files", "index_jobs", "note_search",
+}
+SEQ_SCAN = re.compile(r"Seq Scan on (\w+)")
+# Each of these must be among the statements captured below, so a renamed
+# or removed lookup fails here instead of silently going unchecked
+EXPECTED = ["FROM sessions", "FROM links", "FROM blocks", "FROM folders", "FROM tags", "FROM attachments", "FROM repos"]
+
+
+async def _hot_requests(client):
+    r = await client.post("/auth/register", json={"email": f"scan-{uuid.uuid4().hex[:8]}@example.com", "password": "pass"})
+    h = {"Authorization": f"Bearer {r.json()['accessToken']}"}
+    # Force the token through the session lookup rather than the cache
+    token_cache.clear()
+    nid = (await client.post("/notes", headers=h, json={"title": "Scan", "body": "see [[Scan target]]"})).json()["id"]
+    await client.get(f"/notes/{nid}", headers=h)
+    await client.patch(f"/notes/{nid}", headers=h, json={"title": "Scan 2"})
+    await client.get(f"/notes/{nid}/backlinks", headers=h)
+    await client.post(f"/notes/{nid}/blocks", headers=h, params={"type": "paragraph"})
+    fid = (await client.post("/folders", headers=h, json={"name": "Scan"})).json()["id"]
+    await client.patch(f"/folders/{fid}", headers=h, json={"name": "Scan 2"})
+    tid = (await client.post("/tags", headers=h, json={"name": "scan"})).json()["id"]
+    await client.patch(f"/tags/{tid}", headers=h, json={"name": "scan2"})
+    await client.get(f"/attachments/{uuid.uuid4()}", headers=h)
+    await client.post("/repos", headers=h, params={"name": f"scan-{uuid.uuid4().hex[:6]}"})
+    await client.get(f"/repos/{uuid.uuid4()}/files", headers=h)
+    await client.delete(f"/notes/{nid}", headers=h)
+
+
+@pytest.mark.anyio
+async def test_hot_lookups_use_indexes(client):
+    # EXPLAIN exactly what the routers send, with the parameters they bound
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            captured.append((statement, parameters))
+
+    event.listen(engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        await _hot_requests(client)
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", capture)
+    lookups = [
+        (sql, params)
+        for sql, params in captured
+        if sql.lstrip().split(None, 1)[0].upper() in ("SELECT", "UPDATE", "DELETE", "WITH")
+        and any(t in sql for t in APP_TABLES)
+    ]
+    for fragment in EXPECTED:
+        assert any(fragment in sql for sql, _ in lookups), f"no captured statement contains {fragment!r}"
+    async with engine.connect() as conn:
+        # With seq scans priced out, any remaining Seq Scan means no index applies
+        await conn.execute(text("SET LOCAL enable_seqscan = off"))
+        for sql, params in lookups:
+            res = await conn.exec_driver_sql("EXPLAIN " + sql, params)
+            plan = "\n".join(r[0] for r in res)
+            tables = set(SEQ_SCAN.findall(plan)) & APP_TABLES
+            assert not tables, f"seq scan on {sorted(tables)}:\n{sql}\n{plan}"
+        await conn.rollback()
+
+
+@pytest.mark.anyio
+async def test_garbage_ids_are_rejected(client):
+    r = await client.post("/auth/register", json={"email": f"ids-{uuid.uuid4().hex[:8]}@example.com", "password": "pass"})
+    h = {"Authorization": f"Bearer {r.json()['accessToken']}"}
+    assert (await client.get("/notes/not-a-uuid", headers=h)).status_code == 422
+    assert (await client.get(f"/notes/{uuid.uuid4()}", headers=h)).status_code == 404
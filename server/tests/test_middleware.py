@@ -0,0 +1,103 @@
+import pytest
+from httpx import AsyncClient, ASGITransport
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from fastapi import Body, FastAPI
+
+from app.middleware import (
+    BodySizeLimitMiddleware,
+    MemoryBucketStore,
+    RateLimitMiddleware,
+    SharedBucketStore,
+    parse_body_rules,
+    parse_rate_rules,
+    parse_size,
+)
+
+
+async def _ok(request):
+    return PlainTextResponse("ok")
+
+
+def _app(**kwargs):
+    inner = Starlette(routes=[Route("/{path:path}", _ok, methods=["GET", "POST"])])
+    return RateLimitMiddleware(inner, **kwargs)
+
+
+@pytest.mark.anyio
+async def test_rate_limit_default_and_route_rules():
+    app = _app(max_per_minute=2, rules=parse_rate_rules("POST /blocks/*/crdt=5/user"))
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as c:
+        assert (await c.get("/notes")).status_code == 200
+        assert (await c.get("/notes")).status_code == 200
+        r = await c.get("/notes")
+        assert r.status_code == 429 and int(r.headers["retry-after"]) >= 1
+        assert (await c.get("/health")).status_code == 200
+        # Per-user CRDT budget is separate from the per-IP default
+        h = {"Authorization": "Bearer abc"}
+        codes = [(await c.post(f"/blocks/{i}/crdt", headers=h)).status_code for i in range(6)]
+        assert codes == [200] * 5 + [429]
+        # Unverified tokens fall back to the client IP, so inventing one doesn't reset the budget
+        r = await c.post("/blocks/x/crdt", headers={"Authorization": "Bearer made-up"})
+        assert r.status_code == 429
+
+
+def test_bucket_store_refills_and_evicts():
+    store = MemoryBucketStore(max_keys=2)
+    assert store.take("a", 1.0, 1, now=0.0) == 0.0
+    assert store.take("a", 1.0, 1, now=0.5) == pytest.approx(0.5)
+    assert store.take("a", 1.0, 1, now=1.5) == 0.0
+    store.take("b", 1.0, 1, now=2.0)
+    store.take("c", 1.0, 1, now=2.0)
+    assert len(store) == 2
+
+
+def test_shared_store_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "rl")
+    a, b = SharedBucketStore(path, slots=64), SharedBucketStore(path, slots=64)
+    try:
+        assert a.take("k", 1.0, 2, now=10.0) == 0.0
+        assert b.take("k", 1.0, 2, now=10.0) == 0.0
+        assert a.take("k", 1.0, 2, now=10.0) > 0
+        # Non-blocking callers back off instead of waiting for the lock
+        with a._mutex:
+            assert a.take("k", 1.0, 2, now=20.0, blocking=False) is None
+        assert b.take("k", 1.0, 2, now=20.0, blocking=False) == 0.0
+    finally:
+        a.close()
+        b.close()
+
+
+def _body_app():
+    inner = FastAPI()
+
+    @inner.post("/blocks/{block_id}/crdt")
+    async def push(block_id: str, payload: bytes = Body(..., media_type="application/octet-stream")):
+        return {"bytes": len(payload)}
+
+    return BodySizeLimitMiddleware(inner, max_body_bytes=1024, rules=parse_body_rules("POST /blocks/*/crdt=16"))
+
+
+@pytest.mark.anyio
+async def test_body_limit_counts_streamed_bytes():
+    async def chunks(n):
+        for _ in range(n):
+            yield b"x" * 8
+
+    async with AsyncClient(transport=ASGITransport(app=_body_app()), base_url="http://test") as c:
+        h = {"Content-Type": "application/octet-stream"}
+        r = await c.post("/blocks/1/crdt", headers=h, content=chunks(2))
+        assert r.status_code == 200 and r.json() == {"bytes": 16}
+        r = await c.post("/blocks/1/crdt", headers=h, content=chunks(3))
+        assert r.status_code == 413
+        r = await c.post("/blocks/1/crdt", headers=h, content=b"x" * 17)
+        assert r.status_code == 413
+
+
+def test_parse_size():
+    assert parse_size("512KB") == 512 * 1024
+    assert parse_size("2MB") == 2 * 1024 * 1024
+    assert parse_size("100") == 100
+    assert parse_size("lots") is None
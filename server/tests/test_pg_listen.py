@@ -0,0 +1,34 @@
+import asyncio
+import pytest
+from sqlalchemy import text
+
+from app.db import engine
+from app.utils.pg_listen import PgListener
+
+
+@pytest.mark.anyio
+async def test_listener_reconnects_after_termination(client):
+    got, reconnects = [], []
+    listener = PgListener("test", min_backoff=0.05)
+    listener.on_reconnect.append(lambda: reconnects.append(1))
+    await listener.listen("vnote_test_listen", lambda conn, pid, ch, payload: got.append(payload))
+    await listener.start()
+    try:
+        pid = listener._raw.get_server_pid()
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT pg_terminate_backend(:pid)"), {"pid": pid})
+        for _ in range(100):
+            if reconnects:
+                break
+            await asyncio.sleep(0.05)
+        assert reconnects and listener.connected and listener._raw.get_server_pid() != pid
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT pg_notify('vnote_test_listen', 'after')"))
+            await conn.commit()
+        for _ in range(100):
+            if got:
+                break
+            await asyncio.sleep(0.05)
+        assert got == ["after"]
+    finally:
+        await listener.stop()
@@ -0,0 +1,202 @@
+import uuid
+import pytest
+
+
+async def _login(client):
+    r = await client.post("/auth/register", json={"email": f"s-{uuid.uuid4().hex[:8]}@example.com", "password": "pass1234"})
+    return {"Authorization": f"Bearer {r.json()['accessToken']}"}
+
+
+@pytest.mark.anyio
+async def test_body_is_searchable_and_title_ranks_first(client):
+    h = await _login(client)
+    body = await client.post("/notes", headers=h, params={"waitForIndex": "true"}, json={"title": "Groceries", "body": "buy a zebra crossing sign"})
+    title = await client.post("/notes", headers=h, params={"waitForIndex": "true"}, json={"title": "Zebra facts", "body": "stripes"})
+    r = await client.get("/search", headers=h, params={"q": "zebra"})
+    assert r.status_code == 200
+    hits = r.json()["results"]
+    assert [x["id"] for x in hits] == [title.json()["id"], body.json()["id"]]
+    assert "<b>zebra</b>" in hits[1]["snippet"]
+
+
+@pytest.mark.anyio
+async def test_search_config_validation(client):
+    h = await _login(client)
+    r = await client.get("/search/config", headers=h)
+    assert r.json()["config"] == "english" and "simple" in r.json()["available"]
+    assert (await client.put("/search/config", headers=h, json={"config": "klingon"})).status_code == 422
+    r = await client.put("/search/config", headers=h, json={"config": "simple"})
+    assert r.json() == {"config": "simple", "reindexing": True}
+
+
+def test_recent_titles_prefix_match_and_bounds():
+    from app.utils.title_cache import RecentTitles
+
+    cache = RecentTitles(max_users=1, per_user=2)
+    a, b, c = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    cache.touch("u1", a, "Project Alpha")
+    cache.touch("u1", b, "project beta")
+    assert [t for _, t in cache.match("u1", "PRO")] == ["project beta", "Project Alpha"]
+    cache.touch("u1", c, "Other")
+    assert [t for _, t in cache.match("u1", "pro")] == ["project beta"]
+    cache.rename("u1", b, "Renamed")
+    assert cache.match("u1", "pro") == []
+    cache.touch("u2", a, "Project Alpha")
+    assert cache.match("u1", "o") == []
+
+
+@pytest.mark.anyio
+async def test_title_search_prefix_and_typos(client):
+    h = await _login(client)
+    ids = {}
+    for t in ("Meeting notes", "Meal plan", "Quarterly report"):
+        ids[t] = (await client.post("/notes", headers=h, json={"title": t})).json()["id"]
+    r = await client.get("/search/titles", headers=h, params={"q": "me"})
+    assert {x["title"] for x in r.json()} == {"Meeting notes", "Meal plan"}
+    r = await client.get("/search/titles", headers=h, params={"q": "quartrly"})
+    assert r.json()[0]["title"] == "Quarterly report"
+    await client.get(f"/notes/{ids['Meal plan']}", headers=h)
+    r = await client.get("/search/titles", headers=h, params={"q": "mea", "limit": 1})
+    assert r.json() == [{"id": ids["Meal plan"], "title": "Meal plan", "recent": True}]
+    # renamed and deleted by another worker: this worker's cache doesn't know
+    from app.db import SessionLocal
+    from sqlalchemy import text
+
+    async with SessionLocal() as s:
+        await s.execute(text("UPDATE notes SET title = 'Meals for May' WHERE id = :id"), {"id": uuid.UUID(ids["Meal plan"])})
+        await s.commit()
+    r = await client.get("/search/titles", headers=h, params={"q": "mea", "limit": 1})
+    assert r.json() == [{"id": ids["Meal plan"], "title": "Meals for May", "recent": True}]
+    async with SessionLocal() as s:
+        await s.execute(text("UPDATE notes SET deleted_at = now() WHERE id = :id"), {"id": uuid.UUID(ids["Meal plan"])})
+        await s.commit()
+    r = await client.get("/search/titles", headers=h, params={"q": "mea"})
+    assert ids["Meal plan"] not in {x["id"] for x in r.json()}
+
+
+@pytest.mark.anyio
+async def test_admin_reindex_runs_in_chunks(client, monkeypatch):
+    import asyncio
+    from app import auth
+
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", "secret")
+    admin = {"Authorization": "Bearer secret"}
+    h = await _login(client)
+    word = f"okapi{uuid.uuid4().hex[:6]}"
+    for i in range(3):
+        await client.post("/notes", headers=h, params={"waitForIndex": "true"}, json={"title": f"{word} {i}"})
+    r = await client.post("/admin/reindex-search", headers=admin, json={"chunkSize": 2})
+    assert r.status_code == 202
+    job = r.json()
+    for _ in range(200):
+        job = (await client.get(f"/admin/reindex-search/{job['id']}", headers=admin)).json()
+        if job["status"] != "running":
+            break
+        await asyncio.sleep(0.05)
+    assert job["status"] == "done" and job["processed"] >= 3
+    assert len((await client.get("/search", headers=h, params={"q": word})).json()["results"]) == 3
+    assert (await client.get(f"/admin/reindex-search/{uuid.uuid4()}", headers=admin)).status_code == 404
+
+
+def test_search_cache_generations_and_budget():
+    from app.utils.search_cache import SearchCache
+
+    cache = SearchCache(max_bytes=800, max_users=2)
+    gen = cache.generation("u1")
+    cache.put("u1", ("a",), gen, ["hit"], 100)
+    assert cache.get("u1", ("a",)) == ["hit"]
+    cache.bump(["u2"])
+    assert cache.get("u1", ("a",)) == ["hit"]
+    # Computed before a write, stored after it: never served
+    stale = cache.generation("u1")
+    cache.bump(["u1"])
+    cache.put("u1", ("b",), stale, ["old"], 100)
+    assert cache.get("u1", ("a",)) is None and cache.get("u1", ("b",)) is None
+    gen = cache.generation("u1")
+    for i in range(8):
+        cache.put("u1", (i,), gen, [i], 100)
+    cache.get("u1", (0,))
+    cache.put("u1", ("x",), gen, ["x"], 100)
+    assert cache.bytes <= 800 and cache.get("u1", (0,)) == [0] and cache.get("u1", (1,)) is None
+    # Generations evicted past max_users still invalidate
+    cache.bump(["u3", "u4"])
+    assert cache.get("u1", (0,)) is None
+
+
+@pytest.mark.anyio
+async def test_search_cache_needs_direct_listen_under_pgbouncer(monkeypatch):
+    from app.utils import search_cache as sc
+
+    monkeypatch.setattr(sc, "PGBOUNCER", True)
+    cache = sc.SearchCache(max_bytes=800)
+    await cache.start()
+    assert not cache.enabled and not cache.listener.connected
+    # a reconnect forgets every generation, since NOTIFYs may have been missed
+    cache = sc.SearchCache(max_bytes=800)
+    gen = cache.generation("u1")
+    cache.put("u1", ("a",), gen, ["hit"], 100)
+    for fn in cache.listener.on_reconnect:
+        fn()
+    assert cache.get("u1", ("a",)) is None
+
+
+@pytest.mark.anyio
+async def test_search_cache_invalidated_by_writes(client):
+    from app.utils.search_cache import search_cache
+
+    h = await _login(client)
+    word = f"quokka{uuid.uuid4().hex[:6]}"
+    await client.post("/notes", headers=h, params={"waitForIndex": "true"}, json={"title": f"{word} one"})
+    first = (await client.get("/search", headers=h, params={"q": word})).json()
+    hits = search_cache.hits
+    assert (await client.get("/search", headers=h, params={"q": f"  {word.upper()} "})).json() == first
+    assert search_cache.hits == hits + 1
+    await client.post("/notes", headers=h, params={"waitForIndex": "true"}, json={"title": f"{word} two"})
+    assert len((await client.get("/search", headers=h, params={"q": word})).json()["results"]) == 2
+
+
+@pytest.mark.anyio
+async def test_search_pages_and_facets(client, monkeypatch):
+    from sqlalchemy import text
+    from app.db import SessionLocal
+    from app.utils import search_backend as search_backend_module
+
+    h = await _login(client)
+    word = f"wombat{uuid.uuid4().hex[:6]}"
+    folder = (await client.post("/folders", headers=h, json={"name": "Zoo"})).json()["id"]
+    tag = (await client.post("/tags", headers=h, json={"name": "marsupial"})).json()["id"]
+    ids = []
+    for i in range(5):
+        r = await client.post(
+            "/notes", headers=h, params={"waitForIndex": "true"},
+            json={"title": f"{word} {i}", "folderId": folder if i < 3 else None},
+        )
+        ids.append(r.json()["id"])
+    async with SessionLocal() as s:
+        await s.execute(
+            text("INSERT INTO note_tags (note_id, tag_id) SELECT unnest(CAST(:ids AS uuid[])), :tag"),
+            {"ids": [uuid.UUID(i) for i in ids[:2]], "tag": uuid.UUID(tag)},
+        )
+        await s.commit()
+    seen = []
+    params = {"q": word, "limit": 2}
+    while True:
+        r = await client.get("/search", headers=h, params=params)
+        seen += [x["id"] for x in r.json()["results"]]
+        if "x-next-cursor" not in r.headers:
+            break
+        params["cursor"] = r.headers["x-next-cursor"]
+    assert sorted(seen) == sorted(ids)
+    r = await client.get("/search", headers=h, params={"q": word, "limit": 2, "facets": "tags,folders"})
+    body = r.json()
+    assert body["total"] == 5 and not body["truncated"] and len(body["results"]) == 2 and body["nextCursor"]
+    assert body["facets"]["tags"] == [{"id": tag, "name": "marsupial", "count": 2}]
+    assert {(f["id"], f["count"]) for f in body["facets"]["folders"]} == {(folder, 3), (None, 2)}
+    r = await client.get("/search", headers=h, params={"q": word, "cursor": body["nextCursor"], "facets": "folders"})
+    assert len(r.json()["results"]) == 3
+    assert (await client.get("/search", headers=h, params={"q": word, "facets": "authors"})).status_code == 422
+    # total never promises more than paging can reach
+    monkeypatch.setattr(search_backend_module, "CANDIDATES", 3)
+    for facets in ("", "folders"):
+        body = (await client.get("/search", headers=h, params={"q": word, "limit": 10, "facets": facets})).json()
+        assert body["total"] == 3 and body["truncated"] and len(body["results"]) == 3
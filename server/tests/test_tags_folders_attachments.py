@@ -10,6 +10,8 @@ async def test_tags_folders_attachments(client):
     # Tag
     r = await client.post("/tags", headers=h, json={"name": "inbox"})
     assert r.status_code in (200, 409)
+    r = await client.post("/tags", headers=h, json={"name": "inbox"})
+    assert r.status_code == 409
     # Folder
     r = await client.post("/folders", headers=h, json={"name": "Docs"})
     assert r.status_code == 200